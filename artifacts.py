@@ -0,0 +1,131 @@
+import atexit
+import io
+import json
+import logging
+import os
+import queue
+import threading
+
+from PIL import Image
+
+import epd_image
+
+logger = logging.getLogger(__name__)
+
+_writer = None
+
+
+class ArtifactWriter:
+    """
+    Encodes and writes files on a background thread, so disk I/O stays off the critical path
+    Every file is written to a temporary file first and renamed, readers never see a partial file.
+    Failures are logged and kept in failures until flush() returns them.
+    """
+
+    def __init__(self):
+        self.failures = []
+        self._queue = queue.Queue()
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name="artifact-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, path: str, encode) -> None:
+        """
+        Queues a file
+        :param path:
+            Path of the file
+        :param encode:
+            Function returning the content as bytes, called on the writer thread
+        """
+        self._queue.put((path, lambda: write_atomic(path, encode())))
+
+    def call(self, name: str, function) -> None:
+        """
+        Queues a function doing its own I/O, e.g. appending to a file
+        :param name:
+            Name its failure is reported with, like the path of a file
+        """
+        self._queue.put((name, function))
+
+    def _run(self):
+        while True:
+            (name, job) = self._queue.get()
+            try:
+                job()
+            except Exception as e:
+                logger.error(f"Writing {name} failed: {e!r}")
+                self.failures.append((name, e))
+            finally:
+                self._queue.task_done()
+
+    def flush(self) -> list:
+        """Waits until all queued files are written, returns the failures since the last flush"""
+        self._queue.join()
+        failures, self.failures = self.failures, []
+        return failures
+
+
+def write_atomic(path: str, data: bytes) -> None:
+    # Writes to a temporary file next to the target and renames it
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as outfile:
+            outfile.write(data)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def get_writer() -> ArtifactWriter:
+    """Returns the writer of this process, a forked process starts its own"""
+    global _writer
+    if _writer is None or _writer._pid != os.getpid():
+        _writer = ArtifactWriter()
+    return _writer
+
+
+def write_image(path: str, image: Image, **params) -> None:
+    """Queues the image, the format follows from the file extension. The image must not be modified afterwards."""
+
+    def encode():
+        buffer = io.BytesIO()
+        image.save(buffer, format=Image.registered_extensions()[os.path.splitext(path)[1].lower()], **params)
+        return buffer.getvalue()
+
+    get_writer().submit(path, encode)
+
+
+def write_frame(path: str, image_black: Image, image_red: Image) -> None:
+    """Queues the bands returned by to_palette() as palette PNG with 2 bits per pixel"""
+
+    def encode():
+        buffer = io.BytesIO()
+        epd_image.join_bitplanes(image_black, image_red).save(buffer, format="PNG", optimize=True)
+        return buffer.getvalue()
+
+    get_writer().submit(path, encode)
+
+
+def write_bitplanes(path: str, image_black: Image, image_red: Image) -> None:
+    """Queues the bands returned by to_palette() as packed black plane followed by the packed red plane"""
+    get_writer().submit(path, lambda: b"".join(epd_image.pack_bitplanes(image_black, image_red)))
+
+
+def write_json(path: str, data) -> None:
+    get_writer().submit(path, lambda: json.dumps(data, indent=4).encode("utf-8"))
+
+
+def flush() -> list:
+    """Waits for all queued files of this process, returns the failures"""
+    if _writer is None or _writer._pid != os.getpid():
+        return []
+    return _writer.flush()
+
+
+# Files queued by short-lived scripts are written before they exit, processes ending with os._exit() have to flush()
+atexit.register(flush)
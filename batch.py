@@ -0,0 +1,138 @@
+#!/usr/bin/python
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import time
+
+import artifacts
+import draw_forecasts
+import owm_forecasts
+from epd_image import pack_bitplanes
+from epd_image import to_palette
+from weather_display import WeatherDisplay
+
+logger = logging.getLogger(__name__)
+
+## Paths config
+_HERE = os.path.dirname(__file__)
+
+
+def load_sites(path: str) -> list:
+    """
+    Reads the list of sites to render
+    Every site is a dict with a unique "name" and any config.json keys it overrides,
+    e.g. lat, lon, locale, temp_units, wind_units or mqtt_topic.
+    """
+    with open(path, "r") as sitesfile:
+        sites = json.load(sitesfile)
+    names = [site["name"] for site in sites]
+    if len(set(names)) != len(names):
+        raise ValueError("Site names must be unique.")
+    return sites
+
+
+def render_site(site: dict, outdir: str) -> tuple:
+    """
+    Renders the dashboard of a single site and writes <name>.png and <name>.bin
+    The .bin file holds the packed black plane followed by the packed red plane,
+    in the byte layout EPD.display() sends to the panel.
+    :return:
+        Tuple of the site name and the render time in seconds
+    """
+    start = time.perf_counter()
+    draw_forecasts.configure_site(site)
+    display = WeatherDisplay(pixel_width=800, pixel_height=480, width_mm=163, height_mm=98)
+    image = draw_forecasts.get_forecast_image(display=display)
+    image_black, image_red = to_palette(image=image, palette="bwr", dither=draw_forecasts.dither)
+    black, red = pack_bitplanes(image_black, image_red)
+
+    image.save(os.path.join(outdir, f"{site['name']}.png"))
+    with open(os.path.join(outdir, f"{site['name']}.bin"), "wb") as outfile:
+        outfile.write(black)
+        outfile.write(red)
+    # Pool workers exit without running atexit handlers, so the history has to be written now
+    artifacts.flush()
+    return site["name"], time.perf_counter() - start
+
+
+def prefetch_weather(sites: list) -> dict:
+    """Fetches the weather data of all sites into this process's cache, once per grid cell and language"""
+    locations = []
+    for site in sites:
+        draw_forecasts.configure_site(site)
+        locations.append((draw_forecasts.lat, draw_forecasts.lon, owm_forecasts.language))
+    return owm_forecasts.prefetch(locations, token=draw_forecasts.token)
+
+
+def _render_site_safe(args: tuple) -> tuple:
+    site, outdir = args
+    try:
+        return render_site(site, outdir) + (None,)
+    except Exception as e:
+        return site["name"], 0.0, repr(e)
+
+
+def render_all(sites: list, outdir: str, workers: int) -> dict:
+    """
+    Renders all sites across a pool of worker processes
+    Fonts and icons are loaded once before the pool is forked, so the workers start with warm caches.
+    :return:
+        Dict with the throughput numbers of the run
+    """
+    os.makedirs(outdir, exist_ok=True)
+    for family in sorted({site.get("font_family", draw_forecasts.font_family) for site in sites}):
+        draw_forecasts.configure_site({"font_family": family})
+        draw_forecasts.warm_caches()
+
+    start = time.perf_counter()
+    # Weather data is fetched once per grid cell before the pool is forked, the workers find it in their cache
+    fetch_stats = prefetch_weather(sites)
+    logger.info(
+        f"Fetched weather data for {fetch_stats['fetches']} cells instead of {fetch_stats['requests']} sites "
+        f"({fetch_stats['hit_rate']:.0%} shared, {fetch_stats['api_calls_saved']} API calls saved)"
+    )
+    failed = 0
+    render_times = []
+    context = multiprocessing.get_context("fork")
+    with context.Pool(processes=workers) as pool:
+        for name, seconds, error in pool.imap_unordered(_render_site_safe, [(site, outdir) for site in sites]):
+            if error:
+                failed += 1
+                logger.error(f"Rendering {name} failed: {error}")
+            else:
+                render_times.append(seconds)
+                logger.info(f"Rendered {name} in {seconds:.2f} s")
+    elapsed = time.perf_counter() - start
+
+    stats = {
+        "panels": len(sites),
+        "failed": failed,
+        "workers": workers,
+        "seconds": elapsed,
+        "panels_per_second": len(render_times) / elapsed if elapsed > 0 else 0.0,
+        "mean_render_seconds": sum(render_times) / len(render_times) if render_times else 0.0,
+        "weather_fetches": fetch_stats["fetches"],
+    }
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Renders the dashboards of many sites in one go.")
+    parser.add_argument("sites", help="JSON file with the list of sites, see sites.json.dist")
+    parser.add_argument("--out", default=os.path.join(_HERE, "output"), help="Directory for the PNGs and bitplanes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    stats = render_all(sites=load_sites(args.sites), outdir=args.out, workers=args.workers)
+    logger.info(
+        f"{stats['panels'] - stats['failed']}/{stats['panels']} panels in {stats['seconds']:.2f} s "
+        f"with {stats['workers']} workers: {stats['panels_per_second']:.2f} panels/s, "
+        f"{stats['mean_render_seconds']:.2f} s per panel"
+    )
+
+
+if __name__ == "__main__":
+    main()
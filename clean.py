@@ -1,6 +1,8 @@
 #!/usr/bin/python
 import logging
+import os
 
+import frame_archive
 from src.drivers import epd7in5b_V2
 
 logging.basicConfig(level=logging.DEBUG)
@@ -9,9 +11,15 @@ try:
     logging.info("epd7in5b_V2")
     epd = epd7in5b_V2.EPD()
 
+    # The next weather.py run has to paint the frame again, see weather.forget_fingerprint()
+    fingerprintpath = os.path.join(os.path.dirname(os.path.realpath(__file__)), "cache", "frame-fingerprint")
+    if os.path.exists(fingerprintpath):
+        os.remove(fingerprintpath)
+
     logging.info("init and Clear")
     epd.init()
     epd.Clear()
+    frame_archive.record(*frame_archive.white_frame())
 
     logging.info("Goto Sleep...")
     epd.sleep()
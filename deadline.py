@@ -0,0 +1,108 @@
+import contextlib
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class StageTimeout(TimeoutError):
+    def __init__(self, stage: str, budget: float):
+        super().__init__(f"{stage} did not finish within {budget:.0f} s")
+        self.stage = stage
+        self.budget = budget
+
+
+class Deadline:
+    """
+    Time budget of a run, with a budget per stage
+    Stages passed to run() are executed on a daemon thread and abandoned once their budget or the overall
+    deadline is used up, so a hung request can't stall the run. Stages that must not be abandoned, like a panel
+    refresh, are measured with measure(), run to completion and are only reported as overrun.
+    """
+
+    def __init__(self, total_seconds: float, budgets: dict):
+        self.total_seconds = total_seconds
+        self.budgets = budgets
+        self.start = time.monotonic()
+        # Name, seconds, budget and outcome of every stage
+        self.stages = []
+
+    def remaining(self) -> float:
+        return max(self.total_seconds - (time.monotonic() - self.start), 0)
+
+    def budget(self, name: str) -> float:
+        """Seconds the stage may take, its own budget if the overall deadline leaves that much"""
+        return min(self.budgets.get(name, self.remaining()), self.remaining())
+
+    def _record(self, name: str, seconds: float, budget: float, outcome: str) -> None:
+        self.stages.append({"stage": name, "seconds": seconds, "budget": budget, "outcome": outcome})
+
+    def run(self, name: str, function, *args, **kwargs):
+        """
+        Runs a stage with a timeout
+        :return:
+            Return value of the function
+        :raises StageTimeout:
+            If the stage didn't finish within its budget, it keeps running in the background
+        """
+        budget = self.budget(name)
+        result = {}
+
+        def target():
+            try:
+                result["value"] = function(*args, **kwargs)
+            except BaseException as e:
+                result["error"] = e
+
+        start = time.monotonic()
+        thread = threading.Thread(target=target, name=f"stage-{name}", daemon=True)
+        thread.start()
+        thread.join(budget)
+        seconds = time.monotonic() - start
+        if thread.is_alive():
+            self._record(name, seconds, budget, "overran")
+            raise StageTimeout(name, budget)
+        if "error" in result:
+            self._record(name, seconds, budget, "failed")
+            raise result["error"]
+        self._record(name, seconds, budget, "ok")
+        return result["value"]
+
+    @contextlib.contextmanager
+    def measure(self, name: str):
+        """Measures a stage running on this thread"""
+        budget = self.budget(name)
+        start = time.monotonic()
+        outcome = "failed"
+        try:
+            yield
+            outcome = "ok"
+        finally:
+            seconds = time.monotonic() - start
+            self._record(name, seconds, budget, "overran" if outcome == "ok" and seconds > budget else outcome)
+
+    def degrade(self, name: str, fallback: str) -> None:
+        """Notes the fallback used for a stage"""
+        logger.warning(f"{name}: {fallback}")
+        self._record(name, 0, 0, f"fallback: {fallback}")
+
+    def overrun(self) -> list:
+        """Names of the stages that overran or failed"""
+        return [stage["stage"] for stage in self.stages if stage["outcome"] in ("overran", "failed")]
+
+    def report(self) -> None:
+        for stage in self.stages:
+            if stage["outcome"].startswith("fallback"):
+                continue
+            message = f"{stage['stage']}: {stage['seconds']:.1f} s of {stage['budget']:.0f} s, {stage['outcome']}"
+            if stage["outcome"] == "ok":
+                logger.info(message)
+            else:
+                logger.warning(message)
+        fallbacks = [f"{stage['stage']} ({stage['outcome'][10:]})" for stage in self.stages if stage["outcome"].startswith("fallback")]
+        logger.info(
+            f"Run finished after {time.monotonic() - self.start:.1f} s of {self.total_seconds:.0f} s"
+            + (f", overran: {', '.join(self.overrun())}" if self.overrun() else "")
+            + (f", fallbacks: {', '.join(fallbacks)}" if fallbacks else "")
+        )
@@ -1,9 +1,17 @@
+import functools
+import hashlib
 import io
 import json
 import locale
 import logging
+import math
+import multiprocessing
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from datetime import timedelta
 
 import matplotlib.dates as mdates
 import matplotlib.pyplot as plt
@@ -11,10 +19,14 @@ import matplotlib.ticker as ticker
 import numpy as np
 from PIL import Image
 from PIL import ImageDraw
+from PIL import ImageFont
 from PIL import ImageOps
 
+import epd_image
 import owm_forecasts
-from room_temperature import mqtt_temperature
+import profiling
+import room_temperature
+import tile_cache
 from src.fonts import font
 from src.weather_icons import weather_icons
 from weather_display import WeatherDisplay
@@ -33,47 +45,208 @@ logger.addHandler(stream_handler)
 ## Paths config
 _HERE = os.path.dirname(__file__)
 uidir = os.path.join(_HERE, "src", "ui-icons")
+cachedir = os.path.join(_HERE, "cache")
+tiledir = os.path.join(cachedir, "tiles")
+# Written by forecast_accuracy.py --bias
+biaspath = os.path.join(cachedir, "forecast-bias.json")
+
+# Stage of get_forecast_image() the tiles of a section are drawn in, see profiling.count_tile()
+TILE_STAGES = {"current": "current", "chart": "hourly", "day": "daily"}
+
+# Layers are only kept in memory if False, e.g. while rendering past dates which must not replace the dashboard's
+persist_layers = True
+
+## Executors for rendering the sections in parallel, started with the first parallel render
+_chart_pool = None
+_section_threads = None
 
 ## Read Settings
 with open(os.path.join(_HERE, "config.json"), "r") as configfile:
     config = json.load(configfile)
 
-lat = float(config["lat"])
-lon = float(config["lon"])
-wind_units = config["wind_units"]
-if wind_units == "beaufort":
-    windDispUnit = "bft"
-elif wind_units == "knots":
-    windDispUnit = "kn"
-elif wind_units == "km_hour":
-    windDispUnit = "km/h"
-elif wind_units == "miles_hour":
-    windDispUnit = "mph"
-else:
-    windDispUnit = ""
-temp_units = config["temp_units"]
-if temp_units == "fahrenheit":
-    tempDispUnit = "F"
-elif temp_units == "celsius":
-    tempDispUnit = "°"
-token = config["token"]
-use_owm_icons = bool(config["use_owm_icons"])
-min_max_annotations = bool(config["min_max_annotations"])
-locale.setlocale(locale.LC_TIME, config["locale"])
-font_family = config["font_family"]
-icon_outline = config["icon_outline"]
-weekly_title = config["weekly_title"]
-chart_title = config["chart_title"]
-display_wind_gust = config["display_wind_gust"]
-mqtt_sub = bool(config["mqtt_sub"])
-if mqtt_sub == True:
-    mqtt_host = config["mqtt_host"]
-    mqtt_port = config["mqtt_port"]
-    mqtt_user = config["mqtt_user"]
-    mqtt_pass = config["mqtt_pass"]
-    mqtt_topic = config["mqtt_topic"]
-    mqtt_temp_key = config["mqtt_temp_key"]
-    mqtt_rH_key = config["mqtt_rH_key"]
+
+def apply_settings(settings: dict) -> None:
+    """
+    Applies the given settings to this module and the modules it relies on
+    :param settings:
+        Dict with the same keys as config.json, e.g. the config merged with a site's overrides
+    """
+    global lat, lon, wind_units, windDispUnit, temp_units, tempDispUnit, token, use_owm_icons, min_max_annotations
+    global font_family, icon_outline, weekly_title, chart_title, display_wind_gust, mqtt_sub, render_mode, dither
+    global parallel_render, applied_settings, _tile_cache, sensor_trend_hours, show_forecast_bias, chart_renderer
+    global sensor_timeout
+    global mqtt_host, mqtt_port, mqtt_user, mqtt_pass, mqtt_topic, mqtt_temp_key, mqtt_rH_key
+
+    lat = float(settings["lat"])
+    lon = float(settings["lon"])
+    wind_units = settings["wind_units"]
+    if wind_units == "beaufort":
+        windDispUnit = "bft"
+    elif wind_units == "knots":
+        windDispUnit = "kn"
+    elif wind_units == "km_hour":
+        windDispUnit = "km/h"
+    elif wind_units == "miles_hour":
+        windDispUnit = "mph"
+    else:
+        windDispUnit = ""
+    temp_units = settings["temp_units"]
+    if temp_units == "fahrenheit":
+        tempDispUnit = "F"
+    elif temp_units == "celsius":
+        tempDispUnit = "°"
+    token = settings["token"]
+    use_owm_icons = bool(settings["use_owm_icons"])
+    min_max_annotations = bool(settings["min_max_annotations"])
+    locale.setlocale(locale.LC_TIME, settings["locale"])
+    font_family = settings["font_family"]
+    icon_outline = settings["icon_outline"]
+    weekly_title = settings["weekly_title"]
+    chart_title = settings["chart_title"]
+    display_wind_gust = settings["display_wind_gust"]
+    render_mode = settings.get("render_mode", "rgb")
+    dither = settings.get("dither", "floyd-steinberg")
+    parallel_render = bool(settings.get("parallel_render", False))
+    tile_cache_mb = settings.get("tile_cache_mb", 20)
+    _tile_cache = tile_cache.TileCache(directory=tiledir, max_bytes=int(tile_cache_mb * 2**20)) if tile_cache_mb else None
+    sensor_trend_hours = settings.get("sensor_trend_hours", 24)
+    # Same budget as the sensors stage of weather.py
+    sensor_timeout = settings.get("stage_budget_seconds", {}).get("sensors", 20)
+    show_forecast_bias = bool(settings.get("show_forecast_bias", False))
+    chart_renderer = settings.get("chart_renderer", "matplotlib")
+    mqtt_sub = bool(settings["mqtt_sub"])
+    if mqtt_sub == True:
+        mqtt_host = settings["mqtt_host"]
+        mqtt_port = settings["mqtt_port"]
+        mqtt_user = settings["mqtt_user"]
+        mqtt_pass = settings["mqtt_pass"]
+        mqtt_topic = settings["mqtt_topic"]
+        mqtt_temp_key = settings["mqtt_temp_key"]
+        mqtt_rH_key = settings["mqtt_rH_key"]
+    owm_forecasts.apply_settings(settings)
+    room_temperature.apply_settings(settings)
+    applied_settings = settings
+
+
+def configure_site(site: dict) -> None:
+    """
+    Applies config.json overridden with a site's settings (lat/lon, locale, units, MQTT topic, ...)
+    :param site:
+        Dict with any subset of the config.json keys
+    """
+    apply_settings({**config, **site})
+
+
+apply_settings(config)
+
+
+## Text layer
+# Measurements and rasterized strings are cached, so placing recurring text is a paste operation
+GLYPH_ATLAS_CHARS = "0123456789-+., °%F"
+
+
+@functools.lru_cache(maxsize=None)
+def text_bbox(family: str, style: str, size: int, text: str) -> tuple:
+    """Returns the bounding box of the text relative to its top left origin, like ImageFont.getbbox()"""
+    return font.font(family, style, size).getbbox(text)
+
+
+def _rasterize(family: str, style: str, size: int, text: str, binary: bool) -> tuple:
+    left, top, right, bottom = text_bbox(family, style, size, text)
+    mask = Image.new("L", (max(right - left, 0), max(bottom - top, 0)), 0)
+    ImageDraw.Draw(mask).text((-left, -top), text, font=font.font(family, style, size), fill=255)
+    if binary:
+        mask = mask.point(lambda value: 255 if value >= 128 else 0, "1")
+    return mask, (left, top)
+
+
+@functools.lru_cache(maxsize=512)
+def text_sprite(family: str, style: str, size: int, text: str, binary: bool = False) -> tuple:
+    """
+    Rasterizes the text once
+    :param binary:
+        Threshold the coverage to 1 bit, for exact colours in palette images
+    :return:
+        Tuple of the coverage mask and its offset from the text origin
+    """
+    return _rasterize(family, style, size, text, binary)
+
+
+@functools.lru_cache(maxsize=None)
+def glyph_atlas(family: str, style: str, size: int, binary: bool = False) -> dict:
+    """
+    Rasterizes the digits, signs and unit characters of temperatures and other values once
+    :return:
+        Dict of character to (coverage mask, offset from the pen position, advance)
+    """
+    glyphs = {}
+    for char in GLYPH_ATLAS_CHARS:
+        mask, offset = _rasterize(family, style, size, char, binary)
+        glyphs[char] = (mask, offset, font.font(family, style, size).getlength(char))
+    return glyphs
+
+
+def ink(image: Image, color):
+    """
+    Returns the fill value of a colour for the given image
+    Palette images get the exact palette index, so no quantization is needed afterwards.
+    """
+    if image.mode != "P":
+        return color
+    rgb = (color,) * 3 if isinstance(color, int) else tuple(color[:3])
+    if rgb == (255, 255, 255):
+        return epd_image.WHITE
+    elif rgb == (255, 0, 0):
+        return epd_image.RED
+    return epd_image.BLACK
+
+
+def draw_text(image: Image, xy: tuple, text: str, style: str, size: int, fill) -> None:
+    """
+    Draws the text in the configured font family, pixel identical to ImageDraw.text() with the default anchor
+    Strings made of atlas characters only are composed glyph by glyph, everything else is drawn from its cached sprite.
+    Palette images get text without anti-aliasing in the exact colour.
+    """
+    x, y = (math.floor(value + 0.5) for value in xy)
+    binary = image.mode == "P"
+    fill = ink(image, fill)
+    basic_layout = font.font(font_family, style, size).layout_engine == ImageFont.Layout.BASIC
+    if basic_layout and all(char in GLYPH_ATLAS_CHARS for char in text):
+        glyphs = glyph_atlas(font_family, style, size, binary)
+        pen_x = 0.0
+        for char in text:
+            mask, (left, top), advance = glyphs[char]
+            if mask.width and mask.height:
+                image.paste(fill, (x + math.floor(pen_x + 0.5) + left, y + top), mask)
+            pen_x += advance
+    else:
+        mask, (left, top) = text_sprite(font_family, style, size, text, binary)
+        if mask.width and mask.height:
+            image.paste(fill, (x + left, y + top), mask)
+
+
+def paste_continuous(image: Image, tile: Image, xy: tuple, mask: Image = None) -> None:
+    """
+    Pastes continuous-tone content like weather icons or the chart
+    Into palette images, only the covered region is dithered to the panel's colours.
+    Other images remember the region in image.info["dither_regions"] for to_palette().
+    """
+    box = (xy[0], xy[1], xy[0] + tile.width, xy[1] + tile.height)
+    if image.mode != "P":
+        image.paste(tile, xy, mask)
+        image.info["dither_regions"] = image.info.get("dither_regions", []) + [box]
+        return
+    region = image.crop(box).convert("RGB")
+    region.paste(tile, (0, 0), mask)
+    image.paste(epd_image.dither_to_palette(region), box)
+
+
+def paste_section(image: Image, section: Image, xy: tuple) -> None:
+    # Pastes a separately drawn section, keeping track of its continuous-tone regions
+    image.paste(section, xy)
+    regions = [(left + xy[0], top + xy[1], right + xy[0], bottom + xy[1]) for left, top, right, bottom in section.info.get("dither_regions", [])]
+    if regions:
+        image.info["dither_regions"] = image.info.get("dither_regions", []) + regions
 
 
 def get_image_from_plot(fig: plt) -> Image:
@@ -104,36 +277,220 @@ def outline(image: Image, size: int, color: tuple) -> Image:
 
     return outlined
 
+# Bump whenever the static layers are drawn differently, so that persisted layers get rebuilt
+STATIC_LAYER_VERSION = 1
+# Bump when the drawing of a section changes, so cached tiles are not reused
+TILE_CACHE_VERSION = 1
+_layers = {}
+
+
+@functools.lru_cache(maxsize=None)
+def ui_icon(filename: str, size: int, invert: bool = False) -> Image:
+    # Returns the requested icon from src/ui-icons, loaded only once
+    icon = Image.open(os.path.join(uidir, filename))
+    if invert:
+        icon = ImageOps.invert(icon)
+    return icon.resize((size, size))
+
+
+def _static_layer_key(display: WeatherDisplay) -> str:
+    # Everything the static layers depend on
+    layout = [
+        STATIC_LAYER_VERSION,
+        display.width_px,
+        display.height_px,
+        display.left_section_width,
+        font_family,
+        chart_title,
+        weekly_title,
+        mqtt_sub,
+        render_mode,
+    ]
+    return hashlib.sha1(json.dumps(layout).encode("utf-8")).hexdigest()[:16]
+
+
+def _load_layer(name: str, mode: str, size: tuple) -> Image:
+    # Returns the layer from memory or from its raw bitmap in the cache directory, None if not there yet
+    if name not in _layers:
+        try:
+            with open(os.path.join(cachedir, name), "rb") as layerfile:
+                layer = Image.frombytes(mode, size, layerfile.read())
+        except (OSError, ValueError):
+            return None
+        if mode == "P":
+            layer.putpalette(epd_image.BWR_PALETTE)
+        _layers[name] = layer
+    return _layers[name]
+
+
+def _save_layer(name: str, layer: Image, stale_prefix: str = None) -> None:
+    # Persists the layer as raw bitmap, optionally removing older layers starting with stale_prefix
+    if stale_prefix:
+        for stale in [other for other in _layers if other.startswith(stale_prefix) and other != name]:
+            del _layers[stale]
+    _layers[name] = layer
+    if not persist_layers:
+        return
+    try:
+        os.makedirs(cachedir, exist_ok=True)
+        if stale_prefix:
+            for filename in os.listdir(cachedir):
+                if filename.startswith(stale_prefix) and filename != name:
+                    os.remove(os.path.join(cachedir, filename))
+        tmp_path = os.path.join(cachedir, f"{name}.tmp")
+        with open(tmp_path, "wb") as layerfile:
+            layerfile.write(layer.tobytes())
+        os.replace(tmp_path, os.path.join(cachedir, name))
+    except OSError as e:
+        logger.warning(f"Could not persist layer {name}: {e}")
+
+
+def _tile_settings() -> list:
+    # Settings that change how the sections are drawn
+    return [
+        TILE_CACHE_VERSION,
+        temp_units,
+        tempDispUnit,
+        windDispUnit,
+        display_wind_gust,
+        use_owm_icons,
+        icon_outline,
+        min_max_annotations,
+        chart_renderer,
+        locale.setlocale(locale.LC_TIME),
+    ]
+
+
+def cachedTile(display: WeatherDisplay, section: str, inputs, render) -> Image:
+    """
+    Returns the tile of a section from the tile cache, drawing and caching it if it's not there
+    :param display:
+        WeatherDisplay object with all display parameters
+    :param section:
+        Name of the section
+    :param inputs:
+        Everything the tile is drawn from besides the layout and settings, must be JSON serializable or str()-able
+    :param render:
+        Function drawing the tile
+    :return:
+        Tile, must not be modified in place
+    """
+    if _tile_cache is None:
+        return render()
+    key = _tile_cache.key(section, _static_layer_key(display), _tile_settings(), inputs)
+    tile = _tile_cache.get(key)
+    profiling.count_tile(TILE_STAGES.get(section, section), cached=tile is not None)
+    if tile is None:
+        logger.debug(f"Drawing {section} tile {key[:12]}")
+        tile = render()
+        _tile_cache.put(key, tile)
+    return tile
+
+
 def createBaseImage(display: WeatherDisplay) -> Image:
     """
     Creates an RGB Image object with the background and current date
+    With the "palette" render_mode, a palette image in the panel's colours is created instead.
+    The background is kept as raw bitmap per layout and date, so it is only drawn again when the date changes.
     :param display:
         WeatherDisplay object with all display parameters
     :return:
         Background image
     """
-    # Create white image
-    image = Image.new("RGB", (display.width_px, display.height_px), (255, 255, 255))
-    image_draw = ImageDraw.Draw(image)
+    now = owm_forecasts.now()
+    dateString = now.strftime("%d. %B")
+    key = _static_layer_key(display)
+    name = f"background_{key}_{hashlib.sha1(dateString.encode('utf-8')).hexdigest()[:8]}.raw"
+    size = (display.width_px, display.height_px)
+
+    mode = "P" if render_mode == "palette" else "RGB"
+    image = _load_layer(name, mode, size)
+    if image is None:
+        # Create white image
+        if mode == "P":
+            image = epd_image.new_palette_frame(size)
+        else:
+            image = Image.new("RGB", size, (255, 255, 255))
+        image_draw = ImageDraw.Draw(image)
 
-    # Create black rectangle for the current weather section
-    rect_width = int(display.width_px / 4)
-    image_draw.rectangle((0, 0, rect_width, display.height_px), fill=0)
+        # Create black rectangle for the current weather section
+        rect_width = int(display.width_px / 4)
+        image_draw.rectangle((0, 0, rect_width, display.height_px), fill=ink(image, 0))
+
+        # Add text with current date
+        # Get the width of the text
+        dateStringbbox = text_bbox(font_family, "Bold", 20, dateString)
+        dateW = dateStringbbox[2] - dateStringbbox[0]
+        # Draw the current date centered
+        draw_text(image, ((rect_width - dateW) / 2, 5), dateString, "Bold", 20, fill=(255, 255, 255))
+
+        _save_layer(name, image, stale_prefix=f"background_{key}_")
+
+    return image.copy()
 
-    # Add text with current date
-    now = datetime.now()
-    dateString = now.strftime("%d. %B")
-    dateFont = font.font(font_family, "Bold", 20)
-    # Get the width of the text
-    dateStringbbox = dateFont.getbbox(dateString)
-    dateW = dateStringbbox[2] - dateStringbbox[0]
-    # Draw the current date centered
-    image_draw.text(((rect_width - dateW) / 2, 5), dateString, font=dateFont, fill=(255, 255, 255))
 
+def createStaticOverlay(display: WeatherDisplay) -> Image:
+    """
+    Creates a transparent RGBA layer with the section icons and titles, which only depend on layout and config
+    The layer is kept as raw bitmap, so it is drawn once per layout and config.
+    :param display:
+        WeatherDisplay object with all display parameters
+    :return:
+        Overlay image
+    """
+    name = f"overlay_{_static_layer_key(display)}.raw"
+    size = (display.width_px, display.height_px)
+
+    overlay = _load_layer(name, "RGBA", size)
+    if overlay is None:
+        overlay = Image.new("RGBA", size, (0, 0, 0, 0))
+
+        ## Current weather section
+        overlay.paste(ui_icon("rain-chance.bmp", 40).convert("RGBA"), (15, int(display.height_px * 0.625)))
+        overlay.paste(ui_icon("wind.bmp", 40).convert("RGBA"), (15, int(display.height_px * 0.719)))
+
+        ## User section
+        if mqtt_sub == True:
+            overlay.paste(ui_icon("home_temp.png", 40, invert=True).convert("RGBA"), (15, int(display.height_px * 0.8125)))
+            overlay.paste(ui_icon("humidity.bmp", 40).convert("RGBA"), (15, int(display.height_px * 0.90625)))
+        else:
+            overlay.paste(ui_icon("humidity.bmp", 40).convert("RGBA"), (15, int(display.height_px * 0.8125)))
+            overlay.paste(ui_icon("uv.bmp", 40).convert("RGBA"), (15, int(display.height_px * 0.90625)))
+
+        ## Section titles
+        draw_text(overlay, (display.left_section_width + 20, 5), chart_title, "ExtraBold", 20, fill=(0, 0, 0, 255))
+        draw_text(overlay, (display.left_section_width + 20, int(display.height_px / 2)), weekly_title, "Bold", 20, fill=(0, 0, 0, 255))
+
+        _save_layer(name, overlay)
+
+    return overlay
+
+
+def addStaticOverlay(display: WeatherDisplay, image: Image) -> Image:
+    """
+    Adds the section icons and titles on top of the given image
+    :param display:
+        WeatherDisplay object with all display parameters
+    :param image:
+        Image object with all sections drawn
+    :return:
+        Icons and titles added to image
+    """
+    overlay = createStaticOverlay(display=display)
+    if image.mode == "P":
+        # Icons and titles are black and white already, so they get the nearest colour and a 1-bit mask
+        name = f"overlay_{_static_layer_key(display)}.p"
+        if name not in _layers:
+            mask = overlay.getchannel("A").point(lambda value: 255 if value >= 128 else 0, "1")
+            _layers[name] = (epd_image.dither_to_palette(overlay, dither=False), mask)
+        overlay, mask = _layers[name]
+        image.paste(overlay, (0, 0), mask)
+    else:
+        image.paste(overlay, (0, 0), overlay)
     return image
 
 
-def addCurrentWeather(display: WeatherDisplay, image: Image, current_weather, hourly_forecasts) -> Image:
+def addCurrentWeather(display: WeatherDisplay, image: Image, current_weather, hourly_forecasts, sensor_readings=None) -> Image:
     """
     Adds current weather situation to the left of the image
     :param display:
@@ -144,6 +501,8 @@ def addCurrentWeather(display: WeatherDisplay, image: Image, current_weather, ho
         Dict of current weather
     :param hourly_forecasts:
         List of hourly weather forecasts
+    :param sensor_readings:
+        Tuple of indoor temperature and rel. humidity, read from MQTT if not given
     :return:
         Current weather added to image
     """
@@ -156,14 +515,14 @@ def addCurrentWeather(display: WeatherDisplay, image: Image, current_weather, ho
     maxW = 0
     totalH = 0
     for word in sumString.split("\n "):
-        sumStringbbox = sumFont.getbbox(word)
+        sumStringbbox = text_bbox(font_family, "Regular", 28, word)
         sumW = sumStringbbox[2] - sumStringbbox[0]
         sumH = sumStringbbox[3] - sumStringbbox[1]
         maxW = max(maxW, sumW)
         totalH += sumH
     sumtext_x = int((display.left_section_width - maxW) / 2)
     sumtext_y = int(display.height_px * 0.19) - totalH
-    image_draw.multiline_text((sumtext_x, sumtext_y), sumString, font=sumFont, fill=(255, 255, 255), align="center")
+    image_draw.multiline_text((sumtext_x, sumtext_y), sumString, font=sumFont, fill=ink(image, (255, 255, 255)), align="center")
 
     ## Add current weather icon to the image
     icon = weather_icons.get_weather_icon(
@@ -177,36 +536,28 @@ def addCurrentWeather(display: WeatherDisplay, image: Image, current_weather, ho
     # Paste the foreground of the icon onto the background with the help of the mask
     icon_x = int((display.left_section_width - icon.width) / 2)
     icon_y = int(display.height_px * 0.2)
-    image.paste(icon, (icon_x, icon_y), mask)
+    paste_continuous(image, icon, (icon_x, icon_y), mask)
 
     ## Add current temperature to the image
     tempString = f"{current_weather.temperature(temp_units)['feels_like']:.0f}{tempDispUnit}"
-    tempFont = font.font(font_family, "Bold", 68)
     # Get the width of the text
-    tempStringbbox = tempFont.getbbox(tempString)
+    tempStringbbox = text_bbox(font_family, "Bold", 68, tempString)
     tempW = tempStringbbox[2] - tempStringbbox[0]
     temp_x = int((display.left_section_width - tempW) / 2)
     temp_y = int(display.height_px * 0.4375)
     # Draw the current temp centered
-    image_draw.text((temp_x, temp_y), tempString, font=tempFont, fill=(255, 255, 255))
+    draw_text(image, (temp_x, temp_y), tempString, "Bold", 68, fill=(255, 255, 255))
 
-    # Add icon for rain forecast
-    rainIcon = Image.open(os.path.join(uidir, "rain-chance.bmp"))
-    rainIcon = rainIcon.resize((40, 40))
+    # Icon for rain forecast is part of the static overlay
     rain_y = int(display.height_px * 0.625)
-    image.paste(rainIcon, (15, rain_y))
 
     # Amount of precipitation within next 3h
     rain = hourly_forecasts[0]["precip_3h_mm"]
     precipString = f"{rain:.1g} mm" if rain > 0.0 else "0 mm"
-    precipFont = font.font(font_family, "Bold", 28)
-    image_draw.text((65, rain_y), precipString, font=precipFont, fill=(255, 255, 255))
+    draw_text(image, (65, rain_y), precipString, "Bold", 28, fill=(255, 255, 255))
 
-    # Add icon for wind speed
-    windIcon = Image.open(os.path.join(uidir, "wind.bmp"))
-    windIcon = windIcon.resize((40, 40))
+    # Icon for wind speed is part of the static overlay
     wind_y = int(display.height_px * 0.719)
-    image.paste(windIcon, (15, wind_y))
 
     # Max. wind speed within next 3h
     wind_gust = f"{hourly_forecasts[0]['wind_gust']:.0f}"
@@ -219,34 +570,69 @@ def addCurrentWeather(display: WeatherDisplay, image: Image, current_weather, ho
     else: 
         windString = f"{wind} {windDispUnit}"
 
-    windFont = font.font(font_family, "Bold", 28)
-    image_draw.text((65, wind_y), windString, font=windFont, fill=(255, 255, 255))
+    draw_text(image, (65, wind_y), windString, "Bold", 28, fill=(255, 255, 255))
 
-    image = addUserSection(display=display, image=image, current_weather=current_weather)
+    image = addUserSection(display=display, image=image, current_weather=current_weather, sensor_readings=sensor_readings)
 
     return image
 
 
-def addHourlyForecast(display: WeatherDisplay, image: Image, hourly_forecasts: list) -> Image:
+def renderCurrentWeather(display: WeatherDisplay, image: Image, current_weather, hourly_forecasts, sensor_readings=None) -> Image:
     """
-    Adds a plot for temperature and amount of rain for the upcoming hours
+    Draws the current weather section on its own copy of the left section of the image
     :param display:
         WeatherDisplay object with all display parameters
     :param image:
-        Image object to add the forecast to
+        Base image with the background of the section
+    :return:
+        Left section of the image with the current weather
+    """
+    if mqtt_sub and sensor_readings is None:
+        sensor_readings = read_sensor_readings()
+    temperature = current_weather.temperature(temp_units)
+    forecast = hourly_forecasts[0]
+    inputs = [
+        owm_forecasts.now().strftime("%d. %B"),
+        current_weather.detailed_status,
+        current_weather.weather_icon_name,
+        temperature["feels_like"],
+        current_weather.humidity,
+        current_weather.uvi,
+        [forecast["precip_3h_mm"], forecast["wind"], forecast["wind_gust"]],
+        sensor_readings,
+        indoorTrend() if mqtt_sub else None,
+    ]
+
+    def render():
+        section = image.crop((0, 0, display.left_section_width, display.height_px))
+        return addCurrentWeather(
+            display=display,
+            image=section,
+            current_weather=current_weather,
+            hourly_forecasts=hourly_forecasts,
+            sensor_readings=sensor_readings,
+        )
+
+    return cachedTile(display, "current", inputs, render)
+
+
+def _chart_inputs(hourly_forecasts: list) -> list:
+    # The part of the forecast shown in the chart
+    return [[f["datetime"], f["temp"], f["precip_3h_mm"]] for f in hourly_forecasts[:22]]
+
+
+def renderHourlyChart(display: WeatherDisplay, hourly_forecasts: list) -> Image:
+    """
+    Plots temperature and amount of rain for the upcoming hours
+    :param display:
+        WeatherDisplay object with all display parameters
     :param hourly_forecasts:
         List of hourly weather forecasts
     :return:
-        Weather plot added to image
+        Image of the plot
     """
-    ## Create drawing object for image
-    image_draw = ImageDraw.Draw(image)
-
-    ## Draw hourly chart title
-    title_x = display.left_section_width + 20  # X-coordinate of the title
-    title_y = 5
-    chartTitleFont = font.font(font_family, "ExtraBold", 20)
-    image_draw.text((title_x, title_y), chart_title, font=chartTitleFont, fill=0)
+    if chart_renderer == "pil":
+        return renderSimpleChart(display=display, hourly_forecasts=hourly_forecasts)
 
     ## Plot the data
     # Define the chart parameters
@@ -310,33 +696,218 @@ def addHourlyForecast(display: WeatherDisplay, image: Image, hourly_forecasts: l
     fig.gca().xaxis.set_minor_locator(mdates.HourLocator(interval=3))
     fig.tight_layout()  # Adjust layout to prevent clipping of labels
 
-    # Get image from plot and add it to the image
+    # Get image from plot
     hourly_forecast_plot = get_image_from_plot(plt)
-    plot_x = display.left_section_width + 5
-    plot_y = title_y + 30
-    image.paste(hourly_forecast_plot, (plot_x, plot_y))
-    return image
+    hourly_forecast_plot.load()
+    plt.close(fig)
+    return hourly_forecast_plot
 
 
-def addDailyForecast(display: WeatherDisplay, image: Image, hourly_forecasts) -> Image:
+def renderSimpleChart(display: WeatherDisplay, hourly_forecasts: list) -> Image:
     """
-    Adds daily weather forecasts to the given image
+    Draws the chart of renderHourlyChart() with PIL instead of matplotlib, a cheaper variant without min/max annotations
+    :param display:
+        WeatherDisplay object with all display parameters
+    :param hourly_forecasts:
+        List of hourly weather forecasts
+    :return:
+        Image of the chart
+    """
+    w, h = int(0.75 * display.width_px), int(0.45 * display.height_px)
+    forecasts = hourly_forecasts[:22]
+    temperatures = [item["temp"] for item in forecasts]
+    chart = Image.new("RGB", (w, h), (255, 255, 255))
+    chart_draw = ImageDraw.Draw(chart)
+
+    ## Plot area and axes, temperatures in steps like the matplotlib chart, precipitation from 0 to 10 mm
+    left, top, right, bottom = 50, 24, w - 40, h - 46
+    temp_base = 3 if temp_units == "celsius" else 5
+    temp_low = math.floor(min(temperatures) / temp_base) * temp_base
+    temp_high = max(math.ceil(max(temperatures) / temp_base) * temp_base, temp_low + temp_base)
+    step_x = (right - left) / len(forecasts)
+    start = forecasts[0]["datetime"]
+
+    def x_of(time: datetime) -> float:
+        return left + step_x * (0.5 + (time - start).total_seconds() / (3 * 3600))
+
+    def y_of(value: float, low: float, high: float) -> float:
+        return bottom - (value - low) / (high - low) * (bottom - top)
+
+    for value in range(temp_low, temp_high + 1, temp_base):
+        y = y_of(value, temp_low, temp_high)
+        chart_draw.line((left, y, right, y), fill=(176, 176, 176))
+        label = f"{value}{tempDispUnit}"
+        draw_text(chart, (left - 6 - text_bbox(font_family, "Regular", 14, label)[2], y - 10), label, "Regular", 14, fill=(255, 0, 0))
+    for value in (0, 2.5, 5, 7.5, 10):
+        draw_text(chart, (right + 6, y_of(value, 0, 10) - 10), f"{value:.0f}", "Regular", 14, fill=(0, 0, 255))
+
+    ## Days start at midnight
+    midnight = (start + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    while x_of(midnight) < right:
+        x = x_of(midnight)
+        chart_draw.line((x, top, x, bottom), fill=(176, 176, 176))
+        label = midnight.strftime("%a")
+        draw_text(chart, (x - text_bbox(font_family, "Regular", 14, label)[2] / 2, bottom + 4), label, "Regular", 14, fill=(0, 0, 0))
+        midnight += timedelta(days=1)
+
+    ## Precipitation as bars, temperature as line on top
+    for index, item in enumerate(forecasts):
+        if item["precip_3h_mm"] > 0:
+            x = left + step_x * index
+            chart_draw.rectangle((x, y_of(min(item["precip_3h_mm"], 10), 0, 10), x + step_x - 1, bottom), fill=(204, 204, 255))
+    points = [(x_of(item["datetime"]), y_of(item["temp"], temp_low, temp_high)) for item in forecasts]
+    chart_draw.line(points, fill=(255, 0, 0), width=2)
+    for x, y in points:
+        chart_draw.ellipse((x - 2, y - 2, x + 2, y + 2), fill=(255, 0, 0))
+    chart_draw.rectangle((left, top, right, bottom), outline=(0, 0, 0))
+    return chart
+
+
+def addHourlyForecast(display: WeatherDisplay, image: Image, hourly_forecasts: list, hourly_forecast_plot: Image = None) -> Image:
+    """
+    Adds a plot for temperature and amount of rain for the upcoming hours
     :param display:
         WeatherDisplay object with all display parameters
     :param image:
         Image object to add the forecast to
     :param hourly_forecasts:
         List of hourly weather forecasts
+    :param hourly_forecast_plot:
+        Plot from renderHourlyChart(), plotted now if not given
     :return:
-        Daily forecasts added to image
+        Weather plot added to image
     """
-    ## Create drawing object for image
-    image_draw = ImageDraw.Draw(image)
+    ## Hourly chart title is part of the static overlay
+    title_y = 5
+
+    if hourly_forecast_plot is None:
+        hourly_forecast_plot = cachedTile(
+            display,
+            "chart",
+            _chart_inputs(hourly_forecasts),
+            lambda: renderHourlyChart(display=display, hourly_forecasts=hourly_forecasts),
+        )
+    plot_x = display.left_section_width + 5
+    plot_y = title_y + 30
+    paste_continuous(image, hourly_forecast_plot, (plot_x, plot_y))
+
+    ## Bias of the recent forecasts, right of the title
+    bias = forecast_bias()
+    if bias is not None:
+        biasString = f"Bias {bias:+.1f}{tempDispUnit}"
+        biasStringbbox = text_bbox(font_family, "Bold", 16, biasString)
+        draw_text(image, (display.width_px - 15 - biasStringbbox[2], title_y + 4), biasString, "Bold", 16, fill=(0, 0, 0))
+    return image
+
 
-    ## Draw daily chart title
-    title_y = int(display.height_px / 2)  # Y-coordinate of the title
-    chartTitleFont = font.font(font_family, "Bold", 20)
-    image_draw.text((display.left_section_width + 20, title_y), weekly_title, font=chartTitleFont, fill=0)
+def forecast_bias():
+    """
+    Returns the mean temperature error of the forecasts for the next day in the displayed unit, as computed by
+    forecast_accuracy.py --bias, None if it isn't shown or there is none
+    """
+    if not show_forecast_bias or not os.path.exists(biaspath):
+        return None
+    try:
+        with open(biaspath, "r") as biasfile:
+            temp_bias = json.load(biasfile).get("temp_bias_k")
+    except (OSError, ValueError) as e:
+        logger.warning(f"Could not read the forecast bias: {e!r}")
+        return None
+    if temp_bias is None:
+        return None
+    return round(temp_bias * (1.8 if temp_units == "fahrenheit" else 1), 1)
+
+
+def renderDayTile(day_data: dict, size: tuple, mode: str) -> Image:
+    """
+    Draws the forecast of one day
+    :param day_data:
+        Dict of the day from owm_forecasts.get_forecast_for_day()
+    :param size:
+        Width and height of the tile
+    :param mode:
+        Mode of the image the tile is pasted into
+    :return:
+        Tile of the day
+    """
+    rectangle_width, rectangle_height = size
+    if mode == "P":
+        rect = epd_image.new_palette_frame(size)
+    else:
+        rect = Image.new("RGBA", size, (255, 255, 255))
+
+    # Rain icon is static
+    weeklyRainIcon = ui_icon("rain-chance.bmp", 20, invert=True)
+
+    # Date string: Day of week on line 1, date on line 2
+    short_day_name = datetime.fromtimestamp(day_data["datetime"]).strftime("%a")
+    short_month_day = datetime.fromtimestamp(day_data["datetime"]).strftime("%b %d")
+    short_day_name_text = text_bbox(font_family, "ExtraBold", 24, short_day_name)
+    short_month_day_text = text_bbox(font_family, "Bold", 16, short_month_day)
+    day_name_x = (rectangle_width - short_day_name_text[2] + short_day_name_text[0]) / 2
+    short_month_day_x = (rectangle_width - short_month_day_text[2] + short_month_day_text[0]) / 2
+    draw_text(rect, (day_name_x, 0), short_day_name, "ExtraBold", 24, fill=0)
+    draw_text(rect, (short_month_day_x, 30), short_month_day, "Bold", 16, fill=0)
+
+    ## Min and max temperature split into diagonal placement
+    min_temp = day_data["temp_min"]
+    max_temp = day_data["temp_max"]
+    temp_text_min = f"{min_temp:.0f}{tempDispUnit}"
+    temp_text_max = f"{max_temp:.0f}{tempDispUnit}"
+    temp_x_offset = 20
+    # this is upper left: max temperature
+    temp_text_max_x = temp_x_offset
+    temp_text_max_y = int(rectangle_height * 0.25)
+    # this is lower right: min temperature
+    temp_text_min_bbox = text_bbox(font_family, "ExtraBold", 24, temp_text_min)
+    temp_text_min_x = int((rectangle_width - temp_text_min_bbox[2] + temp_text_min_bbox[0]) / 2) + temp_x_offset + 7
+    temp_text_min_y = int(rectangle_height * 0.33)
+    draw_text(rect, (temp_text_min_x, temp_text_min_y), temp_text_min, "ExtraBold", 24, fill=0)
+    draw_text(rect, (temp_text_max_x, temp_text_max_y), temp_text_max, "ExtraBold", 24, fill=0)
+
+    # Weather icon for the day
+    icon_code = day_data["icon"]
+    icon = weather_icons.get_weather_icon(icon_name=icon_code, size=90, use_owm_icons=use_owm_icons)
+    if icon_outline:
+        icon = outline(image=icon, size=8, color=(0,0,0,255))
+    icon_x = int((rectangle_width - icon.width) / 2)
+    icon_y = int(rectangle_height * 0.4)
+    # Create a mask from the alpha channel of the weather icon
+    if len(icon.split()) == 4:
+        mask = icon.split()[-1]
+    else:
+        mask = None
+    # Paste the foreground of the icon onto the background with the help of the mask
+    paste_continuous(rect, icon, (int(icon_x), icon_y), mask)
+
+    ## Precipitation icon and text
+    rain = day_data["precip_mm"]
+    if rain:
+        rain_text = f"{rain:.0f} mm"
+        # Icon
+        rain_icon_x = int((rectangle_width - icon.width) / 2)
+        rain_icon_y = int(rectangle_height * 0.82)
+        paste_continuous(rect, weeklyRainIcon, (rain_icon_x, rain_icon_y))
+        # Text
+        rain_text_y = int(rectangle_height * 0.8)
+        draw_text(rect, (rain_icon_x + weeklyRainIcon.width + 10, rain_text_y), rain_text, "ExtraBold", 20, fill=0)
+
+    return rect
+
+
+def renderDailyForecast(display: WeatherDisplay, hourly_forecasts, mode: str) -> list:
+    """
+    Draws the daily weather forecasts, one tile per day
+    :param display:
+        WeatherDisplay object with all display parameters
+    :param hourly_forecasts:
+        List of hourly weather forecasts
+    :param mode:
+        Mode of the image the tiles are pasted into
+    :return:
+        List of tiles and their positions
+    """
+    ## Daily chart title is part of the static overlay
 
     # Define the parameters
     number_of_forecast_days = 5  # including today
@@ -345,95 +916,156 @@ def addDailyForecast(display: WeatherDisplay, image: Image, hourly_forecasts) ->
     # Maximum height for each rectangle (avoid overlapping with title)
     rectangle_height = int(display.height_px / 2 - 20)
 
-    # Rain icon is static
-    rainIcon = Image.open(os.path.join(uidir, "rain-chance.bmp"))
-    rainIcon.convert("L")
-    rainIcon = ImageOps.invert(rainIcon)
-    weeklyRainIcon = rainIcon.resize((20, 20))
-
     # Loop through the upcoming days' data and create rectangles
+    tiles = []
     for i in range(number_of_forecast_days):
         x_rect = display.left_section_width + 20 + i * rectangle_width  # Start from the title width
         y_rect = int(display.height_px / 2 + 30)
 
         day_data = owm_forecasts.get_forecast_for_day(days_from_today=i, hourly_forecasts=hourly_forecasts)
-        rect = Image.new("RGBA", (int(rectangle_width), int(rectangle_height)), (255, 255, 255))
-        rect_draw = ImageDraw.Draw(rect)
-
-        # Date string: Day of week on line 1, date on line 2
-        short_day_font = font.font(font_family, "ExtraBold", 24)
-        short_month_day_font = font.font(font_family, "Bold", 16)
-        short_day_name = datetime.fromtimestamp(day_data["datetime"]).strftime("%a")
-        short_month_day = datetime.fromtimestamp(day_data["datetime"]).strftime("%b %d")
-        short_day_name_text = rect_draw.textbbox((0, 0), short_day_name, font=short_day_font)
-        short_month_day_text = rect_draw.textbbox((0, 0), short_month_day, font=short_month_day_font)
-        day_name_x = (rectangle_width - short_day_name_text[2] + short_day_name_text[0]) / 2
-        short_month_day_x = (rectangle_width - short_month_day_text[2] + short_month_day_text[0]) / 2
-        rect_draw.text((day_name_x, 0), short_day_name, fill=0, font=short_day_font)
-        rect_draw.text(
-            (short_month_day_x, 30),
-            short_month_day,
-            fill=0,
-            font=short_month_day_font,
+        size = (int(rectangle_width), int(rectangle_height))
+        rect = cachedTile(
+            display, "day", [day_data, size], lambda: renderDayTile(day_data=day_data, size=size, mode=mode)
         )
+        tiles.append((rect, (int(x_rect), int(y_rect))))
 
-        ## Min and max temperature split into diagonal placement
-        min_temp = day_data["temp_min"]
-        max_temp = day_data["temp_max"]
-        temp_text_min = f"{min_temp:.0f}{tempDispUnit}"
-        temp_text_max = f"{max_temp:.0f}{tempDispUnit}"
-        rect_temp_font = font.font(font_family, "ExtraBold", 24)
-        temp_x_offset = 20
-        # this is upper left: max temperature
-        temp_text_max_x = temp_x_offset
-        temp_text_max_y = int(rectangle_height * 0.25)
-        # this is lower right: min temperature
-        temp_text_min_bbox = rect_draw.textbbox((0, 0), temp_text_min, font=rect_temp_font)
-        temp_text_min_x = int((rectangle_width - temp_text_min_bbox[2] + temp_text_min_bbox[0]) / 2) + temp_x_offset + 7
-        temp_text_min_y = int(rectangle_height * 0.33)
-        rect_draw.text((temp_text_min_x, temp_text_min_y), temp_text_min, fill=0, font=rect_temp_font)
-        rect_draw.text(
-            (temp_text_max_x, temp_text_max_y),
-            temp_text_max,
-            fill=0,
-            font=rect_temp_font,
-        )
+    return tiles
+
+
+def addDailyForecast(display: WeatherDisplay, image: Image, hourly_forecasts, tiles: list = None) -> Image:
+    """
+    Adds daily weather forecasts to the given image
+    :param display:
+        WeatherDisplay object with all display parameters
+    :param image:
+        Image object to add the forecast to
+    :param hourly_forecasts:
+        List of hourly weather forecasts
+    :param tiles:
+        Tiles from renderDailyForecast(), drawn now if not given
+    :return:
+        Daily forecasts added to image
+    """
+    if tiles is None:
+        tiles = renderDailyForecast(display=display, hourly_forecasts=hourly_forecasts, mode=image.mode)
+    for rect, xy in tiles:
+        paste_section(image, rect, xy)
 
-        # Weather icon for the day
-        icon_code = day_data["icon"]
-        icon = weather_icons.get_weather_icon(icon_name=icon_code, size=90, use_owm_icons=use_owm_icons)
-        if icon_outline:
-            icon = outline(image=icon, size=8, color=(0,0,0,255))
-        icon_x = int((rectangle_width - icon.width) / 2)
-        icon_y = int(rectangle_height * 0.4)
-        # Create a mask from the alpha channel of the weather icon
-        if len(icon.split()) == 4:
-            mask = icon.split()[-1]
-        else:
-            mask = None
-        # Paste the foreground of the icon onto the background with the help of the mask
-        rect.paste(icon, (int(icon_x), icon_y), mask)
-
-        ## Precipitation icon and text
-        rain = day_data["precip_mm"]
-        if rain:
-            rain_text = f"{rain:.0f} mm"
-            rain_font = font.font(font_family, "ExtraBold", 20)
-            # Icon
-            rain_icon_x = int((rectangle_width - icon.width) / 2)
-            rain_icon_y = int(rectangle_height * 0.82)
-            rect.paste(weeklyRainIcon, (rain_icon_x, rain_icon_y))
-            # Text
-            rain_text_y = int(rectangle_height * 0.8)
-            rect_draw.text(
-                (rain_icon_x + weeklyRainIcon.width + 10, rain_text_y), rain_text, fill=0, font=rain_font, align="right"
-            )
-
-        image.paste(rect, (int(x_rect), int(y_rect)))
-        
     return image
 
-def addUserSection(display:WeatherDisplay, image: Image, current_weather) -> Image:
+def get_sensor_readings(my_home=None, timeout: float = None) -> tuple:
+    """
+    Waits for the indoor temperature and rel. humidity from MQTT
+    :param my_home:
+        Connected mqtt_temperature client, a new one is connected if not given
+    :param timeout:
+        Seconds to wait for the sensor, forever if not given
+    :return:
+        Tuple of temperature and rel. humidity
+    :raises TimeoutError:
+        If the sensor didn't report within the timeout
+    """
+    start = time.monotonic()
+    if my_home is None:
+        my_home = room_temperature.get_sensor_client(topic=mqtt_topic, temp_key=mqtt_temp_key, rH_key=mqtt_rH_key)
+    homeTemp = my_home.get_temperature(mqtt_topic)
+    rH = my_home.get_rH(mqtt_topic)
+    while homeTemp is None or rH is None:
+        if timeout is not None and time.monotonic() - start > timeout:
+            raise TimeoutError(f"No reading on {mqtt_topic} within {timeout:.0f} s")
+        time.sleep(0.05)
+        homeTemp = my_home.get_temperature(mqtt_topic)
+        rH = my_home.get_rH(mqtt_topic)
+    return homeTemp, rH
+
+
+def read_sensor_readings(my_home=None) -> tuple:
+    """
+    Waits for the indoor sensor up to sensor_timeout seconds, e.g. while rendering without a deadline of its own
+    :param my_home:
+        Connected mqtt_temperature client, a new one is connected if not given
+    :return:
+        Tuple of temperature and rel. humidity, the last recorded ones marked stale if the sensor is silent
+    :raises TimeoutError:
+        If the sensor is silent and nothing was recorded
+    """
+    try:
+        return get_sensor_readings(my_home, timeout=sensor_timeout)
+    except TimeoutError as e:
+        sensor_readings = get_stale_sensor_readings()
+        if sensor_readings is None:
+            raise
+        logger.warning(f"{e}, using the last recorded values")
+        return sensor_readings
+
+
+def get_stale_sensor_readings():
+    """
+    Returns the last indoor temperature and rel. humidity recorded in the sensor history, for when the sensor is silent
+    :return:
+        Tuple of temperature, rel. humidity and True (stale), None if nothing was ever recorded
+    """
+    reading = room_temperature.last_reading(mqtt_topic)
+    if reading is None:
+        return None
+    logger.warning(f"Showing the indoor values of {datetime.fromtimestamp(reading[0]):%d.%m. %H:%M} as stale")
+    return reading[1], reading[2], True
+
+
+def indoorTrend() -> list:
+    """
+    Returns the aggregated indoor temperature of the last sensor_trend_hours from the sensor history
+    :return:
+        List of bucket start, mean, min and max temperature, oldest first
+    """
+    if not sensor_trend_hours:
+        return []
+    trend = room_temperature.get_history(room_temperature.sensor_topic(mqtt_topic)).aggregates(since=datetime.now().timestamp() - sensor_trend_hours * 3600)
+    return [
+        [float(start), round(float(mean), 2), float(low), float(high)]
+        for start, mean, low, high in zip(trend["start"], trend["temp_mean"], trend["temp_min"], trend["temp_max"])
+    ]
+
+
+def sparklineBox(display: WeatherDisplay, homeTempString: str) -> tuple:
+    # Room right of the home temperature, None if it's too narrow for a trend
+    homeTemp_y = int(display.height_px * 0.8125)
+    homeTempbbox = text_bbox(font_family, "Bold", 28, homeTempString)
+    box = (65 + homeTempbbox[2] + 10, homeTemp_y + homeTempbbox[1], display.left_section_width - 10, homeTemp_y + homeTempbbox[3])
+    return box if box[2] - box[0] >= 20 else None
+
+
+def sparklinePoints(box: tuple, trend: list, span: float) -> list:
+    """
+    Returns the points of the line through the mean temperatures of the trend
+    :param box:
+        Left, top, right and bottom of the line
+    :param trend:
+        Buckets as returned by indoorTrend()
+    :param span:
+        Seconds covered by the width of the box, the latest bucket is at the right
+    """
+    if len(trend) < 2:
+        return []
+    left, top, right, bottom = box
+    end = trend[-1][0]
+    low = min(bucket[2] for bucket in trend)
+    high = max(bucket[3] for bucket in trend)
+    scale = (bottom - top) / (high - low) if high > low else 0
+    return [
+        (right - (end - start) / span * (right - left), bottom - (mean - low) * scale if scale else (top + bottom) / 2)
+        for start, mean, _, _ in trend
+    ]
+
+
+def drawSparkline(image: Image, box: tuple, trend: list, span: float, fill) -> None:
+    """Draws the mean temperatures of the trend as line into the box, see sparklinePoints()"""
+    points = sparklinePoints(box, trend, span)
+    if points:
+        ImageDraw.Draw(image).line(points, fill=ink(image, fill), width=2, joint="curve")
+
+
+def addUserSection(display:WeatherDisplay, image: Image, current_weather, sensor_readings=None) -> Image:
     """
     Adds user-defined section to the given image
     :param display:
@@ -442,84 +1074,276 @@ def addUserSection(display:WeatherDisplay, image: Image, current_weather) -> Ima
         Image object to add the forecast to
     :param current_weather:
         Dict of current weather
+    :param sensor_readings:
+        Tuple of indoor temperature and rel. humidity, read from MQTT if not given. Stale readings have True as third item
+        and are drawn in red.
     :return:
         User section added to image
     """
-    ## Create drawing object for image
-    image_draw = ImageDraw.Draw(image)
-
     if mqtt_sub == True:
-        # Add icon for Home
-        homeTempIcon = Image.open(os.path.join(uidir, "home_temp.png"))
-        homeTempIcon = ImageOps.invert(homeTempIcon)
-        homeTempIcon = homeTempIcon.resize((40, 40))
+        if sensor_readings is None:
+            sensor_readings = read_sensor_readings()
+        homeTemp, rH = sensor_readings[:2]
+        sensor_fill = (255, 0, 0) if len(sensor_readings) > 2 and sensor_readings[2] else (255, 255, 255)
+
+        # Icon for Home is part of the static overlay
         homeTemp_y = int(display.height_px * 0.8125)
-        image.paste(homeTempIcon, (15, homeTemp_y))
 
         # Home temperature
-        my_home = mqtt_temperature(host=mqtt_host, port=mqtt_port, user=mqtt_user, password=mqtt_pass, topic=mqtt_topic)
-        homeTemp = None
-        while homeTemp == None:
-            homeTemp = my_home.get_temperature()
         homeTempString = f"{homeTemp:.1f} {tempDispUnit}"
-        homeTempFont = font.font(font_family, "Bold", 28)
-        image_draw.text((65, homeTemp_y), homeTempString, font=homeTempFont, fill=(255, 255, 255))
+        draw_text(image, (65, homeTemp_y), homeTempString, "Bold", 28, fill=sensor_fill)
+
+        # Trend of the home temperature next to it, if there's room
+        sparkline_box = sparklineBox(display, homeTempString)
+        if sparkline_box is not None:
+            drawSparkline(image, sparkline_box, indoorTrend(), span=sensor_trend_hours * 3600, fill=(255, 255, 255))
 
-        # Add icon for rH
-        humidityIcon = Image.open(os.path.join(uidir, "humidity.bmp"))
-        humidityIcon = humidityIcon.resize((40, 40))
+        # Icon for rH is part of the static overlay
         humidity_y = int(display.height_px * 0.90625)
-        image.paste(humidityIcon, (15, humidity_y))
 
         # rel. humidity
-        rH = None
-        while rH == None:
-            rH = my_home.get_rH()
         humidityString = f"{rH:.0f} %"
-        humidityFont = font.font(font_family, "Bold", 28)
-        image_draw.text((65, humidity_y), humidityString, font=humidityFont, fill=(255, 255, 255))
+        draw_text(image, (65, humidity_y), humidityString, "Bold", 28, fill=sensor_fill)
     else:
-         # Add icon for Humidity
-        humidityIcon = Image.open(os.path.join(uidir, "humidity.bmp"))
-        humidityIcon = humidityIcon.resize((40, 40))
+        # Icon for Humidity is part of the static overlay
         humidity_y = int(display.height_px * 0.8125)
-        image.paste(humidityIcon, (15, humidity_y))
 
         # Humidity
         humidityString = f"{current_weather.humidity} %"
-        humidityFont = font.font(font_family, "Bold", 28)
-        image_draw.text((65, humidity_y), humidityString, font=humidityFont, fill=(255, 255, 255))
+        draw_text(image, (65, humidity_y), humidityString, "Bold", 28, fill=(255, 255, 255))
 
-        # Add icon for uv
-        uvIcon = Image.open(os.path.join(uidir, "uv.bmp"))
-        uvIcon = uvIcon.resize((40, 40))
+        # Icon for uv is part of the static overlay
         ux_y = int(display.height_px * 0.90625)
-        image.paste(uvIcon, (15, ux_y))
 
         # uvindex
         uvString = f"{current_weather.uvi if current_weather.uvi else '0'}"
-        uvFont = font.font(font_family, "Bold", 28)
-        image_draw.text((65, ux_y), uvString, font=uvFont, fill=(255, 255, 255))
+        draw_text(image, (65, ux_y), uvString, "Bold", 28, fill=(255, 255, 255))
     
     return image
 
-def get_forecast_image(display: WeatherDisplay) -> Image:
+def get_displayed_values(current_weather, hourly_forecasts, sensor_readings=None) -> dict:
+    """
+    Collects the values the dashboard shows, rounded like they are displayed
+    :param current_weather:
+        Current weather
+    :param hourly_forecasts:
+        List of hourly weather forecasts
+    :param sensor_readings:
+        Tuple of indoor temperature and rel. humidity, only used with mqtt_sub
+    :return:
+        Dict of value name to str, number or tuple of numbers
+    """
+    days = [owm_forecasts.get_forecast_for_day(days_from_today=i, hourly_forecasts=hourly_forecasts) for i in range(5)]
+    values = {
+        "date": owm_forecasts.now().strftime("%d. %B"),
+        "status": current_weather.detailed_status,
+        "icon": current_weather.weather_icon_name,
+        "temp": round(current_weather.temperature(temp_units)["feels_like"]),
+        "precip": float(f"{hourly_forecasts[0]['precip_3h_mm']:.1g}"),
+        "wind": (round(hourly_forecasts[0]["wind"]), round(hourly_forecasts[0]["wind_gust"] or 0)),
+        "chart_start": hourly_forecasts[0]["datetime"].isoformat(),
+        "chart_temps": tuple(f["temp"] for f in hourly_forecasts[:22]),
+        "chart_precip": tuple(f["precip_3h_mm"] for f in hourly_forecasts[:22]),
+        "day_icons": tuple(day["icon"] for day in days),
+        "day_temps": tuple(round(temp) for day in days for temp in (day["temp_min"], day["temp_max"])),
+        "day_precip": tuple(round(day["precip_mm"]) for day in days),
+        # Days without any rain show no amount at all
+        "day_rain": tuple(bool(day["precip_mm"]) for day in days),
+        "forecast_bias": forecast_bias(),
+    }
+    if mqtt_sub and sensor_readings is not None:
+        values["sensor_temp"] = round(sensor_readings[0], 1)
+        values["sensor_rH"] = round(sensor_readings[1])
+        if len(sensor_readings) > 2 and sensor_readings[2]:
+            values["sensor_stale"] = True
+    else:
+        values["humidity"] = current_weather.humidity
+        values["uvi"] = current_weather.uvi
+    return values
+
+
+def get_fingerprint(display: WeatherDisplay, current_weather, hourly_forecasts, sensor_readings=None) -> str:
+    """
+    Hashes everything get_forecast_image() draws at the precision it's drawn with, so an equal fingerprint means
+    an identical frame and the render can be skipped
+    :param display:
+        WeatherDisplay object with all display parameters
+    :param sensor_readings:
+        Tuple of indoor temperature and rel. humidity, read from MQTT if needed and not given
+    :return:
+        Hex digest
+    """
+    if mqtt_sub and sensor_readings is None:
+        sensor_readings = read_sensor_readings()
+    sparkline = None
+    if mqtt_sub:
+        sparkline_box = sparklineBox(display, f"{sensor_readings[0]:.1f} {tempDispUnit}")
+        if sparkline_box is not None:
+            # Whole pixels, the line moves with every new sample otherwise
+            points = sparklinePoints(sparkline_box, indoorTrend(), span=sensor_trend_hours * 3600)
+            sparkline = [(round(x), round(y)) for x, y in points]
+    return tile_cache.TileCache.key(
+        _static_layer_key(display),
+        applied_settings,
+        get_displayed_values(current_weather, hourly_forecasts, sensor_readings),
+        # The chart plots the exact values
+        _chart_inputs(hourly_forecasts),
+        sparkline,
+    )
+
+
+def warm_caches() -> None:
+    """
+    Loads the fonts, glyph atlases and weather icons used by the layout into their caches, e.g. before forking
+    worker processes so that all of them share the already loaded objects
+    """
+    for style, size in [("Regular", 28), ("Bold", 16), ("Bold", 20), ("Bold", 28), ("Bold", 68), ("ExtraBold", 20), ("ExtraBold", 24)]:
+        font.font(font_family, style, size)
+        glyph_atlas(font_family, style, size)
+
+    weather_icons.load_atlas()
+    if use_owm_icons:
+        icondir = os.path.join(_HERE, "src", "weather_icons", "owm_icons")
+        for icon_file in sorted(os.listdir(icondir)):
+            icon_name = os.path.splitext(icon_file)[0]
+            weather_icons.get_weather_icon(icon_name=icon_name, size=150, use_owm_icons=True, invert=True)
+            weather_icons.get_weather_icon(icon_name=icon_name, size=90, use_owm_icons=True)
+
+
+def get_weather_data() -> tuple:
+    """
+    Fetches the current weather and the hourly forecasts for the configured location
+    :return:
+        Tuple of current weather and list of hourly weather forecasts
+    """
+    return owm_forecasts.get_owm_data(lat=lat, lon=lon, token=token)
+
+
+def _timed(function, *args, **kwargs) -> tuple:
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def _render_chart_job(settings: dict, display: WeatherDisplay, hourly_forecasts: list) -> tuple:
+    # Runs in the chart process, which keeps the settings of the last job (locale, units) until they change
+    if settings != applied_settings:
+        apply_settings(settings)
+    profiling.reset_timings()
+    (plot, seconds) = _timed(
+        cachedTile,
+        display,
+        "chart",
+        _chart_inputs(hourly_forecasts),
+        lambda: renderHourlyChart(display=display, hourly_forecasts=hourly_forecasts),
+    )
+    # The tile counts of this process are reported back with the plot
+    return plot, seconds, profiling.tile_counts()
+
+
+def addSectionsParallel(display: WeatherDisplay, image: Image, current_weather, hourly_forecasts, sensor_readings=None) -> Image:
+    """
+    Renders the current weather, hourly and daily forecast sections concurrently and composites them
+    The matplotlib chart is plotted in a separate process as pyplot is not thread-safe, the PIL sections
+    are drawn on threads into their own layers.
+    :param display:
+        WeatherDisplay object with all display parameters
+    :param image:
+        Base image to add the sections to
+    :return:
+        Sections added to image
+    """
+    global _chart_pool, _section_threads
+    if _chart_pool is None:
+        # The chart process is forked before any section thread exists
+        _chart_pool = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("fork"))
+        _section_threads = ThreadPoolExecutor(max_workers=2, thread_name_prefix="section")
+
+    start = time.perf_counter()
+    chart = _chart_pool.submit(_render_chart_job, applied_settings, display, hourly_forecasts)
+    current = _section_threads.submit(
+        _timed, renderCurrentWeather, display, image, current_weather, hourly_forecasts, sensor_readings
+    )
+    daily = _section_threads.submit(
+        _timed, renderDailyForecast, display=display, hourly_forecasts=hourly_forecasts, mode=image.mode
+    )
+
+    (current_section, current_seconds) = current.result()
+    paste_section(image, current_section, (0, 0))
+    (tiles, daily_seconds) = daily.result()
+    addDailyForecast(display=display, image=image, hourly_forecasts=hourly_forecasts, tiles=tiles)
+    (plot, chart_seconds, chart_tiles) = chart.result()
+    profiling.add_tile_counts(chart_tiles)
+    addHourlyForecast(display=display, image=image, hourly_forecasts=hourly_forecasts, hourly_forecast_plot=plot)
+
+    seconds = {"current": current_seconds, "hourly": chart_seconds, "daily": daily_seconds}
+    for name, section_seconds in seconds.items():
+        profiling.add_timing(name, section_seconds)
+    critical = max(seconds, key=seconds.get)
+    logger.debug(
+        f"Sections rendered in {time.perf_counter() - start:.2f} s instead of {sum(seconds.values()):.2f} s sequentially, "
+        f"critical path: {critical} ({seconds[critical]:.2f} s)"
+    )
+    return image
+
+
+def get_forecast_image(display: WeatherDisplay, current_weather=None, hourly_forecasts=None, sensor_readings=None) -> Image:
+    """
+    Draws the whole dashboard
+    :param display:
+        WeatherDisplay object with all display parameters
+    :param current_weather:
+        Current weather, fetched from OWM if not given
+    :param hourly_forecasts:
+        List of hourly weather forecasts, fetched from OWM if not given
+    :param sensor_readings:
+        Tuple of indoor temperature and rel. humidity, read from MQTT if needed and not given
+    :return:
+        Dashboard image
+    """
     ## Grab OWM API data
-    (current_weather, hourly_forecasts) = owm_forecasts.get_owm_data(lat=lat, lon=lon, token=token)
+    if current_weather is None or hourly_forecasts is None:
+        with profiling.stage("fetch"):
+            (current_weather, hourly_forecasts) = get_weather_data()
 
     ## Create Base Image
-    my_image = createBaseImage(display=display)
+    with profiling.stage("base"):
+        my_image = createBaseImage(display=display)
+
+    # Profiling measures the sections one after another, and daemonic processes (batch workers) can't fork the chart process
+    if parallel_render and not profiling.is_enabled() and not multiprocessing.current_process().daemon:
+        my_image = addSectionsParallel(
+            display=display,
+            image=my_image,
+            current_weather=current_weather,
+            hourly_forecasts=hourly_forecasts,
+            sensor_readings=sensor_readings,
+        )
+        with profiling.stage("overlay"):
+            return addStaticOverlay(display=display, image=my_image)
 
     ## Add Current Weather
-    my_image = addCurrentWeather(
-        display=display, image=my_image, current_weather=current_weather, hourly_forecasts=hourly_forecasts
-    )
+    with profiling.stage("current"):
+        current_section = renderCurrentWeather(
+            display=display,
+            image=my_image,
+            current_weather=current_weather,
+            hourly_forecasts=hourly_forecasts,
+            sensor_readings=sensor_readings,
+        )
+        paste_section(my_image, current_section, (0, 0))
 
     ## Add Hourly Forecast
-    my_image = addHourlyForecast(display=display, image=my_image, hourly_forecasts=hourly_forecasts)
+    with profiling.stage("hourly"):
+        my_image = addHourlyForecast(display=display, image=my_image, hourly_forecasts=hourly_forecasts)
 
     ## Add Daily Forecast
-    my_image = addDailyForecast(display=display, image=my_image, hourly_forecasts=hourly_forecasts)
+    with profiling.stage("daily"):
+        my_image = addDailyForecast(display=display, image=my_image, hourly_forecasts=hourly_forecasts)
+
+    ## Add section icons and titles
+    with profiling.stage("overlay"):
+        my_image = addStaticOverlay(display=display, image=my_image)
 
     return my_image
 
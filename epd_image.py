@@ -0,0 +1,367 @@
+import argparse
+import logging
+import time
+
+import numpy
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Palette of frames rendered straight into the panel's colours: index 0 is white, 1 black and 2 red
+BWR_PALETTE = [255, 255, 255, 0, 0, 0, 255, 0, 0]
+WHITE = 0
+BLACK = 1
+RED = 2
+
+
+def new_palette_frame(size: tuple) -> Image:
+    """Returns a white palette image using BWR_PALETTE"""
+    frame = Image.new("P", size, WHITE)
+    frame.putpalette(BWR_PALETTE)
+    return frame
+
+
+def dither_to_palette(image: Image, dither: bool = True) -> Image:
+    """
+    Maps continuous-tone content (e.g. weather icons or the chart) to a palette image using BWR_PALETTE
+    Args:
+      - image: RGB image
+      - dither: Use Floyd-Steinberg dithering? Otherwise every pixel gets the nearest colour.
+    Returns:
+      - palette image with the same size
+    """
+    palette_im = Image.new("P", (1, 1))
+    palette_im.putpalette(BWR_PALETTE + [0, 0, 0] * 253)
+    quantized_im = image.convert("RGB").quantize(palette=palette_im, dither=Image.Dither.FLOYDSTEINBERG if dither else Image.Dither.NONE)
+    # All the padding entries are black
+    lut = numpy.full(256, BLACK, dtype=numpy.uint8)
+    lut[:3] = [WHITE, BLACK, RED]
+    frame = Image.frombytes("P", image.size, lut[numpy.asarray(quantized_im)].tobytes())
+    frame.putpalette(BWR_PALETTE)
+    return frame
+
+
+def split_palette_frame(image: Image) -> (Image, Image):
+    """
+    Splits a palette image using BWR_PALETTE into the black and the coloured band without any quantization
+    Returns:
+      - two 1-bit images: the black band and the coloured band, both black where the colour is shown
+    """
+    indices = numpy.asarray(image)
+    im_black = Image.fromarray(indices != BLACK)
+    im_colour = Image.fromarray(indices != RED)
+    return im_black, im_colour
+
+
+def join_bitplanes(image_black: Image, image_red: Image) -> Image:
+    """
+    Joins the black and the coloured band into a palette image using BWR_PALETTE, the inverse of split_palette_frame()
+    Saved as PNG, the frame only takes 2 bits per pixel.
+    """
+    indices = numpy.full((image_black.height, image_black.width), WHITE, dtype=numpy.uint8)
+    indices[~numpy.asarray(image_black.convert("1"))] = BLACK
+    indices[~numpy.asarray(image_red.convert("1"))] = RED
+    frame = Image.frombytes("P", image_black.size, indices.tobytes())
+    frame.putpalette(BWR_PALETTE)
+    return frame
+
+
+
+# Spread of the ordered dither thresholds per colour channel
+ORDERED_DITHER_SPREAD = 255
+
+
+def _bayer_matrix(size: int) -> numpy.ndarray:
+    # Normalized Bayer threshold matrix with values in (0, 1)
+    matrix = numpy.array([[0, 2], [3, 1]])
+    while matrix.shape[0] < size:
+        matrix = numpy.block([[4 * matrix, 4 * matrix + 2], [4 * matrix + 3, 4 * matrix + 1]])
+    return (matrix + 0.5) / matrix.size
+
+
+BAYER_8X8 = _bayer_matrix(8)
+
+
+def map_regions(image: Image, pal: list, regions: list, ordered: bool = False) -> numpy.ndarray:
+    """
+    Maps an image to a 3-colour palette, dithering only the given regions
+    Everything outside the regions (text, grid lines, flat fills) snaps to the nearest colour.
+    Args:
+      - image: RGB image
+      - pal: flat list of the 3 palette colours, white first and black second
+      - regions: list of (left, top, right, bottom) boxes with continuous-tone content
+      - ordered: use a vectorized 8x8 Bayer dither instead of Floyd-Steinberg in the regions
+    Returns:
+      - array with the palette index of every pixel
+    """
+    colours = len(pal) // 3
+    palette_im = Image.new('P', (1, 1))
+    palette_im.putpalette(pal + [0, 0, 0] * (256 - colours))
+    # All the padding entries are black
+    lut = numpy.full(256, 1, dtype=numpy.uint8)
+    lut[:colours] = numpy.arange(colours)
+
+    def quantize(im, dither):
+        return lut[numpy.asarray(im.quantize(palette=palette_im, dither=dither))]
+
+    image = image.convert('RGB')
+    indices = quantize(image, Image.Dither.NONE)
+    width, height = image.size
+    for left, top, right, bottom in regions:
+        left, top, right, bottom = max(left, 0), max(top, 0), min(right, width), min(bottom, height)
+        if left >= right or top >= bottom:
+            continue
+        region = image.crop((left, top, right, bottom))
+        if ordered:
+            # Thresholds follow absolute coordinates, so neighbouring regions share one pattern
+            thresholds = numpy.tile(BAYER_8X8, (height // 8 + 1, width // 8 + 1))[top:bottom, left:right]
+            shifted = numpy.asarray(region, dtype=numpy.float32) + ((thresholds - 0.5) * ORDERED_DITHER_SPREAD)[..., None]
+            region = Image.fromarray(numpy.clip(shifted, 0, 255).astype(numpy.uint8))
+            indices[top:bottom, left:right] = quantize(region, Image.Dither.NONE)
+        else:
+            indices[top:bottom, left:right] = quantize(region, Image.Dither.FLOYDSTEINBERG)
+    return indices
+
+
+# Stolen from inkycal
+def to_palette(image, palette, dither=True, regions=None) -> (Image, Image):
+    """Maps an image to a given colour palette.
+    Maps each pixel from the image to a colour from the palette.
+    Args:
+      - palette: A supported token. (see below)
+      - dither:->bool. Use dithering? Set to `False` for solid colour fills.
+        Also accepts a mode for the 3-colour palettes:
+        'floyd-steinberg' (same as `True`), 'none' (same as `False`),
+        'regions' to only dither continuous-tone regions and snap everything else,
+        'ordered' like 'regions' but with a vectorized ordered dither.
+      - regions: boxes with continuous-tone content, defaults to the ones recorded
+        by the renderer in image.info['dither_regions'] or else the whole image.
+    Returns:
+      - two images: one for the coloured band and one for the black band.
+    Raises:
+      - ValueError if palette token is not supported
+    Supported palette tokens:
+    >>> 'bwr' # black-white-red
+    >>> 'bwy' # black-white-yellow
+    >>> 'bw'  # black-white
+    >>> '16gray' # 16 shades of gray
+    """
+    # Frames rendered straight into the panel's colours only need to be split
+    if image.mode == 'P' and palette == 'bwr' and image.getpalette()[:9] == BWR_PALETTE:
+        im_black, im_colour = split_palette_frame(image)
+        logger.info('split palette image into bands')
+        return im_black, im_colour
+
+    image.convert('RGB')
+    logger.info('loaded Image')
+
+    if palette == 'bwr':
+        # black-white-red palette
+        pal = [255, 255, 255, 0, 0, 0, 255, 0, 0]
+    elif palette == 'bwy':
+        # black-white-yellow palette
+        pal = [255, 255, 255, 0, 0, 0, 255, 255, 0]
+    elif palette == 'bw':
+        pal = None
+    elif palette == '16gray':
+        pal = [x for x in range(0, 256, 16)] * 3
+        pal.sort()
+    else:
+        logger.error('The given palette is unsupported.')
+        raise ValueError('The given palette is not supported.')
+    if dither in ('regions', 'ordered') and pal and len(pal) == 9:
+        if regions is None:
+            regions = image.info.get('dither_regions', [(0, 0, image.width, image.height)])
+        indices = map_regions(image, pal, regions, ordered=dither == 'ordered')
+        im_black = Image.fromarray(indices != 1)
+        im_colour = Image.fromarray(indices != 2)
+        logger.info(f'mapped image to specified palette, dithering {len(regions)} regions')
+        return im_black, im_colour
+
+    dither = {'floyd-steinberg': True, 'none': False, 'regions': True, 'ordered': True}.get(dither, dither)
+    if pal:
+        # The palette needs to have 256 colors, for this, the black-colour
+        # is added until the
+        colours = len(pal) // 3
+        # print(f'The palette has {colours} colours')
+        if 256 % colours != 0:
+            # print('Filling palette with black')
+            pal += (256 % colours) * [0, 0, 0]
+        # print(pal)
+        colours = len(pal) // 3
+        # print(f'The palette now has {colours} colours')
+        # Create a dummy image to be used as a palette
+        palette_im = Image.new('P', (1, 1))
+        # Attach the created palette. The palette should have 256 colours
+        # equivalent to 768 integers
+        palette_im.putpalette(pal * (256 // colours))
+        # Quantize the image to given palette
+        quantized_im = image.quantize(palette=palette_im, dither=dither)
+        quantized_im = quantized_im.convert('RGB')
+        # get rgb of the non-black-white colour from the palette
+        rgb = [pal[x:x + 3] for x in range(0, len(pal), 3)]
+        rgb = [col for col in rgb if col != [0, 0, 0] and col != [255, 255, 255]][0]
+        r_col, g_col, b_col = rgb
+        # print(f'r:{r_col} g:{g_col} b:{b_col}')
+        # Create an image buffer for black pixels
+        buffer1 = numpy.array(quantized_im)
+        # Get RGB values of each pixel
+        r, g, b = buffer1[:, :, 0], buffer1[:, :, 1], buffer1[:, :, 2]
+        # convert coloured pixels to white
+        buffer1[numpy.logical_and(r == r_col, g == g_col)] = [255, 255, 255]
+        # reconstruct image for black-band
+        im_black = Image.fromarray(buffer1)
+        # Create a buffer for coloured pixels
+        buffer2 = numpy.array(quantized_im)
+        # Get RGB values of each pixel
+        r, g, b = buffer2[:, :, 0], buffer2[:, :, 1], buffer2[:, :, 2]
+        # convert black pixels to white
+        buffer2[numpy.logical_and(r == 0, g == 0)] = [255, 255, 255]
+        # convert non-white pixels to black
+        buffer2[numpy.logical_and(g == g_col, b == 0)] = [0, 0, 0]
+        # reconstruct image for colour-band
+        im_colour = Image.fromarray(buffer2)
+        # self.preview(im_black)
+        # self.preview(im_colour)
+
+    else:
+        im_black = image.convert('1', dither=dither)
+        im_colour = Image.new(mode='1', size=im_black.size, color='white')
+
+    logger.info('mapped image to specified palette')
+
+    return im_black, im_colour
+
+
+def pack_bitplanes(image_black: Image, image_red: Image) -> (bytes, bytes):
+    """
+    Packs the two bands returned by to_palette() into the bytes the panel receives
+    This is the same byte layout EPD.display() sends after EPD.getbuffer(): one bit per pixel,
+    rows from top to bottom, MSB first. In the black plane 1=white, in the red plane 1=red.
+    Args:
+      - image_black: black band, landscape (800x480) or portrait (480x800)
+      - image_red: coloured band of the same size
+    Returns:
+      - black bytes and red bytes
+    """
+    planes = []
+    for band in (image_black, image_red):
+        if band.height > band.width:
+            band = band.rotate(90, expand=True)
+        planes.append(band.convert("1").tobytes("raw"))
+    black, red = planes
+    # PIL's 1-bit images already store white as 1 which matches the black plane, while
+    # the red plane needs to be inverted so that 1 means red
+    red = (numpy.frombuffer(red, dtype=numpy.uint8) ^ 0xFF).tobytes()
+    return black, red
+
+
+def unpack_bitplanes(black: bytes, red: bytes, size: tuple) -> (Image, Image):
+    """
+    Turns the packed planes back into the two bands, the inverse of pack_bitplanes() for landscape frames
+    Returns:
+      - two 1-bit images: the black band and the coloured band, both black where the colour is shown
+    """
+    im_black = Image.frombytes('1', size, black)
+    im_colour = Image.frombytes('1', size, (numpy.frombuffer(red, dtype=numpy.uint8) ^ 0xFF).tobytes())
+    return im_black, im_colour
+
+
+def packed_bands(image: Image, dither=True, band_height: int = 48):
+    """
+    Maps a landscape image to the bwr palette and packs it band by band of rows, with the same result as
+    to_palette() followed by pack_bitplanes() but only one band of palette indices in memory at a time.
+    Regions dithered with Floyd-Steinberg are dithered as a whole when the first band reaches them, as the
+    error diffuses across band borders, and dropped after their last row.
+    Args:
+      - image: RGB image or palette image using BWR_PALETTE
+      - dither: same as for to_palette()
+      - band_height: rows per band, rounded up to a multiple of 8 so that the ordered dither stays aligned
+    Yields:
+      - top row, black bytes and red bytes of every band, in the byte layout of pack_bitplanes()
+    """
+    band_height = -(-band_height // 8) * 8
+    width, height = image.size
+    palette_frame = image.mode == 'P' and image.getpalette()[:9] == BWR_PALETTE
+    pal = list(BWR_PALETTE)
+    regions = []
+    ordered = dither == 'ordered'
+    if not palette_frame and dither in ('regions', 'ordered'):
+        regions = image.info.get('dither_regions', [(0, 0, width, height)])
+    elif not palette_frame and {'floyd-steinberg': True, 'none': False}.get(dither, dither):
+        regions = [(0, 0, width, height)]
+    # Clipped like map_regions() does, the order is kept as later regions overwrite earlier ones
+    regions = [
+        (max(left, 0), max(top, 0), min(right, width), min(bottom, height)) for left, top, right, bottom in regions
+    ]
+    regions = [box for box in regions if box[0] < box[2] and box[1] < box[3]]
+    dithered = {}
+
+    for top in range(0, height, band_height):
+        bottom = min(top + band_height, height)
+        band = image.crop((0, top, width, bottom))
+        if palette_frame:
+            indices = numpy.asarray(band)
+        else:
+            band = band.convert('RGB')
+            crossing = [box for box in regions if box[1] < bottom and box[3] > top]
+            if ordered:
+                indices = map_regions(band, pal, [(l, max(t, top) - top, r, min(b, bottom) - top) for l, t, r, b in crossing], ordered=True)
+            else:
+                indices = map_regions(band, pal, [])
+                for box in crossing:
+                    left, region_top, right, region_bottom = box
+                    if box not in dithered:
+                        region = image.crop(box)
+                        dithered[box] = map_regions(region, pal, [(0, 0, region.width, region.height)])
+                    rows = slice(max(region_top, top) - region_top, min(region_bottom, bottom) - region_top)
+                    indices[max(region_top, top) - top : min(region_bottom, bottom) - top, left:right] = dithered[box][rows]
+                for box in [box for box in dithered if box[3] <= bottom]:
+                    del dithered[box]
+        yield top, numpy.packbits(indices != BLACK, axis=1).tobytes(), numpy.packbits(indices == RED, axis=1).tobytes()
+
+
+def benchmark(image: Image, palette: str = 'bwr', repeat: int = 5) -> dict:
+    """
+    Compares the dither modes against whole-frame Floyd-Steinberg dithering
+    Returns:
+      - dict of mode to mean seconds and share of pixels differing from the reference in each band
+    """
+    def bands(dither):
+        im_black, im_colour = to_palette(image, palette, dither=dither)
+        return numpy.asarray(im_black.convert('1')), numpy.asarray(im_colour.convert('1'))
+
+    reference = bands(True)
+    results = {}
+    for mode in ('floyd-steinberg', 'none', 'regions', 'ordered'):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            black, colour = bands(mode)
+        results[mode] = {
+            'seconds': (time.perf_counter() - start) / repeat,
+            'black_diff': float((black != reference[0]).mean()),
+            'colour_diff': float((colour != reference[1]).mean()),
+        }
+    return results
+
+
+if __name__ == '__main__':
+    # Benchmarks the dither modes on a freshly rendered dashboard or on a given image
+    parser = argparse.ArgumentParser(description='Compares speed and output of the dither modes.')
+    parser.add_argument('--image', help='Image to map instead of rendering the dashboard (dithered as a whole)')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    if args.image:
+        frame = Image.open(args.image).convert('RGB')
+    else:
+        import draw_forecasts
+        from weather_display import WeatherDisplay
+
+        frame = draw_forecasts.get_forecast_image(WeatherDisplay(pixel_width=800, pixel_height=480, width_mm=163, height_mm=98))
+    logging.basicConfig(level=logging.WARNING)
+    for mode, result in benchmark(frame, repeat=args.repeat).items():
+        print(
+            f"{mode:>16}: {result['seconds'] * 1000:7.1f} ms, "
+            f"differs from floyd-steinberg in {result['black_diff']:.2%} (black) / {result['colour_diff']:.2%} (colour) of the pixels"
+        )
@@ -0,0 +1,280 @@
+#!/usr/bin/python
+import argparse
+import glob
+import io
+import json
+import logging
+import os
+import re
+import time
+from datetime import datetime
+
+import numpy as np
+
+import artifacts
+import owm_forecasts
+
+logger = logging.getLogger(__name__)
+
+## Paths config
+_HERE = os.path.dirname(os.path.realpath(__file__))
+cachedir = os.path.join(_HERE, "cache")
+biaspath = os.path.join(cachedir, "forecast-bias.json")
+columnspath = os.path.join(cachedir, "history-columns.npz")
+
+# Issue time in the names of the full JSON snapshots written before the forecast store, local time
+SNAPSHOT_NAME = re.compile(r"openweather_(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})\.json$")
+# An observation counts for a forecast timing if it was made at most this far apart
+MATCH_SECONDS = 90 * 60
+# Leads the dashboard's bias indicator is computed over
+BIAS_LEAD_HOURS = 24
+
+FORECAST_COLUMNS = ("issued", "valid", "temp", "precip_3h_mm", "icon")
+OBSERVATION_COLUMNS = ("time", "temp", "precip_1h_mm", "icon")
+
+
+def icon_code(icons) -> np.ndarray:
+    """Weather condition of OWM icon names without day/night, e.g. 10 for 10d and 10n, 0 for missing icons"""
+    return np.array([int(icon[:2]) if icon else 0 for icon in icons], dtype=np.int8)
+
+
+def to_kelvin(temps: np.ndarray, unit: str) -> np.ndarray:
+    if unit == "celsius":
+        return temps + owm_forecasts.KELVIN_OFFSET
+    if unit == "fahrenheit":
+        return (temps - 32.0) / 1.8 + owm_forecasts.KELVIN_OFFSET
+    return temps
+
+
+def delta_in_units(kelvin: np.ndarray, unit: str):
+    # Temperature differences in the displayed unit
+    return kelvin * 1.8 if unit == "fahrenheit" else kelvin
+
+
+def _empty(names: tuple) -> dict:
+    return {name: np.zeros(0, dtype=np.int8 if name == "icon" else np.float64) for name in names}
+
+
+def _concatenate(parts: list, names: tuple) -> dict:
+    if not parts:
+        return _empty(names)
+    return {name: np.concatenate([part[name] for part in parts]) for name in names}
+
+
+def read_snapshot(path: str, temp_units: str) -> dict:
+    """
+    Reads a full JSON snapshot of the history directory into forecast columns
+    Snapshots hold the forecast in the units configured when they were written, temp_units has to match them.
+    """
+    issued = datetime.strptime(SNAPSHOT_NAME.search(path).group(1), "%Y-%m-%d_%H-%M-%S").timestamp()
+    with open(path, "rb") as snapshotfile:
+        items = json.loads(snapshotfile.read())
+    return {
+        "issued": np.full(len(items), issued),
+        "valid": np.array([datetime.fromisoformat(item["datetime"]).timestamp() for item in items], dtype=np.float64),
+        "temp": to_kelvin(np.array([item["temp"] for item in items], dtype=np.float64), temp_units),
+        "precip_3h_mm": np.array([item["precip_3h_mm"] for item in items], dtype=np.float64),
+        "icon": icon_code(item["icon"] for item in items),
+    }
+
+
+def read_snapshots(directory: str, temp_units: str, cache_path: str = None) -> dict:
+    """
+    Returns the forecast columns of all JSON snapshots in the directory
+    The columns are kept in cache_path together with the names of the files they were read from, later calls only
+    read the snapshots added since.
+    """
+    paths = sorted(path for path in glob.glob(os.path.join(directory, "openweather_*.json")) if SNAPSHOT_NAME.search(path))
+    parts, known = [], set()
+    if cache_path is not None and os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            if str(cached["temp_units"]) == temp_units:
+                parts.append({name: cached[name] for name in FORECAST_COLUMNS})
+                known = set(cached["files"].tolist())
+    new_paths = [path for path in paths if os.path.basename(path) not in known]
+    for path in new_paths:
+        try:
+            parts.append(read_snapshot(path, temp_units))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Skipping {path}: {e!r}")
+    columns = _concatenate(parts, FORECAST_COLUMNS)
+    if cache_path is not None and new_paths:
+        files = np.array(sorted(known | {os.path.basename(path) for path in new_paths}))
+        artifacts.write_atomic(cache_path, _npz(columns, files=files, temp_units=np.array(temp_units)))
+    return columns
+
+
+def _npz(columns: dict, **extra) -> bytes:
+    buffer = io.BytesIO()
+    np.savez(buffer, **columns, **extra)
+    return buffer.getvalue()
+
+
+def read_store(store: owm_forecasts.ForecastStore) -> tuple:
+    """Returns the forecast and the observation columns of a forecast store"""
+    parts = []
+    for issued, table in store.snapshots():
+        parts.append(
+            {
+                "issued": np.full(len(table["timestamp"]), float(issued)),
+                "valid": table["timestamp"].astype(np.float64),
+                "temp": table["temp"],
+                "precip_3h_mm": table["precip_3h_mm"],
+                "icon": icon_code(table["icon"]),
+            }
+        )
+    observations = store.observations
+    observed = {
+        "time": np.array([item["time"] for item in observations], dtype=np.float64),
+        "temp": np.array([np.nan if item["temp"] is None else item["temp"] for item in observations], dtype=np.float64),
+        "precip_1h_mm": np.array([item["precip_1h_mm"] for item in observations], dtype=np.float64),
+        "icon": icon_code(item["icon"] for item in observations),
+    }
+    return _concatenate(parts, FORECAST_COLUMNS), observed
+
+
+def load_archive(directory: str, temp_units: str, cache_path: str = None) -> tuple:
+    """
+    Streams the history directory into columnar arrays: the forecast stores and the JSON snapshots written before them
+    :return:
+        Tuple of forecast columns (issued, valid, temp in Kelvin, precip_3h_mm, icon) and observation columns
+        (time, temp in Kelvin, precip_1h_mm, icon)
+    """
+    forecasts = [read_snapshots(directory, temp_units, cache_path)]
+    observations = []
+    for path in sorted(glob.glob(os.path.join(directory, "forecasts_*.jsonl"))):
+        (store_forecasts, store_observations) = read_store(owm_forecasts.ForecastStore(path))
+        forecasts.append(store_forecasts)
+        observations.append(store_observations)
+    return _concatenate(forecasts, FORECAST_COLUMNS), _concatenate(observations, OBSERVATION_COLUMNS)
+
+
+def reference_values(forecasts: dict, observations: dict) -> dict:
+    """
+    Returns what was observed at every forecast timing, NaN / 0 if nothing was
+    The current weather closest to the timing is used if it was observed within MATCH_SECONDS. Timings without one
+    (e.g. from JSON snapshots) fall back to the forecast with the shortest lead, issued less than one step before.
+    """
+    valid = forecasts["valid"]
+    count = len(valid)
+    reference = {
+        "temp": np.full(count, np.nan),
+        "precip_3h_mm": np.full(count, np.nan),
+        "icon": np.zeros(count, dtype=np.int8),
+        "observed": np.zeros(count, dtype=bool),
+    }
+
+    # Latest forecast issued less than one step before its timing
+    lead = valid - forecasts["issued"]
+    short = (lead >= 0) & (lead < owm_forecasts.FORECAST_STEP)
+    if short.any():
+        order = np.lexsort((forecasts["issued"][short], valid[short]))
+        short_valid = valid[short][order]
+        last = np.r_[short_valid[1:] != short_valid[:-1], True]
+        analysis_valid = short_valid[last]
+        index = np.searchsorted(analysis_valid, valid)
+        found = index < len(analysis_valid)
+        found[found] = analysis_valid[index[found]] == valid[found]
+        for name in ("temp", "precip_3h_mm", "icon"):
+            reference[name][found] = forecasts[name][short][order][last][index[found]]
+
+    times = observations["time"]
+    if len(times):
+        order = np.argsort(times)
+        times = times[order]
+        index = np.clip(np.searchsorted(times, valid), 1, len(times)) - 1
+        # Closest of the observations before and after the timing
+        after = np.minimum(index + 1, len(times) - 1)
+        index = np.where(np.abs(times[after] - valid) < np.abs(times[index] - valid), after, index)
+        matched = np.abs(times[index] - valid) <= MATCH_SECONDS
+        observed = {name: observations[name][order][index[matched]] for name in ("temp", "precip_1h_mm", "icon")}
+        reference["temp"][matched] = observed["temp"]
+        # The forecast sums up three hours, the observation the last one
+        reference["precip_3h_mm"][matched] = observed["precip_1h_mm"] * 3
+        reference["icon"][matched] = observed["icon"]
+        reference["observed"] = matched
+    return reference
+
+
+def evaluate(forecasts: dict, observations: dict, temp_units: str, max_lead_hours: int = 120) -> dict:
+    """
+    Computes the forecast errors by lead time, in steps of the forecast timings
+    :return:
+        Dict with the lead hours and, per lead, the number of forecasts, temperature bias and mean absolute error
+        (displayed units), precipitation bias and mean absolute error (mm per 3 h), rain / no rain agreement and
+        icon agreement (same condition, day or night), and the share compared against real observations
+    """
+    reference = reference_values(forecasts, observations)
+    step = owm_forecasts.FORECAST_STEP
+    lead = forecasts["valid"] - forecasts["issued"]
+    bucket = np.floor(lead / step).astype(np.int64)
+    buckets = max_lead_hours * 3600 // step
+    # Forecasts used as their own reference are left out
+    usable = (lead >= 0) & (bucket < buckets) & (reference["observed"] | (lead >= step))
+    usable &= ~np.isnan(reference["temp"]) & ~np.isnan(forecasts["temp"])
+    bucket = bucket[usable]
+
+    def per_lead(values: np.ndarray) -> np.ndarray:
+        return np.bincount(bucket, weights=values, minlength=buckets)
+
+    count = np.bincount(bucket, minlength=buckets)
+    temp_error = delta_in_units(forecasts["temp"][usable] - reference["temp"][usable], temp_units)
+    precip_forecast = np.nan_to_num(forecasts["precip_3h_mm"][usable])
+    precip_reference = np.nan_to_num(reference["precip_3h_mm"][usable])
+    precip_error = precip_forecast - precip_reference
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return {
+            "lead_hours": np.arange(buckets) * step // 3600,
+            "count": count,
+            "temp_bias": per_lead(temp_error) / count,
+            "temp_mae": per_lead(np.abs(temp_error)) / count,
+            "precip_bias": per_lead(precip_error) / count,
+            "precip_mae": per_lead(np.abs(precip_error)) / count,
+            "rain_agreement": per_lead((precip_forecast > 0.1) == (precip_reference > 0.1)) / count,
+            "icon_agreement": per_lead(forecasts["icon"][usable] == reference["icon"][usable]) / count,
+            "observed_share": per_lead(reference["observed"][usable]) / count,
+        }
+
+
+def bias(result: dict, temp_units: str, lead_hours: int = BIAS_LEAD_HOURS) -> dict:
+    """Temperature bias in Kelvin over the leads up to lead_hours, weighted by the number of forecasts"""
+    leads = (result["lead_hours"] < lead_hours) & (result["count"] > 0)
+    count = int(result["count"][leads].sum())
+    temp_bias = None
+    if count:
+        temp_bias = float(np.sum(result["temp_bias"][leads] * result["count"][leads]) / count) / delta_in_units(1.0, temp_units)
+    return {"temp_bias_k": temp_bias, "lead_hours": lead_hours, "count": count, "computed": int(time.time())}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Computes the forecast accuracy by lead time from the history directory.")
+    parser.add_argument("--history", default=owm_forecasts.historydir, help="History directory (default: history)")
+    parser.add_argument("--max-lead", type=int, default=120, help="Longest lead in hours")
+    parser.add_argument("--bias", action="store_true", help=f"Save the bias of the first {BIAS_LEAD_HOURS} h for the dashboard")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    temp_units = owm_forecasts.temp_units
+
+    start = time.perf_counter()
+    (forecasts, observations) = load_archive(args.history, temp_units, cache_path=columnspath)
+    loaded = time.perf_counter()
+    result = evaluate(forecasts, observations, temp_units, max_lead_hours=args.max_lead)
+    logger.info(
+        f"{len(forecasts['valid'])} forecasts of {len(np.unique(forecasts['issued']))} issues and {len(observations['time'])} "
+        f"observations loaded in {loaded - start:.2f} s, evaluated in {time.perf_counter() - loaded:.3f} s"
+    )
+    logger.info(f"{'lead h':>6} {'count':>7} {'temp bias':>9} {'temp MAE':>8} {'rain bias':>9} {'rain MAE':>8} {'rain ok':>7} {'icon ok':>7} {'observed':>8}")
+    for index in np.flatnonzero(result["count"]):
+        logger.info(
+            f"{result['lead_hours'][index]:>6} {result['count'][index]:>7} {result['temp_bias'][index]:>+9.2f} "
+            f"{result['temp_mae'][index]:>8.2f} {result['precip_bias'][index]:>+9.2f} {result['precip_mae'][index]:>8.2f} "
+            f"{result['rain_agreement'][index]:>7.0%} {result['icon_agreement'][index]:>7.0%} {result['observed_share'][index]:>8.0%}"
+        )
+    if args.bias:
+        summary = bias(result, temp_units)
+        artifacts.write_atomic(biaspath, json.dumps(summary).encode("utf-8"))
+        logger.info(f"Saved the temperature bias of the first {BIAS_LEAD_HOURS} h to {biaspath}: {summary['temp_bias_k']} K")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+#!/usr/bin/python
+import argparse
+import fcntl
+import json
+import logging
+import os
+import struct
+import time
+
+import numpy as np
+
+import epd_image
+
+logger = logging.getLogger(__name__)
+
+## Paths config
+_HERE = os.path.dirname(os.path.realpath(__file__))
+
+# Magic, bytes per plane and frames per keyframe
+INDEX_HEADER = struct.Struct("<8sII")
+INDEX_MAGIC = b"EPDARCH1"
+# Time, offset in the data file, encoded length of the black and of the red plane
+INDEX_ENTRY = struct.Struct("<dQII")
+# Size of the epd7in5b_V2 panel
+DEFAULT_SIZE = (800, 480)
+
+_archives = {}
+
+
+def rle_encode(data: bytes) -> bytes:
+    """
+    Run-length encodes bytes the PackBits way: a count byte n < 128 is followed by n + 1 literal bytes, a count byte
+    n > 128 by one byte repeated 257 - n times
+    """
+    values = np.frombuffer(data, dtype=np.uint8)
+    if not len(values):
+        return b""
+    starts = np.flatnonzero(np.r_[True, values[1:] != values[:-1]])
+    lengths = np.diff(np.r_[starts, len(values)])
+    out = bytearray()
+    literal_start = 0
+
+    def add_literal(start: int, end: int) -> None:
+        for chunk_start in range(start, end, 128):
+            chunk = data[chunk_start : min(chunk_start + 128, end)]
+            out.append(len(chunk) - 1)
+            out.extend(chunk)
+
+    # Only runs of 3 and more bytes are worth a run, shorter ones go into the literals
+    for start, length in zip(starts[lengths >= 3].tolist(), lengths[lengths >= 3].tolist()):
+        add_literal(literal_start, start)
+        for chunk in [128] * (length // 128) + ([length % 128] if length % 128 else []):
+            if chunk < 3:
+                add_literal(start, start + chunk)
+            else:
+                out.append(257 - chunk)
+                out.append(data[start])
+            start += chunk
+        literal_start = start
+    add_literal(literal_start, len(data))
+    return bytes(out)
+
+
+def rle_decode(data: bytes) -> bytes:
+    """Decodes bytes encoded with rle_encode()"""
+    out = bytearray()
+    index = 0
+    while index < len(data):
+        count = data[index]
+        if count < 128:
+            out += data[index + 1 : index + count + 2]
+            index += count + 2
+        else:
+            out += data[index + 1 : index + 2] * (257 - count)
+            index += 2
+    return bytes(out)
+
+
+def _xor(data: bytes, reference: bytes) -> bytes:
+    return np.bitwise_xor(np.frombuffer(data, dtype=np.uint8), np.frombuffer(reference, dtype=np.uint8)).tobytes()
+
+
+class FrameArchive:
+    """
+    Every frame shown on the panel, as the packed black and red plane it received (see epd_image.pack_bitplanes())
+    Frames are stored as the XOR against the previous frame, run-length encoded, so an unchanged region costs a few
+    bytes. Every keyframe_interval-th frame is stored on its own, reading a frame decodes at most that many frames.
+    The index holds time, offset and length of every frame for random access, both files are only appended to.
+    """
+
+    def __init__(self, directory: str, plane_size: int = DEFAULT_SIZE[0] // 8 * DEFAULT_SIZE[1], keyframe_interval: int = 32):
+        self.directory = directory
+        self.datapath = os.path.join(directory, "frames.bin")
+        self.indexpath = os.path.join(directory, "frames.idx")
+        self.plane_size = plane_size
+        self.keyframe_interval = keyframe_interval
+        # Index of the last frame and its planes, the reference of the next delta
+        self._last = None
+        if os.path.exists(self.indexpath) and os.path.getsize(self.indexpath):
+            with open(self.indexpath, "rb") as indexfile:
+                (magic, self.plane_size, self.keyframe_interval) = INDEX_HEADER.unpack(indexfile.read(INDEX_HEADER.size))
+            if magic != INDEX_MAGIC:
+                raise ValueError(f"{self.indexpath} is no frame archive index.")
+
+    def __len__(self) -> int:
+        if not os.path.exists(self.indexpath):
+            return 0
+        return max(os.path.getsize(self.indexpath) - INDEX_HEADER.size, 0) // INDEX_ENTRY.size
+
+    def _entries(self, start: int, stop: int) -> list:
+        with open(self.indexpath, "rb") as indexfile:
+            indexfile.seek(INDEX_HEADER.size + start * INDEX_ENTRY.size)
+            data = indexfile.read((stop - start) * INDEX_ENTRY.size)
+        return list(INDEX_ENTRY.iter_unpack(data))
+
+    def append(self, black: bytes, red: bytes, timestamp: float = None) -> int:
+        """Adds a frame, returns its index"""
+        if len(black) != self.plane_size or len(red) != self.plane_size:
+            raise ValueError(f"Frames of {self.directory} need planes of {self.plane_size} bytes.")
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.indexpath, "ab") as indexfile:
+            fcntl.flock(indexfile, fcntl.LOCK_EX)
+            try:
+                if not indexfile.tell():
+                    indexfile.write(INDEX_HEADER.pack(INDEX_MAGIC, self.plane_size, self.keyframe_interval))
+                index = (indexfile.tell() - INDEX_HEADER.size) // INDEX_ENTRY.size
+                if index % self.keyframe_interval:
+                    if self._last is None or self._last[0] != index - 1:
+                        # Another process added frames
+                        self._last = (index - 1, *self.frame(index - 1)[1:])
+                    encoded = (rle_encode(_xor(black, self._last[1])), rle_encode(_xor(red, self._last[2])))
+                else:
+                    encoded = (rle_encode(black), rle_encode(red))
+                with open(self.datapath, "ab") as datafile:
+                    offset = datafile.tell()
+                    datafile.write(encoded[0] + encoded[1])
+                indexfile.write(INDEX_ENTRY.pack(time.time() if timestamp is None else timestamp, offset, *map(len, encoded)))
+                indexfile.flush()
+            finally:
+                fcntl.flock(indexfile, fcntl.LOCK_UN)
+        self._last = (index, bytes(black), bytes(red))
+        return index
+
+    def frame(self, index: int) -> tuple:
+        """
+        Reconstructs a frame, negative indices count from the end
+        :return:
+            Tuple of time, black plane and red plane
+        """
+        count = len(self)
+        if index < 0:
+            index += count
+        if not 0 <= index < count:
+            raise IndexError(f"No frame {index} in {self.directory}.")
+        keyframe = index - index % self.keyframe_interval
+        entries = self._entries(keyframe, index + 1)
+        with open(self.datapath, "rb") as datafile:
+            datafile.seek(entries[0][1])
+            data = datafile.read(entries[-1][1] + entries[-1][2] + entries[-1][3] - entries[0][1])
+        black = red = None
+        for (_, offset, black_length, red_length) in entries:
+            start = offset - entries[0][1]
+            frame_black = rle_decode(data[start : start + black_length])
+            frame_red = rle_decode(data[start + black_length : start + black_length + red_length])
+            if black is None:
+                (black, red) = (frame_black, frame_red)
+            else:
+                (black, red) = (_xor(frame_black, black), _xor(frame_red, red))
+        return entries[-1][0], black, red
+
+    def stats(self) -> dict:
+        """Number of frames, stored bytes per frame and the share of the raw planes they take"""
+        count = len(self)
+        entries = self._entries(0, count) if count else []
+        stored = sum(black_length + red_length for (_, _, black_length, red_length) in entries)
+        keyframes = sum(black_length + red_length for index, (_, _, black_length, red_length) in enumerate(entries) if not index % self.keyframe_interval)
+        deltas = count - len(range(0, count, self.keyframe_interval))
+        return {
+            "frames": count,
+            "bytes": stored,
+            "bytes_per_frame": stored / count if count else 0.0,
+            "bytes_per_keyframe": keyframes / len(range(0, count, self.keyframe_interval)) if count else 0.0,
+            "bytes_per_delta": (stored - keyframes) / deltas if deltas else 0.0,
+            "raw_bytes_per_frame": 2 * self.plane_size,
+            "ratio": stored / (count * 2 * self.plane_size) if count else 0.0,
+        }
+
+
+def white_frame(size: tuple = DEFAULT_SIZE) -> tuple:
+    """Returns the black and red plane of a cleared panel"""
+    plane_size = size[0] // 8 * size[1]
+    return b"\xff" * plane_size, b"\x00" * plane_size
+
+
+def archive_path(path: str = None) -> str:
+    """Returns the archive directory, frame_archive of config.json if not given (empty if there is none), relative paths are relative to the repository"""
+    if path is None:
+        with open(os.path.join(_HERE, "config.json"), "r") as configfile:
+            path = json.load(configfile).get("frame_archive", "")
+    return os.path.join(_HERE, path) if path else ""
+
+
+def get_archive(directory: str) -> FrameArchive:
+    """Returns the archive of the directory, opened on first use"""
+    if directory not in _archives:
+        _archives[directory] = FrameArchive(directory)
+    return _archives[directory]
+
+
+def record(black: bytes, red: bytes, directory: str = None) -> None:
+    """Adds the frame just sent to the panel to the archive of config.json, if there is one"""
+    directory = archive_path() if directory is None else directory
+    if not directory:
+        return
+    try:
+        start = time.perf_counter()
+        index = get_archive(directory).append(black, red)
+        logger.debug(f"Archived frame {index} in {(time.perf_counter() - start) * 1000:.0f} ms")
+    except (OSError, ValueError) as e:
+        # The archive must never keep the panel from updating
+        logger.error(f"Archiving the frame failed: {e!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Shows the frame archive's size or extracts frames from it.")
+    parser.add_argument("--archive", help="Archive directory, defaults to frame_archive of config.json")
+    parser.add_argument("--extract", type=int, nargs="*", default=[], help="Indices of the frames to save as PNG, negative ones count from the end")
+    parser.add_argument("--out", default=".", help="Directory for the extracted frames")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    directory = archive_path(args.archive)
+    if not directory:
+        parser.error("No archive, set frame_archive in config.json or pass --archive.")
+
+    archive = FrameArchive(directory)
+    stats = archive.stats()
+    logger.info(
+        f"{stats['frames']} frames, {stats['bytes'] / 1024:.1f} KiB: {stats['bytes_per_frame']:.0f} bytes per frame "
+        f"({stats['ratio']:.1%} of the raw planes), {stats['bytes_per_keyframe']:.0f} per keyframe, {stats['bytes_per_delta']:.0f} per delta"
+    )
+    for index in args.extract:
+        start = time.perf_counter()
+        (timestamp, black, red) = archive.frame(index)
+        frame = epd_image.join_bitplanes(*epd_image.unpack_bitplanes(black, red, DEFAULT_SIZE))
+        path = os.path.join(args.out, f"frame_{index % len(archive):05d}.png")
+        frame.save(path)
+        logger.info(f"Frame {index} of {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))} saved to {path} ({(time.perf_counter() - start) * 1000:.0f} ms)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import fcntl
+import mmap
+import os
+import struct
+
+# Magic, width, height, sequence number of the latest frame, its slot, sequence number shown on the panel
+HEADER = struct.Struct("<8sIIQIQ")
+MAGIC = b"EPDFRAME"
+# Size of the epd7in5b_V2 panel, used when the renderer creates the file before the panel writer
+DEFAULT_SIZE = (800, 480)
+# Byte ranges locked with lockf(): publishing (between renderers) and the front slot (flip vs. copy)
+PUBLISH_LOCK = 0
+FRONT_LOCK = 1
+
+
+class FrameBuffer:
+    """
+    Double-buffered frames in a memory-mapped file, shared by the renderer and the panel writer
+    Every slot holds a frame as packed black and red plane (the byte layout of epd_image.pack_bitplanes()).
+    A renderer writes the back slot and flips it to the front with the next sequence number, the panel writer
+    copies the front slot. Both only wait for each other for the flip or the copy, never for the panel.
+    """
+
+    def __init__(self, path: str, width: int = DEFAULT_SIZE[0], height: int = DEFAULT_SIZE[1]):
+        self.path = path
+        self.plane_size = width // 8 * height
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o664)
+        size = HEADER.size + 4 * self.plane_size
+        self._lock(PUBLISH_LOCK, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size == 0:
+                os.ftruncate(self._fd, size)
+                os.pwrite(self._fd, HEADER.pack(MAGIC, width, height, 0, 0, 0), 0)
+            self._mmap = mmap.mmap(self._fd, 0)
+        finally:
+            self._lock(PUBLISH_LOCK, fcntl.LOCK_UN)
+        (magic, self.width, self.height) = HEADER.unpack_from(self._mmap)[:3]
+        if magic != MAGIC or (self.width, self.height) != (width, height) or len(self._mmap) != size:
+            self.close()
+            raise ValueError(f"{path} is no frame buffer for {width}x{height} frames.")
+
+    def _lock(self, byte: int, operation: int) -> None:
+        fcntl.lockf(self._fd, operation, 1, byte)
+
+    def _slot_offset(self, slot: int) -> int:
+        return HEADER.size + slot * 2 * self.plane_size
+
+    def _header(self) -> tuple:
+        # Sequence number, front slot and shown sequence number
+        (_, _, _, seq, front, shown) = HEADER.unpack_from(self._mmap)
+        return seq, front, shown
+
+    @property
+    def seq(self) -> int:
+        return self._header()[0]
+
+    @property
+    def shown(self) -> int:
+        return self._header()[2]
+
+    def publish(self, black: bytes, red: bytes) -> int:
+        """Writes a frame into the back slot and makes it the latest, returns its sequence number"""
+        if len(black) != self.plane_size or len(red) != self.plane_size:
+            raise ValueError(f"Frames of {self.path} need planes of {self.plane_size} bytes.")
+        self._lock(PUBLISH_LOCK, fcntl.LOCK_EX)
+        try:
+            (seq, front, _) = self._header()
+            back = 1 - front
+            offset = self._slot_offset(back)
+            self._mmap[offset : offset + self.plane_size] = black
+            self._mmap[offset + self.plane_size : offset + 2 * self.plane_size] = red
+            self._lock(FRONT_LOCK, fcntl.LOCK_EX)
+            try:
+                struct.pack_into("<QI", self._mmap, 16, seq + 1, back)
+            finally:
+                self._lock(FRONT_LOCK, fcntl.LOCK_UN)
+        finally:
+            self._lock(PUBLISH_LOCK, fcntl.LOCK_UN)
+        return seq + 1
+
+    def read(self, after: int = 0):
+        """
+        Copies the latest frame if it is newer than the given sequence number
+        :return:
+            Tuple of sequence number, black plane and red plane, None if there is no newer frame
+        """
+        self._lock(FRONT_LOCK, fcntl.LOCK_SH)
+        try:
+            (seq, front, _) = self._header()
+            if seq <= after:
+                return None
+            offset = self._slot_offset(front)
+            black = self._mmap[offset : offset + self.plane_size]
+            red = self._mmap[offset + self.plane_size : offset + 2 * self.plane_size]
+        finally:
+            self._lock(FRONT_LOCK, fcntl.LOCK_UN)
+        return seq, black, red
+
+    def mark_shown(self, seq: int) -> None:
+        # Only the panel writer sets it
+        struct.pack_into("<Q", self._mmap, 28, seq)
+
+    def close(self) -> None:
+        if getattr(self, "_mmap", None) is not None:
+            self._mmap.close()
+            self._mmap = None
+        os.close(self._fd)
@@ -1,32 +1,115 @@
 import json
+import logging
+import threading
+import time
 
 import paho.mqtt.client as mqtt
 
+logger = logging.getLogger(__name__)
+
+
+class TopicStore:
+    """
+    Latest payload of every topic, kept as raw bytes and only parsed as JSON when a value is read
+    Storing a message is a dict update, so the MQTT callback costs the same no matter how large or frequent
+    the payloads are. Every topic counts its messages for the message rates.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def put(self, topic: str, payload: bytes) -> None:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(topic)
+            if entry is None:
+                self._entries[topic] = {"payload": payload, "state": None, "first": now, "received": now, "count": 1}
+            else:
+                entry.update(payload=payload, state=None, received=now)
+                entry["count"] += 1
+
+    def latest_topic(self, pattern: str):
+        """Returns the topic matching the subscription pattern (wildcards allowed) that received the latest message"""
+        with self._lock:
+            if pattern in self._entries:
+                return pattern
+            matching = [(entry["received"], topic) for topic, entry in self._entries.items() if mqtt.topic_matches_sub(pattern, topic)]
+        return max(matching)[1] if matching else None
+
+    def get(self, topic: str):
+        """Returns the decoded payload of the topic, None if there is none or it is no JSON"""
+        with self._lock:
+            entry = self._entries.get(topic)
+            if entry is None:
+                return None
+            if entry["state"] is None:
+                try:
+                    entry["state"] = json.loads(entry["payload"].decode("utf-8"))
+                except ValueError as e:
+                    logger.warning(f"Ignoring payload of {topic}: {e}")
+                    return None
+            return entry["state"]
+
+    def value(self, pattern: str, key: str):
+        """Returns the value of the key in the latest payload matching the pattern, None if there is none"""
+        topic = self.latest_topic(pattern)
+        state = self.get(topic) if topic is not None else None
+        if not isinstance(state, dict):
+            return None
+        return state.get(key)
+
+    def rates(self) -> dict:
+        """Returns message count and messages per second of every topic"""
+        with self._lock:
+            return {
+                topic: {
+                    "count": entry["count"],
+                    "per_second": entry["count"] / max(entry["received"] - entry["first"], 1.0),
+                }
+                for topic, entry in self._entries.items()
+            }
+
 
 class mqtt_client:
     def __init__(self, host, port, user, password, topic):
-        self.topic = topic
-        self.state = 0
+        # One or many topics, wildcards are allowed
+        self.topics = []
+        self.store = TopicStore()
         self.client = mqtt.Client()
         self.client.on_connect = self.on_connect
         self.client.on_message = self.on_message
         self.client.username_pw_set(user, password)
+        for subscription in [topic] if isinstance(topic, str) else topic:
+            self.subscribe(subscription)
         self.client.connect(host=host, port=port, keepalive=60)
         self.client.loop_start()
 
     def __exit__(self):
         self.client.loop_stop()
 
+    @property
+    def state(self):
+        # Latest payload on the first subscription, 0 until there is one
+        topic = self.store.latest_topic(self.topics[0]) if self.topics else None
+        state = self.store.get(topic) if topic is not None else None
+        return 0 if state is None else state
+
+    def subscribe(self, topic: str) -> None:
+        # Subscriptions made before the connection is up are sent by on_connect()
+        if topic not in self.topics:
+            self.topics.append(topic)
+            if self.client.is_connected():
+                self.client.subscribe(topic, 0)
+
     # The callback for when the client receives a CONNACK response from the server.
     def on_connect(self, client, userdata, flags, rc):
         # Subscribing in on_connect() means that if we lose the connection and
         # reconnect then subscriptions will be renewed.
-        self.client.subscribe(self.topic, 0)
+        if self.topics:
+            self.client.subscribe([(topic, 0) for topic in self.topics])
 
     # The callback for when a PUBLISH message is received from the server.
     def on_message(self, client, userdata, msg):
-        # Decode the payload from bytes to a string
-        payload_string = str(msg.payload.decode("utf-8"))
-
-        # Parse the JSON string into a Python dictionary
-        self.state = json.loads(payload_string)
+        # Only keep the raw payload, it's decoded when read
+        self.store.put(msg.topic, msg.payload)
@@ -1,14 +1,33 @@
-import copy
+import argparse
+import bisect
+import fcntl
+import functools
+import glob
+import gzip
 import json
 import logging
+import math
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from datetime import timedelta
+from datetime import timezone
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
 
 import arrow
+import numpy as np
+import requests
 from dateutil import tz
 from pyowm import OWM
 from pyowm.utils.config import get_default_config
+from pyowm.weatherapi25.weather import Weather
+from urllib3.util.retry import Retry
+
+import artifacts
+
 
 ## Configure logger instance for local logging
 logging.root.handlers = []
@@ -25,43 +44,47 @@ logger.addHandler(stream_handler)
 _HERE = os.path.dirname(__file__)
 with open(os.path.join(_HERE, "config.json"), "r") as configfile:
     config = json.load(configfile)
-tz_zone = tz.gettz(config["tz"])
-locale = config["locale"]
-language = locale.split("_")[0]
 historydir = os.path.join("history")
-keep_history = bool(config["history"])
-wind_units = config["wind_units"]
-temp_units = config["temp_units"]
 
+OWM_API_URL = "https://api.openweathermap.org/data/2.5"
+REQUEST_TIMEOUT = 10
+KELVIN_OFFSET = 273.15
+# Upper limits (m/s) of the Beaufort levels 0-11 and factors for the other units, as pyowm converts them
+BEAUFORT_LIMITS = [0.2, 1.5, 3.3, 5.4, 7.9, 10.7, 13.8, 17.1, 20.7, 24.4, 28.4, 32.6]
+WIND_FACTORS = {"miles_hour": 2.23694, "km_hour": 3.6, "knots": 1.94384}
+KM_PER_DEGREE = 111.32
+# Seconds between two forecast timings
+FORECAST_STEP = 3 * 3600
+# Columns of the forecast table kept in the forecast store
+STORE_FIELDS = ("temp", "temp_min", "temp_max", "precip_3h_mm", "wind", "wind_gust", "icon")
 
-def saveToFile(data):
-    try:
-        with open(
-            os.path.join(historydir, f"{datetime.now().strftime('openweather_%Y-%m-%d_%H-%M-%S')}.json"),
-            "w",
-        ) as outfile:
-            json.dump(data, outfile, indent=4)
-    except:
-        logger.error("Error while writing openweather response to file.")
+_session = None
+_session_pid = None
 
 
-def is_timestamp_within_range(timestamp, start_time, end_time):
-    # Check if the timestamp is within the range
-    return start_time <= timestamp <= end_time
+def apply_settings(settings: dict) -> None:
+    """Applies the given settings (same keys as config.json) to this module"""
+    global tz_zone, locale, language, keep_history, wind_units, temp_units, transport, grid_km, cache_seconds
+    tz_zone = tz.gettz(settings["tz"])
+    locale = settings["locale"]
+    language = locale.split("_")[0]
+    keep_history = bool(settings["history"])
+    wind_units = settings["wind_units"]
+    temp_units = settings["temp_units"]
+    transport = settings.get("owm_transport", "pyowm")
+    grid_km = settings.get("owm_grid_km", 0)
+    cache_seconds = settings.get("owm_cache_seconds", 600)
 
 
-def get_owm_data(lat, lon, token):
-    config_dict = get_default_config()
-    config_dict["language"] = language
+apply_settings(config)
 
-    owm = OWM(token, config_dict)
 
-    mgr = owm.weather_manager()
+def is_timestamp_within_range(timestamp, start_time, end_time):
+    # Check if the timestamp is within the range
+    return start_time <= timestamp <= end_time
 
-    current_observation = mgr.weather_at_coords(lat=lat, lon=lon)
-    current_weather = current_observation.weather
-    hourly_forecasts = mgr.forecast_at_coords(lat=lat, lon=lon, interval="3h")
 
+def _forecast_timings() -> list:
     # Forecasts are provided for every 3rd full hour
     # - find out how many hours there are until the next 3rd full hour
     now = arrow.utcnow()
@@ -72,46 +95,599 @@ def get_owm_data(lat, lon, token):
 
     # Create timings for hourly forcasts
     steps = [i * 3 for i in range(40)]
-    forecast_timings = [now.shift(hours=+hour_gap + step).floor("hour") for step in steps]
+    return [now.shift(hours=+hour_gap + step).floor("hour") for step in steps]
+
+
+def fetch_si_pyowm(lat, lon, token, language: str = None) -> tuple:
+    """
+    Fetches the current weather and the forecasts for the upcoming timings with pyowm
+    :return:
+        Tuple of pyowm's current weather and the forecast table, see to_hourly_forecasts()
+    """
+    config_dict = get_default_config()
+    config_dict["language"] = globals()["language"] if language is None else language
+
+    owm = OWM(token, config_dict)
+
+    mgr = owm.weather_manager()
+
+    current_observation = mgr.weather_at_coords(lat=lat, lon=lon)
+    current_weather = current_observation.weather
+    hourly_forecasts = mgr.forecast_at_coords(lat=lat, lon=lon, interval="3h")
+
+    forecast_timings = _forecast_timings()
 
     # Create forecast objects for given timings
     forecasts = [hourly_forecasts.get_weather_at(forecast_time.datetime) for forecast_time in forecast_timings]
 
-    # Add forecast-data to fc_data list of dictionaries
-    hourly_data_dict = []
-    for forecast in forecasts:
-        temp = forecast.temperature(unit=temp_units)["temp"]
-        min_temp = forecast.temperature(unit=temp_units)["temp_min"]
-        max_temp = forecast.temperature(unit=temp_units)["temp_max"]
-        wind = forecast.wind(unit=wind_units)["speed"]
-        wind_gust = forecast.wind(unit=wind_units)["gust"]
+    rows = []
+    for forecast_time, forecast in zip(forecast_timings, forecasts):
+        temperature = forecast.temperature(unit="kelvin")
+        wind = forecast.wind(unit="meters_sec")
         # combined precipitation (snow + rain)
         precip_mm = 0.0
         if "3h" in forecast.rain.keys():
             precip_mm = +forecast.rain["3h"]
         if "3h" in forecast.snow.keys():
             precip_mm = +forecast.snow["3h"]
+        rows.append(
+            (
+                forecast_time.int_timestamp,
+                temperature["temp"],
+                temperature.get("temp_min"),
+                temperature.get("temp_max"),
+                precip_mm,
+                wind.get("speed"),
+                wind.get("gust"),
+                forecast.weather_icon_name,
+            )
+        )
 
-        icon = forecast.weather_icon_name
-        hourly_data_dict.append(
-            {
-                "temp": temp,
-                "min_temp": min_temp,
-                "max_temp": max_temp,
-                "precip_3h_mm": precip_mm,
-                "wind": wind,
-                "wind_gust": wind_gust,
-                "icon": icon,
-                "datetime": forecast_timings[forecasts.index(forecast)].datetime.astimezone(tz=tz_zone),
-            }
+    return (current_weather, _forecast_table(rows))
+
+
+def get_owm_data_pyowm(lat, lon, token):
+    (current_weather, table) = fetch_si_pyowm(lat=lat, lon=lon, token=token)
+    return (current_weather, to_hourly_forecasts(table, temp_units=temp_units, wind_units=wind_units, tz_zone=tz_zone))
+
+
+def _forecast_table(rows: list) -> dict:
+    # Columns of the forecast rows, numbers as arrays with NaN for missing values
+    columns = list(zip(*rows))
+    table = {"timestamp": np.array(columns[0], dtype=np.int64), "icon": list(columns[7])}
+    for index, name in enumerate(("temp", "temp_min", "temp_max", "precip_3h_mm", "wind", "wind_gust"), start=1):
+        table[name] = np.array([np.nan if value is None else value for value in columns[index]], dtype=np.float64)
+    return table
+
+
+def _to_list(values: np.ndarray, missing: np.ndarray) -> list:
+    return [None if is_missing else value for value, is_missing in zip(values.tolist(), missing.tolist())]
+
+
+def convert_temperatures(kelvin: np.ndarray, unit: str) -> list:
+    """Converts an array of temperatures like convert_temperature() does, with the same result for every value"""
+    missing = np.isnan(kelvin)
+    if unit == "kelvin":
+        return _to_list(kelvin, missing)
+    if unit == "celsius":
+        converted = kelvin - KELVIN_OFFSET
+    elif unit == "fahrenheit":
+        converted = (kelvin - KELVIN_OFFSET) * 1.8 + 32.0
+    else:
+        raise ValueError(f"Invalid temperature unit {unit}")
+    # Rounded by formatting like pyowm, np.round() scales by 100 first and can end up 0.01 off
+    return [
+        None if is_missing else value if value < 0 else float(f"{temperature:.2f}")
+        for value, temperature, is_missing in zip(kelvin.tolist(), converted.tolist(), missing.tolist())
+    ]
+
+
+def convert_winds(speed: np.ndarray, unit: str) -> list:
+    """Converts an array of wind speeds in m/s like convert_wind() does"""
+    missing = np.isnan(speed)
+    if unit == "meters_sec":
+        return _to_list(speed, missing)
+    if unit == "beaufort":
+        return _to_list(np.searchsorted(BEAUFORT_LIMITS, np.nan_to_num(speed), side="left"), missing)
+    if unit in WIND_FACTORS:
+        return _to_list(speed * WIND_FACTORS[unit], missing)
+    raise ValueError(f"Invalid wind unit {unit}")
+
+
+def to_hourly_forecasts(table: dict, temp_units: str, wind_units: str, tz_zone) -> list:
+    """
+    Converts the forecast table (Kelvin, m/s, UTC timestamps) for a site, a whole column at a time
+    :return:
+        List of hourly forecast dicts in the given units and time zone
+    """
+    columns = {
+        "temp": convert_temperatures(table["temp"], temp_units),
+        "min_temp": convert_temperatures(table["temp_min"], temp_units),
+        "max_temp": convert_temperatures(table["temp_max"], temp_units),
+        "precip_3h_mm": table["precip_3h_mm"].tolist(),
+        "wind": convert_winds(table["wind"], wind_units),
+        "wind_gust": convert_winds(table["wind_gust"], wind_units),
+        "icon": table["icon"],
+        "datetime": [datetime.fromtimestamp(timestamp, tz=timezone.utc).astimezone(tz=tz_zone) for timestamp in table["timestamp"].tolist()],
+    }
+    return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+
+def convert_temperature(kelvin, unit: str):
+    # Same conversion and rounding as pyowm, negative values are deltas (temp_kf) and stay as they are
+    if kelvin is None or kelvin < 0 or unit == "kelvin":
+        return kelvin
+    if unit == "celsius":
+        return float(f"{kelvin - KELVIN_OFFSET:.2f}")
+    if unit == "fahrenheit":
+        return float(f"{(kelvin - KELVIN_OFFSET) * 1.8 + 32.0:.2f}")
+    raise ValueError(f"Invalid temperature unit {unit}")
+
+
+def convert_wind(speed, unit: str):
+    # Same conversion as pyowm, speed in m/s
+    if speed is None or unit == "meters_sec":
+        return speed
+    if unit == "beaufort":
+        return bisect.bisect_left(BEAUFORT_LIMITS, speed)
+    if unit in WIND_FACTORS:
+        return speed * WIND_FACTORS[unit]
+    raise ValueError(f"Invalid wind unit {unit}")
+
+
+class CurrentWeather:
+    """
+    Current weather parsed straight from the JSON of OWM's weather endpoint
+    Offers the parts of pyowm's Weather the dashboard uses, temperatures in Kelvin and wind in m/s like pyowm.
+    """
+
+    __slots__ = ("ref_time", "detailed_status", "weather_icon_name", "humidity", "uvi", "temp", "wnd", "rain", "snow")
+
+    def __init__(self, the_dict: dict):
+        weather = the_dict.get("weather") or [{}]
+        main = the_dict.get("main", {})
+        self.ref_time = the_dict.get("dt", 0)
+        self.detailed_status = weather[0].get("description", "")
+        self.weather_icon_name = weather[0].get("icon", "")
+        self.humidity = main.get("humidity", 0)
+        self.uvi = the_dict.get("uvi")
+        self.temp = {key: main.get(key) for key in ("temp", "temp_kf", "temp_max", "temp_min", "feels_like")}
+        self.wnd = dict(the_dict.get("wind") or {})
+        self.rain = dict(the_dict.get("rain") or {})
+        self.snow = dict(the_dict.get("snow") or {})
+
+    def reference_time(self) -> int:
+        return self.ref_time
+
+    def temperature(self, unit: str = "kelvin") -> dict:
+        return {label: convert_temperature(temp, unit) for label, temp in self.temp.items()}
+
+    def wind(self, unit: str = "meters_sec") -> dict:
+        return {key: value if key == "deg" else convert_wind(value, unit) for key, value in self.wnd.items() if value is not None}
+
+    def to_dict(self) -> dict:
+        return {
+            "reference_time": self.ref_time,
+            "rain": self.rain,
+            "snow": self.snow,
+            "wind": self.wnd,
+            "humidity": self.humidity,
+            "temperature": self.temp,
+            "detailed_status": self.detailed_status,
+            "weather_icon_name": self.weather_icon_name,
+            "uvi": self.uvi,
+        }
+
+
+def get_session():
+    """Returns the HTTP session of this process, its connections to OWM are kept alive between requests"""
+    global _session, _session_pid
+    if _session is None or _session_pid != os.getpid():
+        # A forked process must not share the sockets of its parent
+        _session = requests.Session()
+        _session.headers.update({"Accept-Encoding": "gzip", "User-Agent": "waveshare-epd-weather-dashboard"})
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=4, max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504])
+        )
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+        _session_pid = os.getpid()
+    return _session
+
+
+def _get_json(api_url: str, endpoint: str, lat, lon, token, language: str = None) -> dict:
+    response = get_session().get(
+        f"{api_url}/{endpoint}",
+        params={"lat": lat, "lon": lon, "appid": token, "lang": globals()["language"] if language is None else language},
+        timeout=REQUEST_TIMEOUT,
+    )
+    response.raise_for_status()
+    return response.json()
+
+
+def fetch_si_rest(lat, lon, token, language: str = None, api_url: str = OWM_API_URL) -> tuple:
+    """
+    Fetches the current weather and the forecasts for the upcoming timings from the REST endpoints
+    :return:
+        Tuple of the current weather and the forecast table, see to_hourly_forecasts()
+    """
+    current_weather = CurrentWeather(_get_json(api_url, "weather", lat, lon, token, language))
+    items = _get_json(api_url, "forecast", lat, lon, token, language)["list"]
+
+    rows = []
+    for forecast_time in _forecast_timings():
+        # Closest forecast in time, the first one on ties like pyowm's get_weather_at()
+        timestamp = forecast_time.int_timestamp
+        item = min(items, key=lambda item: abs(item["dt"] - timestamp))
+        main = item["main"]
+        wind = item.get("wind", {})
+        # combined precipitation (snow + rain), the same way as with pyowm
+        precip_mm = 0.0
+        if "3h" in (item.get("rain") or {}):
+            precip_mm = +item["rain"]["3h"]
+        if "3h" in (item.get("snow") or {}):
+            precip_mm = +item["snow"]["3h"]
+        rows.append(
+            (timestamp, main["temp"], main.get("temp_min"), main.get("temp_max"), precip_mm, wind.get("speed"), wind.get("gust"), item["weather"][0]["icon"])
         )
 
+    return (current_weather, _forecast_table(rows))
+
+
+def get_owm_data_rest(lat, lon, token, api_url: str = OWM_API_URL):
+    (current_weather, table) = fetch_si_rest(lat=lat, lon=lon, token=token, api_url=api_url)
+    return (current_weather, to_hourly_forecasts(table, temp_units=temp_units, wind_units=wind_units, tz_zone=tz_zone))
+
+
+def grid_cell(lat, lon, grid_km: float) -> tuple:
+    """Returns the centre of the grid cell the coordinates lie in, the coordinates themselves without a grid"""
+    lat, lon = float(lat), float(lon)
+    if not grid_km:
+        return (lat, lon)
+    lat_step = grid_km / KM_PER_DEGREE
+    cell_lat = (math.floor(lat / lat_step) + 0.5) * lat_step
+    # Cells keep their width in km towards the poles
+    lon_step = grid_km / (KM_PER_DEGREE * max(math.cos(math.radians(cell_lat)), 0.01))
+    cell_lon = (math.floor(lon / lon_step) + 0.5) * lon_step
+    return (round(cell_lat, 4), round(cell_lon, 4))
+
+
+class FetchCache:
+    """
+    Weather data in SI units per grid cell and language, shared by all sites of a process
+    Sites in the same cell only differ in units, time zone or how they are drawn, so the data is fetched once per
+    cell and converted for every site. Entries older than max_age seconds are fetched again.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.fetches = 0
+
+    def get(self, key: tuple, fetch, max_age: float):
+        with self._lock:
+            self.requests += 1
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] < max_age:
+                return entry[1]
+            self.fetches += 1
+        data = fetch()
+        with self._lock:
+            self._entries[key] = (time.time(), data)
+        return data
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.requests - self.fetches
+            return {
+                "requests": self.requests,
+                "fetches": self.fetches,
+                "hit_rate": hits / self.requests if self.requests else 0.0,
+                "api_calls_saved": hits * 2,
+            }
+
+
+_fetch_cache = FetchCache()
+_stores = {}
+# UTC timestamp the dashboard is drawn for instead of the current time, set when re-rendering the history
+render_time = None
+
+
+def fetch_si(lat, lon, token, language: str = None) -> tuple:
+    """
+    Returns current weather and forecast table of the grid cell of the coordinates, fetched at the cell's centre
+    once per owm_cache_seconds with the configured transport
+    """
+    language = globals()["language"] if language is None else language
+    (cell_lat, cell_lon) = grid_cell(lat, lon, grid_km)
+    fetch = functools.partial(
+        fetch_si_rest if transport == "rest" else fetch_si_pyowm, lat=cell_lat, lon=cell_lon, token=token, language=language
+    )
+    if not cache_seconds:
+        return fetch()
+    return _fetch_cache.get((cell_lat, cell_lon, language, transport), fetch, max_age=cache_seconds)
+
+
+def prefetch(locations: list, token, workers: int = 4) -> dict:
+    """
+    Fetches the data of every grid cell the locations fall into, once per cell and concurrently
+    :param locations:
+        List of (lat, lon, language) tuples
+    :return:
+        Dict of the number of locations, fetches and the share of locations served by another location's fetch
+    """
+    cells = {}
+    for lat, lon, language in locations:
+        cells.setdefault(grid_cell(lat, lon, grid_km) + (language,), (lat, lon, language))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(fetch_si, lat, lon, token, language) for lat, lon, language in cells.values()]:
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Prefetching weather data failed: {e!r}")
+    shared = len(locations) - len(cells)
+    return {
+        "requests": len(locations),
+        "fetches": len(cells),
+        "hit_rate": shared / len(locations) if locations else 0.0,
+        "api_calls_saved": shared * 2,
+    }
+
+
+def fetch_stats() -> dict:
+    """Requests for weather data of this process, fetches they needed and the share served from the cache"""
+    return _fetch_cache.stats()
+
+
+class ForecastStore:
+    """
+    Forecast history of a location as a table indexed by the forecast timestamps
+    Successive forecasts mostly overlap, so every fetch (issue) only adds the values that differ from the latest
+    known ones to an append-only JSON lines file, together with the window of timestamps it covered and the current
+    weather observed at the time. Values are kept in Kelvin, m/s and mm like the forecast table, so the history
+    doesn't depend on the configured units.
+    Several processes may merge into the same file, it is locked while appending and lines added by others are read first.
+    get_store() starts a new file every month, so loading the store stays bounded; the first issue of a month is
+    stored in full.
+    """
+
+    def __init__(self, path: str = None):
+        self.path = path
+        # Issue time, first timestamp and number of timestamps of every merged forecast, oldest first
+        self.issues = []
+        # Changed values of every issue, {timestamp: {field: value}}
+        self.changes = []
+        # Current weather observed with the issues, see observation()
+        self.observations = []
+        # Timestamp -> field -> (issue times, values) of all revisions of the value
+        self._revisions = {}
+        self._offset = 0
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path, "rb") as storefile:
+                self._sync(storefile)
+
+    def _apply(self, entry: dict) -> None:
+        issued = entry["issued"]
+        changes = {int(timestamp): values for timestamp, values in entry["changes"].items()}
+        for timestamp, values in changes.items():
+            revisions = self._revisions.setdefault(timestamp, {})
+            for field, value in values.items():
+                (times, field_values) = revisions.setdefault(field, ([], []))
+                times.append(issued)
+                field_values.append(value)
+        self.issues.append((issued, *entry["window"]))
+        self.changes.append(changes)
+        if entry.get("observed"):
+            self.observations.append(entry["observed"])
+
+    def _sync(self, storefile) -> None:
+        # Applies the lines appended since the last read, a partly written last line is left for later
+        storefile.seek(self._offset)
+        data = storefile.read()
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            if line:
+                self._apply(json.loads(line))
+        self._offset += end
+
+    def _value(self, timestamp: int, field: str, issued: float = None):
+        # Value of the field as known at the issue time, the latest one without
+        (times, values) = self._revisions.get(timestamp, {}).get(field, ((), ()))
+        index = len(times) if issued is None else bisect.bisect_right(times, issued)
+        return values[index - 1] if index else None
+
+    def diff(self, table: dict) -> dict:
+        """Returns the values of the forecast table which differ from the latest known ones, {timestamp: {field: value}}"""
+        changes = {}
+        columns = {field: table[field] if field == "icon" else _to_list(table[field], np.isnan(table[field])) for field in STORE_FIELDS}
+        for index, timestamp in enumerate(table["timestamp"].tolist()):
+            values = {field: columns[field][index] for field in STORE_FIELDS}
+            changed = {field: value for field, value in values.items() if value != self._value(timestamp, field)}
+            if changed:
+                changes[timestamp] = changed
+        return changes
+
+    def merge(self, table: dict, issued: float = None, observed: dict = None) -> dict:
+        """
+        Adds a forecast table, only its changed values are stored
+        :param issued:
+            Time the forecast was fetched, now if not given
+        :param observed:
+            Current weather fetched with the forecast, see observation()
+        :return:
+            The changed values, {timestamp: {field: value}}
+        """
+        timestamps = table["timestamp"]
+        if len(timestamps) > 1 and np.any(np.diff(timestamps) != FORECAST_STEP):
+            raise ValueError(f"Forecast timings have to be {FORECAST_STEP} s apart.")
+        window = [int(timestamps[0]), len(timestamps)] if len(timestamps) else [0, 0]
+        issued = int(time.time() if issued is None else issued)
+        with self._lock:
+            if self.path is None:
+                return self._merge(table, issued, window, observed, None)
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "a+b") as storefile:
+                fcntl.flock(storefile, fcntl.LOCK_EX)
+                try:
+                    self._sync(storefile)
+                    return self._merge(table, issued, window, observed, storefile)
+                finally:
+                    fcntl.flock(storefile, fcntl.LOCK_UN)
+
+    def _merge(self, table: dict, issued: int, window: list, observed: dict, storefile) -> dict:
+        changes = self.diff(table)
+        if observed is not None and self.observations and observed["time"] <= self.observations[-1]["time"]:
+            observed = None
+        if not changes and observed is None and self.issues and list(self.issues[-1][1:]) == window:
+            # Same forecast as the latest one, e.g. another site of the same grid cell
+            return changes
+        entry = {"issued": max(issued, self.issues[-1][0] if self.issues else issued), "window": window, "changes": changes}
+        if observed is not None:
+            entry["observed"] = observed
+        if storefile is not None:
+            line = (json.dumps(entry, separators=(",", ":")) + "\n").encode("utf-8")
+            storefile.write(line)
+            storefile.flush()
+            self._offset += len(line)
+        self._apply(entry)
+        return changes
+
+    @property
+    def issued(self):
+        """Issue time of the latest forecast, None if there is none"""
+        return self.issues[-1][0] if self.issues else None
+
+    def table(self, issued: float = None) -> dict:
+        """Returns the forecast table of the latest issue at or before the given time (default: the latest issue)"""
+        times = [issue[0] for issue in self.issues]
+        index = len(times) if issued is None else bisect.bisect_right(times, issued)
+        if not index:
+            raise LookupError(f"No forecast issued before {issued}.")
+        (issue_time, start, count) = self.issues[index - 1]
+        rows = []
+        for timestamp in range(start, start + count * FORECAST_STEP, FORECAST_STEP):
+            rows.append((timestamp, *(self._value(timestamp, field, issue_time) for field in STORE_FIELDS)))
+        return _forecast_table(rows)
+
+    def snapshots(self):
+        """Yields issue time and forecast table of every issue, oldest first, by replaying the changes once"""
+        latest = {}
+        for (issued, start, count), changes in zip(self.issues, self.changes):
+            for timestamp, values in changes.items():
+                latest.setdefault(timestamp, {}).update(values)
+            timestamps = range(start, start + count * FORECAST_STEP, FORECAST_STEP)
+            yield issued, _forecast_table([(timestamp, *(latest.get(timestamp, {}).get(field) for field in STORE_FIELDS)) for timestamp in timestamps])
+
+    def changed_since(self, issued: float) -> dict:
+        """
+        Returns the values of the latest forecast that changed after the given issue time, e.g. of the last render
+        :return:
+            Dict of timestamp to the dict of changed fields and their latest values
+        """
+        if not self.issues:
+            return {}
+        (_, start, count) = self.issues[-1]
+        changed = {}
+        for timestamp in range(start, start + count * FORECAST_STEP, FORECAST_STEP):
+            revisions = self._revisions.get(timestamp, {})
+            values = {field: field_values[-1] for field, (times, field_values) in revisions.items() if times[-1] > issued}
+            if values:
+                changed[timestamp] = values
+        return changed
+
+    def stats(self) -> dict:
+        """Number of issues and stored values, and bytes per issue against storing every forecast in full"""
+        stored = sum(len(values) for changes in self.changes for values in changes.values())
+        full = sum(count for (_, _, count) in self.issues) * len(STORE_FIELDS)
+        size = os.path.getsize(self.path) if self.path is not None and os.path.exists(self.path) else 0
+        return {
+            "issues": len(self.issues),
+            "timestamps": len(self._revisions),
+            "stored_values": stored,
+            "full_values": full,
+            "stored_share": stored / full if full else 0.0,
+            "bytes": size,
+            "bytes_per_issue": size / len(self.issues) if self.issues else 0.0,
+        }
+
+
+def observation(current_weather) -> dict:
+    """
+    Returns the parts of the current weather the forecast accuracy is measured against and the dashboard shows
+    :return:
+        Dict of time (UTC timestamp), temp and feels_like (Kelvin), precip_1h_mm (rain and snow of the last hour),
+        icon, status and humidity
+    """
+    precip_mm = 0.0
+    for amounts in (current_weather.rain, current_weather.snow):
+        if "1h" in amounts:
+            precip_mm += amounts["1h"]
+        elif "3h" in amounts:
+            precip_mm += amounts["3h"] / 3
+    temperature = current_weather.temperature("kelvin")
+    return {
+        "time": int(current_weather.reference_time()),
+        "temp": temperature["temp"],
+        "feels_like": temperature.get("feels_like"),
+        "precip_1h_mm": precip_mm,
+        "icon": current_weather.weather_icon_name,
+        "status": current_weather.detailed_status,
+        "humidity": current_weather.humidity,
+    }
+
+
+def now() -> datetime:
+    """Returns the local time the dashboard is drawn for, the current time unless render_time is set"""
+    return datetime.now() if render_time is None else datetime.fromtimestamp(render_time)
+
+
+def store_path(lat, lon, issued: float = None) -> str:
+    """Returns the forecast store file of the grid cell of the coordinates for the month of the issue time (default: now)"""
+    (cell_lat, cell_lon) = grid_cell(lat, lon, grid_km)
+    month = time.strftime("%Y-%m", time.gmtime(time.time() if issued is None else issued))
+    return os.path.join(historydir, f"forecasts_{cell_lat}_{cell_lon}_{month}.jsonl")
+
+
+def store_paths(lat, lon, directory: str = None) -> list:
+    """Returns all forecast store files of the grid cell of the coordinates, oldest first"""
+    (cell_lat, cell_lon) = grid_cell(lat, lon, grid_km)
+    directory = historydir if directory is None else directory
+    # Files written before the monthly files have no month and come first
+    paths = glob.glob(os.path.join(directory, f"forecasts_{cell_lat}_{cell_lon}.jsonl"))
+    return paths + sorted(glob.glob(os.path.join(directory, f"forecasts_{cell_lat}_{cell_lon}_*.jsonl")))
+
+
+def get_store(lat, lon, issued: float = None) -> ForecastStore:
+    """Returns the forecast store of the coordinates' grid cell for the month of the issue time (default: now), loaded on first use"""
+    path = store_path(lat, lon, issued)
+    cell = grid_cell(lat, lon, grid_km)
+    if cell not in _stores or _stores[cell].path != path:
+        # The store of the previous month is no longer merged into
+        _stores[cell] = ForecastStore(path)
+    return _stores[cell]
+
+
+def _merge_history(lat, lon, table: dict, issued: float, observed: dict) -> None:
+    # Runs on the artifacts writer thread, so loading and locking the store never delays the fetch
+    try:
+        changes = get_store(lat, lon, issued).merge(table, issued=issued, observed=observed)
+        logger.debug(f"Forecast history: {sum(len(values) for values in changes.values())} values changed")
+    except (OSError, ValueError) as e:
+        # The history must never keep the dashboard from updating
+        logger.error(f"Adding the forecast to the history failed: {e!r}")
+
+
+def get_owm_data(lat, lon, token):
+    (current_weather, table) = fetch_si(lat=lat, lon=lon, token=token)
+    hourly_data_dict = to_hourly_forecasts(table, temp_units=temp_units, wind_units=wind_units, tz_zone=tz_zone)
+
     if keep_history == True:
-        history_data_dict = copy.deepcopy(hourly_data_dict)
-        # convert datetime to isoformat for json dump
-        for item in history_data_dict:
-            item["datetime"] = item["datetime"].isoformat()
-        saveToFile(history_data_dict)
+        observed = observation(current_weather)
+        artifacts.get_writer().call("forecast history", functools.partial(_merge_history, lat, lon, table, time.time(), observed))
 
     return (current_weather, hourly_data_dict)
 
@@ -121,7 +697,7 @@ def get_forecast_for_day(days_from_today: int, hourly_forecasts: list) -> dict:
     days_from_today should be int from 0-4: e.g. 2 -> 2 days from today
     """
     # Calculate the start and end times for the specified number of days from now
-    current_time = datetime.now()
+    current_time = now()
     start_time = (
         (current_time + timedelta(days=days_from_today))
         .replace(hour=0, minute=0, second=0, microsecond=0)
@@ -151,8 +727,8 @@ def get_forecast_for_day(days_from_today: int, hourly_forecasts: list) -> dict:
     icons = [f["icon"] for f in forecasts]
     day_icons = [icon for icon in icons if "d" in icon]
     
-    # Use the day icons if possible
-    icon = max(set(day_icons), key=icons.count) if len(day_icons) > 0 else max(set(icons), key=icons.count)
+    # Use the day icons if possible, ties go to the earliest icon so the result is the same in every process
+    icon = max(dict.fromkeys(day_icons or icons), key=icons.count)
 
     # Return a dict with that day's data
     day_data = {
@@ -164,3 +740,143 @@ def get_forecast_for_day(days_from_today: int, hourly_forecasts: list) -> dict:
     }
 
     return day_data
+
+
+def _stand_in_responses() -> dict:
+    # Synthetic answers of the weather and forecast endpoints, in Kelvin and m/s like the real ones
+    now = datetime.now(tz=timezone.utc).replace(minute=0, second=0, microsecond=0)
+    start = int(now.timestamp()) - (now.hour % 3) * 3600
+    forecast = []
+    for i in range(1, 41):
+        forecast.append(
+            {
+                "dt": start + i * 3 * 3600,
+                "main": {"temp": 283.15 + i % 7, "feels_like": 282.0, "temp_min": 281.15, "temp_max": 285.15, "temp_kf": -0.5, "humidity": 70},
+                "weather": [{"id": 500, "main": "Rain", "description": "light rain", "icon": "10d" if i % 8 < 4 else "04n"}],
+                "wind": {"speed": 1.0 + i % 9, "deg": 200, "gust": 3.0 + i % 11},
+                "rain": {"3h": 0.4 * (i % 3)} if i % 3 else {},
+                "dt_txt": datetime.fromtimestamp(start + i * 3 * 3600, tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+            }
+        )
+    weather = {
+        "dt": int(now.timestamp()),
+        "main": {"temp": 284.2, "feels_like": 283.1, "temp_min": 283.0, "temp_max": 285.0, "humidity": 71},
+        "weather": [{"id": 500, "main": "Rain", "description": "light rain", "icon": "10d"}],
+        "wind": {"speed": 3.6, "deg": 220, "gust": 7.2},
+        "rain": {"1h": 0.3},
+        "coord": {"lat": 0, "lon": 0},
+        "sys": {"country": "", "sunrise": int(now.timestamp()), "sunset": int(now.timestamp())},
+        "id": 0,
+        "name": "Stand-in",
+    }
+    city = {"id": 0, "name": "Stand-in", "coord": {"lat": 0, "lon": 0}, "country": "", "timezone": 0}
+    return {
+        "weather": json.dumps(weather).encode("utf-8"),
+        "forecast": json.dumps({"cod": "200", "cnt": len(forecast), "list": forecast, "city": city}).encode("utf-8"),
+    }
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    """Answers the weather and forecast endpoints with canned data, also when used as an HTTP proxy"""
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, don't let delayed ACKs stall kept-alive connections
+    disable_nagle_algorithm = True
+    responses_by_endpoint = {}
+    stats = {"connections": 0, "requests": 0, "bytes": 0}
+
+    def setup(self):
+        super().setup()
+        self.stats["connections"] += 1
+
+    def do_GET(self):
+        endpoint = self.path.split("?")[0].rstrip("/").rsplit("/", 1)[-1]
+        body = self.responses_by_endpoint.get(endpoint)
+        if body is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.stats["requests"] += 1
+        self.stats["bytes"] += len(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def benchmark(repeat: int = 20) -> dict:
+    """
+    Fetches the weather data from a local stand-in server with both transports
+    pyowm is routed to the server as its HTTP proxy, so it runs its usual code path without TLS.
+    :return:
+        Dict of transport to mean seconds per fetch, connections opened and bytes received
+    """
+    global keep_history
+    StandInRequestHandler.responses_by_endpoint = _stand_in_responses()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInRequestHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    stand_in_url = f"http://127.0.0.1:{server.server_port}"
+
+    original_get_default_config = globals()["get_default_config"]
+
+    def get_stand_in_config():
+        config_dict = original_get_default_config()
+        config_dict["connection"]["use_ssl"] = False
+        config_dict["connection"]["use_proxy"] = True
+        config_dict["proxies"] = {"http": stand_in_url, "https": stand_in_url}
+        return config_dict
+
+    fetches = {
+        "pyowm": lambda: get_owm_data_pyowm(lat=0, lon=0, token="stand-in"),
+        "rest": lambda: get_owm_data_rest(lat=0, lon=0, token="stand-in", api_url=f"{stand_in_url}/data/2.5"),
+    }
+    keep_history, original_keep_history = False, keep_history
+    globals()["get_default_config"] = get_stand_in_config
+    results = {}
+    data = {}
+    try:
+        for name, fetch in fetches.items():
+            StandInRequestHandler.stats.update(connections=0, requests=0, bytes=0)
+            start = time.perf_counter()
+            for _ in range(repeat):
+                data[name] = fetch()
+            results[name] = dict(seconds=(time.perf_counter() - start) / repeat, **StandInRequestHandler.stats)
+    finally:
+        globals()["get_default_config"] = original_get_default_config
+        keep_history = original_keep_history
+        server.shutdown()
+
+    # Both transports have to deliver the same forecast, with the temperatures pyowm itself converts to
+    forecasts = json.loads(StandInRequestHandler.responses_by_endpoint["forecast"])["list"]
+    pyowm_temperatures = {item["dt"]: Weather.from_dict(item).temperature(temp_units) for item in forecasts}
+    results["identical"] = (
+        data["pyowm"][1] == data["rest"][1]
+        and data["pyowm"][0].temperature(temp_units) == data["rest"][0].temperature(temp_units)
+        and all(
+            (forecast["temp"], forecast["min_temp"], forecast["max_temp"])
+            == tuple(pyowm_temperatures[int(forecast["datetime"].timestamp())][key] for key in ("temp", "temp_min", "temp_max"))
+            for forecast in data["rest"][1]
+        )
+    )
+    return results
+
+
+if __name__ == "__main__":
+    # Compares the pyowm and the rest transport, run as: python3 owm_forecasts.py --repeat 20
+    parser = argparse.ArgumentParser(description="Benchmarks the OWM transports against a local stand-in server.")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    results = benchmark(repeat=args.repeat)
+    for name in ("pyowm", "rest"):
+        result = results[name]
+        logger.info(
+            f"{name}: {result['seconds'] * 1000:.1f} ms per fetch, {result['connections']} connections "
+            f"for {result['requests']} requests, {result['bytes'] / max(result['requests'], 1) / 1024:.1f} KiB per response"
+        )
+    logger.info(f"Identical forecast data: {results['identical']}")
@@ -0,0 +1,140 @@
+#!/usr/bin/python
+import argparse
+import json
+import logging
+import os
+import time
+
+import frame_archive
+import framebuffer
+
+logger = logging.getLogger(__name__)
+
+## Paths config
+_HERE = os.path.dirname(os.path.realpath(__file__))
+
+
+def framebuffer_path(path: str = None) -> str:
+    """Returns the frame buffer file, framebuffer of config.json if not given, relative paths are relative to the repository"""
+    if not path:
+        with open(os.path.join(_HERE, "config.json"), "r") as configfile:
+            path = json.load(configfile).get("framebuffer") or "cache/framebuffer"
+    return os.path.join(_HERE, path)
+
+
+def paint(epd, black: bytes, red: bytes) -> None:
+    """Sends packed planes (see epd_image.pack_bitplanes()) to the panel and refreshes it"""
+    epd.send_command(0x10)
+    epd.send_data2(black)
+    epd.send_command(0x13)
+    epd.send_data2(red)
+    epd.send_command(0x12)
+    time.sleep(0.1)
+    epd.ReadBusy()
+
+
+def sleep(epd) -> None:
+    # Like EPD.sleep(), but GPIO and SPI stay open for the next frame, init() wakes the panel again
+    epd.send_command(0x02)  # POWER_OFF
+    epd.ReadBusy()
+    epd.send_command(0x07)  # DEEP_SLEEP
+    epd.send_data(0xA5)
+
+
+class PanelWriter:
+    """
+    Owns the panel and paints the frames the renderer publishes to the frame buffer
+    Frames published while the panel refreshes, or within settle_seconds of each other, are coalesced: only the
+    latest one is painted. A failing refresh is logged and retried after retry_seconds, the renderer is not affected.
+    Painted frames are added to the frame archive in archive_dir, if given.
+    """
+
+    def __init__(
+        self,
+        epd,
+        frames: framebuffer.FrameBuffer,
+        poll_seconds: float = 1,
+        settle_seconds: float = 2,
+        retry_seconds: float = 60,
+        archive_dir: str = "",
+    ):
+        self.epd = epd
+        self.frames = frames
+        self.archive_dir = archive_dir
+        self.poll_seconds = poll_seconds
+        self.settle_seconds = settle_seconds
+        self.retry_seconds = retry_seconds
+        # Frames shown before the writer started are shown again
+        self.shown = 0
+
+    def show(self, seq: int, black: bytes, red: bytes) -> None:
+        logger.info(f"Painting frame {seq} ({seq - self.shown - 1} skipped) ...")
+        self.epd.init()
+        paint(self.epd, black, red)
+        sleep(self.epd)
+        self.shown = seq
+        self.frames.mark_shown(seq)
+        frame_archive.record(black, red, self.archive_dir)
+
+    def step(self) -> bool:
+        """Paints the latest frame if there is a new one, returns whether one was painted"""
+        frame = self.frames.read(after=self.shown)
+        if frame is None:
+            return False
+        # Wait for a burst of frames to end
+        time.sleep(self.settle_seconds)
+        frame = self.frames.read(after=frame[0]) or frame
+        self.show(*frame)
+        return True
+
+    def run(self) -> None:
+        while True:
+            try:
+                if not self.step():
+                    time.sleep(self.poll_seconds)
+            except Exception as e:
+                logger.error(f"Painting failed: {e!r}")
+                time.sleep(self.retry_seconds)
+
+
+def clear(path: str) -> None:
+    """Publishes a white frame, the running writer clears the panel with it"""
+    # The next weather.py run has to publish its frame again, see weather.forget_fingerprint()
+    fingerprintpath = os.path.join(_HERE, "cache", "frame-fingerprint")
+    if os.path.exists(fingerprintpath):
+        os.remove(fingerprintpath)
+    frames = framebuffer.FrameBuffer(path)
+    try:
+        frames.publish(*frame_archive.white_frame((frames.width, frames.height)))
+    finally:
+        frames.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Paints the frames published to the frame buffer.")
+    parser.add_argument("--framebuffer", help="Frame buffer file, defaults to framebuffer of config.json")
+    parser.add_argument("--settle", type=float, default=2, help="Seconds to wait for more frames before painting")
+    parser.add_argument("--clear", action="store_true", help="Publish a white frame and exit")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    path = framebuffer_path(args.framebuffer)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if args.clear:
+        clear(path)
+        return
+
+    from src.drivers import epd7in5b_V2
+
+    epd = epd7in5b_V2.EPD()
+    frames = framebuffer.FrameBuffer(path, epd.width, epd.height)
+    writer = PanelWriter(epd, frames, settle_seconds=args.settle, archive_dir=frame_archive.archive_path())
+    try:
+        writer.run()
+    except KeyboardInterrupt:
+        logging.info("ctrl + c:")
+        epd7in5b_V2.epdconfig.module_exit()
+        frames.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/python
+import argparse
+import contextlib
+import logging
+import os
+import resource
+import sys
+import time
+import tracemalloc
+
+logger = logging.getLogger(__name__)
+
+_enabled = False
+_records = []
+# Seconds of the latest run of every stage, measured even when profiling is off
+_timings = {}
+# Stage -> number of tiles drawn and taken from the tile cache since reset_timings()
+_tiles = {}
+_stack = []
+_snapshot = None
+_snapshot_size = 0
+
+
+def enable(frames: int = 1) -> None:
+    """Starts tracing allocations, from now on every stage() is measured"""
+    global _enabled
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+    _enabled = True
+
+
+def disable() -> None:
+    """Stops tracing allocations, stage() only measures the time again"""
+    global _enabled
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _enabled = False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def current_rss_mb() -> float:
+    # Resident set size of this process right now, 0 where /proc is not available
+    try:
+        with open("/proc/self/statm", "r") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return 0.0
+
+
+def peak_rss_mb() -> float:
+    # Highest resident set size of this process so far (ru_maxrss is in KiB on Linux)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """
+    Measures time, traced Python allocations and RSS of the enclosed code, only the time unless enabled
+    Stages can be nested, the peak of an outer stage includes the peaks of its inner stages.
+    """
+    global _snapshot, _snapshot_size
+    if not _enabled:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            _timings[name] = time.perf_counter() - start
+        return
+
+    # The peak so far belongs to the enclosing stage
+    start_current, peak_so_far = tracemalloc.get_traced_memory()
+    if _stack:
+        _stack[-1]["child_peak"] = max(_stack[-1]["child_peak"], peak_so_far)
+    tracemalloc.reset_peak()
+    record = {
+        "stage": "/".join([parent["stage"] for parent in _stack] + [name]),
+        "depth": len(_stack),
+        "child_peak": 0,
+        "rss_before_mb": current_rss_mb(),
+    }
+    _stack.append(record)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        _timings[name] = seconds
+        current, peak = tracemalloc.get_traced_memory()
+        _stack.pop()
+        peak = max(peak, record.pop("child_peak"))
+        if _stack:
+            _stack[-1]["child_peak"] = max(_stack[-1]["child_peak"], peak)
+        record.update(
+            seconds=seconds,
+            traced_delta_mb=(current - start_current) / 2**20,
+            traced_peak_mb=(peak - start_current) / 2**20,
+            rss_after_mb=current_rss_mb(),
+            peak_rss_mb=peak_rss_mb(),
+        )
+        _records.append(record)
+
+        # Keep the snapshot with the most live memory for the allocator report
+        if current > _snapshot_size:
+            _snapshot = tracemalloc.take_snapshot()
+            _snapshot_size = current
+        # Taking a snapshot allocates as well, so don't let it count towards the enclosing stage
+        tracemalloc.reset_peak()
+
+
+def timings() -> dict:
+    """Returns the seconds of the latest run of every stage since reset_timings()"""
+    return dict(_timings)
+
+
+def reset_timings() -> None:
+    _timings.clear()
+    _tiles.clear()
+
+
+def add_timing(name: str, seconds: float) -> None:
+    """Records the seconds of a stage measured elsewhere, e.g. in another thread or process"""
+    _timings[name] = seconds
+
+
+def count_tile(name: str, cached: bool) -> None:
+    """Counts a tile of the stage as drawn or taken from the tile cache, the stage's time depends on how many were drawn"""
+    counts = _tiles.setdefault(name, [0, 0])
+    counts[cached] += 1
+
+
+def tile_counts() -> dict:
+    """Returns the numbers of tiles drawn and taken from the tile cache per stage since reset_timings()"""
+    return {name: tuple(counts) for name, counts in _tiles.items()}
+
+
+def add_tile_counts(counts: dict) -> None:
+    """Adds tile counts of another process, see tile_counts()"""
+    for name, (drawn, cached) in counts.items():
+        total = _tiles.setdefault(name, [0, 0])
+        total[0] += drawn
+        total[1] += cached
+
+
+def report(top: int = 10) -> dict:
+    """
+    Logs all measured stages and the top allocators
+    Traced memory only covers Python allocations (including NumPy arrays), image buffers of PIL show up in the RSS.
+    :return:
+        Dict with the stage records, the highest traced peak of a stage and the peak RSS in MiB
+    """
+    for record in sorted(_records, key=lambda record: record["stage"]):
+        logger.info(
+            f"{'  ' * record['depth']}{record['stage']}: {record['seconds']:.2f} s, "
+            f"traced peak +{record['traced_peak_mb']:.1f} MiB, delta {record['traced_delta_mb']:+.1f} MiB, "
+            f"RSS {record['rss_before_mb']:.1f} -> {record['rss_after_mb']:.1f} MiB"
+        )
+    if _snapshot is not None:
+        logger.info(f"Top {top} allocators:")
+        # Module imports are not part of any render
+        snapshot = _snapshot.filter_traces(
+            [
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+                tracemalloc.Filter(False, "<frozen abc>"),
+                tracemalloc.Filter(False, tracemalloc.__file__),
+            ]
+        )
+        for statistic in snapshot.statistics("lineno")[:top]:
+            logger.info(f"  {statistic}")
+
+    summary = {
+        "stages": list(_records),
+        "traced_peak_mb": max([record["traced_peak_mb"] for record in _records], default=0.0),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    logger.info(f"Peak traced memory {summary['traced_peak_mb']:.1f} MiB, peak RSS {summary['peak_rss_mb']:.1f} MiB")
+    return summary
+
+
+def main():
+    # Renders the dashboard once with profiling enabled and fails when the peak RSS exceeds the budget
+    parser = argparse.ArgumentParser(description="Profiles the memory of one dashboard render.")
+    parser.add_argument("--budget-mb", type=float, help="Peak RSS budget in MiB (default: memory_budget_mb of config.json)")
+    parser.add_argument("--top", type=int, default=10, help="Number of top allocators to list")
+    args = parser.parse_args()
+
+    enable()
+    import draw_forecasts
+    from epd_image import pack_bitplanes
+    from epd_image import to_palette
+    from weather_display import WeatherDisplay
+
+    # draw_forecasts resets the root handlers on import
+    logging.basicConfig(level=logging.INFO)
+
+    display = WeatherDisplay(pixel_width=800, pixel_height=480, width_mm=163, height_mm=98)
+    with stage("render"):
+        image = draw_forecasts.get_forecast_image(display=display)
+    with stage("palette"):
+        image_black, image_red = to_palette(image=image, palette="bwr", dither=draw_forecasts.dither)
+    with stage("bitplanes"):
+        pack_bitplanes(image_black, image_red)
+    summary = report(top=args.top)
+
+    budget = args.budget_mb if args.budget_mb is not None else draw_forecasts.config.get("memory_budget_mb", 0)
+    if not within_budget(summary, budget):
+        sys.exit(1)
+
+
+def within_budget(summary: dict, budget_mb: float) -> bool:
+    """Checks the peak RSS of a report() summary against the budget in MiB, 0 means no budget"""
+    if budget_mb and summary["peak_rss_mb"] > budget_mb:
+        logger.error(f"Peak RSS of {summary['peak_rss_mb']:.1f} MiB exceeds the budget of {budget_mb} MiB")
+        return False
+    return True
+
+
+if __name__ == "__main__":
+    main()
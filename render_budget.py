@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+
+import artifacts
+import draw_forecasts
+import profiling
+
+logger = logging.getLogger(__name__)
+
+## Paths config
+costpath = os.path.join(draw_forecasts.cachedir, "render-costs.json")
+
+# Stages counting towards the render time, as measured by profiling.stage()
+STAGES = ("base", "current", "hourly", "daily", "overlay", "palette")
+# Stages rendered concurrently with parallel_render
+SECTION_STAGES = ("current", "hourly", "daily")
+# Cheaper variants in the order they are applied: name, setting, its cheaper value and the stage it makes cheaper
+DEGRADATIONS = [
+    ("ordered dither", "dither", "ordered", "palette"),
+    ("no min/max annotations", "min_max_annotations", False, "hourly"),
+    ("no icon outline", "icon_outline", False, "daily"),
+    ("simple chart", "chart_renderer", "pil", "hourly"),
+]
+# Share of a stage's time a degradation is assumed to save until the cheaper variant has been measured
+DEFAULT_SAVINGS = 0.5
+# Weight of the latest measurement in the running averages
+SMOOTHING = 0.3
+# A degradation is only lifted again if the estimate without it stays below this share of the budget
+RESTORE_SHARE = 0.8
+
+
+class RenderBudget:
+    """
+    Keeps the render time within budget_seconds by choosing cheaper variants of the expensive stages
+    The time of every stage is measured in each render and kept as running average per variant, i.e. per value of
+    the settings DEGRADATIONS change for that stage, in a file across runs. Before a render the degradations are
+    applied in order until the estimate fits the budget, and lifted again once there is enough room.
+    """
+
+    def __init__(self, budget_seconds: float, path: str = costpath):
+        self.budget_seconds = budget_seconds
+        self.path = path
+        # Stage -> variant -> average seconds
+        self.costs = {}
+        self.applied = []
+        if os.path.exists(path):
+            try:
+                with open(path, "r") as costfile:
+                    saved = json.load(costfile)
+                (self.costs, self.applied) = (saved["costs"], saved.get("applied", []))
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning(f"Could not read the render costs, measuring again: {e!r}")
+
+    def variant(self, stage: str, settings: dict) -> str:
+        # Values of the settings the degradations of the stage change
+        return json.dumps([settings.get(setting) for (_, setting, _, degraded_stage) in DEGRADATIONS if degraded_stage == stage])
+
+    def _degradations(self, stage: str, variant: str) -> int:
+        # Number of degradations of the stage applied in a variant
+        cheaper = [value for (_, _, value, degraded_stage) in DEGRADATIONS if degraded_stage == stage]
+        return sum(value == cheap for value, cheap in zip(json.loads(variant), cheaper))
+
+    def _stage_estimate(self, stage: str, settings: dict) -> float:
+        variants = self.costs.get(stage, {})
+        variant = self.variant(stage, settings)
+        if variant in variants or not variants:
+            return variants.get(variant, 0.0)
+        # Scale every measured variant by DEFAULT_SAVINGS per degradation more or less, the highest estimate counts
+        steps = self._degradations(stage, variant)
+        return max(seconds * (1 - DEFAULT_SAVINGS) ** (steps - self._degradations(stage, measured)) for measured, seconds in variants.items())
+
+    def estimate(self, settings: dict) -> float:
+        """
+        Estimated seconds of a render with the settings without cached tiles, stages which were never measured count 0
+        With parallel_render the sections overlap and only the slowest of them counts, like the wall-clock time.
+        """
+        seconds = {stage: self._stage_estimate(stage, settings) for stage in STAGES}
+        sections = [seconds.pop(stage) for stage in SECTION_STAGES]
+        return sum(seconds.values()) + (max(sections) if settings.get("parallel_render") else sum(sections))
+
+    def choose(self, settings: dict) -> dict:
+        """
+        Picks the degradations for the next render and starts measuring it
+        :param settings:
+            Settings at full quality
+        :return:
+            Settings with the chosen degradations applied
+        """
+        profiling.reset_timings()
+        chosen = dict(settings)
+        applied = []
+        for (name, setting, cheaper, stage) in DEGRADATIONS:
+            # Nothing to gain if the setting is cheap already ("none" dither) or the stage never ran
+            if chosen.get(setting) in (cheaper, "none") or stage not in self.costs:
+                continue
+            limit = self.budget_seconds * (RESTORE_SHARE if name in self.applied else 1)
+            if self.estimate(chosen) <= limit:
+                break
+            chosen[setting] = cheaper
+            applied.append(name)
+        if applied:
+            logger.warning(
+                f"Render budget of {self.budget_seconds:.2f} s: estimated {self.estimate(settings):.2f} s at full quality, "
+                f"applying {', '.join(applied)} ({self.estimate(chosen):.2f} s)"
+            )
+        elif self.applied:
+            logger.info(f"Render budget of {self.budget_seconds:.2f} s: back to full quality ({self.estimate(settings):.2f} s)")
+        self.applied = applied
+        return chosen
+
+    def record(self, settings: dict, timings: dict = None, tiles: dict = None) -> float:
+        """
+        Adds the measured stage times of a render with the settings to the averages and saves them
+        Stages that took some of their tiles from the tile cache are scaled up to all tiles drawn, stages that took all
+        of them from the cache are left out, so the averages hold the time of a render from scratch.
+        :param timings:
+            Seconds per stage, profiling.timings() if not given
+        :param tiles:
+            Tiles drawn and cached per stage, profiling.tile_counts() if not given
+        :return:
+            Wall-clock seconds of the render and palette mapping, the sum of the stages if the render wasn't measured
+        """
+        timings = profiling.timings() if timings is None else timings
+        tiles = profiling.tile_counts() if tiles is None else tiles
+        measured = {stage: seconds for stage, seconds in timings.items() if stage in STAGES}
+        for stage, seconds in measured.items():
+            (drawn, cached) = tiles.get(stage, (1, 0))
+            if not drawn:
+                continue
+            seconds *= (drawn + cached) / drawn
+            variant = self.variant(stage, settings)
+            variants = self.costs.setdefault(stage, {})
+            variants[variant] = seconds if variant not in variants else (1 - SMOOTHING) * variants[variant] + SMOOTHING * seconds
+        if "render" in timings:
+            total = timings["render"] + timings.get("palette", 0.0)
+        else:
+            total = sum(measured.values())
+        (logger.warning if total > self.budget_seconds else logger.info)(f"Render took {total:.2f} s of the {self.budget_seconds:.2f} s budget")
+        # Encoded right away, the scheduler keeps changing the averages while the writer runs
+        saved = json.dumps({"costs": self.costs, "applied": self.applied}).encode("utf-8")
+        artifacts.get_writer().submit(self.path, lambda: saved)
+        return total
+
+
+def from_config(settings: dict):
+    """Returns the render budget of the settings, None if render_budget_seconds is 0"""
+    budget_seconds = settings.get("render_budget_seconds", 0)
+    return RenderBudget(budget_seconds) if budget_seconds else None
+
+
+def apply(budget: RenderBudget, settings: dict = None) -> None:
+    """Applies the settings at full quality, config.json if not given, with the degradations the budget picks"""
+    chosen = budget.choose(draw_forecasts.config if settings is None else settings)
+    if chosen != draw_forecasts.applied_settings:
+        draw_forecasts.apply_settings(chosen)
@@ -0,0 +1,178 @@
+#!/usr/bin/python
+import argparse
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import draw_forecasts
+import owm_forecasts
+from batch import load_sites
+from epd_image import pack_bitplanes
+from epd_image import to_palette
+from weather_display import WeatherDisplay
+
+logger = logging.getLogger(__name__)
+
+# Latest rendered frame of a site
+Frame = namedtuple("Frame", ["etag", "png", "bitplanes", "rendered_at"])
+
+
+class FrameRenderer:
+    """
+    Keeps the latest frame of every site up to date
+    All rendering happens on a single background thread, and a site is only re-rendered when its
+    weather data (or the date shown in the header) changed, no matter how many clients fetch the frames.
+    """
+
+    def __init__(self, sites: list, interval: int):
+        self.sites = sites
+        self.interval = interval
+        self.frames = {}
+        self._data_digests = {}
+        self._lock = threading.Lock()
+        self._display = WeatherDisplay(pixel_width=800, pixel_height=480, width_mm=163, height_mm=98)
+
+    def get_frame(self, name: str):
+        with self._lock:
+            return self.frames.get(name)
+
+    def _data_digest(self, current_weather, hourly_forecasts) -> str:
+        data = {
+            "current": current_weather.to_dict(),
+            "hourly": hourly_forecasts,
+            "date": datetime.now().strftime("%Y-%m-%d"),
+        }
+        return hashlib.sha1(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def update_site(self, site: dict) -> bool:
+        """
+        Fetches the data of a site and renders a new frame if the data changed
+        :return:
+            True if a new frame was published
+        """
+        draw_forecasts.configure_site(site)
+        (current_weather, hourly_forecasts) = draw_forecasts.get_weather_data()
+
+        # The indoor sensor is only read while drawing, so those sites are always re-rendered
+        data_digest = self._data_digest(current_weather, hourly_forecasts)
+        if not draw_forecasts.mqtt_sub and self._data_digests.get(site["name"]) == data_digest:
+            return False
+
+        image = draw_forecasts.get_forecast_image(
+            display=self._display, current_weather=current_weather, hourly_forecasts=hourly_forecasts
+        )
+        image_black, image_red = to_palette(image=image, palette="bwr", dither=draw_forecasts.dither)
+        black, red = pack_bitplanes(image_black, image_red)
+        bitplanes = black + red
+        self._data_digests[site["name"]] = data_digest
+
+        # Frames that end up identical on the panel keep their ETag
+        etag = hashlib.sha1(bitplanes).hexdigest()
+        previous = self.get_frame(site["name"])
+        if previous is not None and previous.etag == etag:
+            return False
+
+        png = io.BytesIO()
+        image.save(png, format="PNG")
+        with self._lock:
+            self.frames[site["name"]] = Frame(etag=etag, png=png.getvalue(), bitplanes=bitplanes, rendered_at=time.time())
+        logger.info(f"New frame for {site['name']}: {etag}")
+        return True
+
+    def run(self):
+        while True:
+            for site in self.sites:
+                try:
+                    self.update_site(site)
+                except Exception as e:
+                    logger.error(f"Updating {site['name']} failed: {e!r}")
+            stats = owm_forecasts.fetch_stats()
+            logger.info(
+                f"Weather data: {stats['fetches']} fetches for {stats['requests']} requests "
+                f"({stats['hit_rate']:.0%} from the cache, {stats['api_calls_saved']} API calls saved)"
+            )
+            time.sleep(self.interval)
+
+    def start(self):
+        threading.Thread(target=self.run, name="renderer", daemon=True).start()
+
+
+class FrameRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the latest frames:
+      - GET /                 JSON list of sites with their current ETag
+      - GET /<site>.png       dashboard image
+      - GET /<site>.bin       packed black plane followed by the packed red plane, as EPD.display() sends them
+    Clients sending the ETag in If-None-Match get a 304 while the frame is unchanged.
+    """
+
+    renderer = None
+
+    def do_GET(self):
+        if self.path == "/":
+            index = {site["name"]: getattr(self.renderer.get_frame(site["name"]), "etag", None) for site in self.renderer.sites}
+            self._send(200, "application/json", json.dumps(index).encode("utf-8"))
+            return
+
+        name, extension = os.path.splitext(self.path.lstrip("/"))
+        frame = self.renderer.get_frame(name)
+        if frame is None or extension not in (".png", ".bin"):
+            self._send(404, "text/plain", b"Not found")
+            return
+
+        etag = f'"{frame.etag}{extension}"'
+        if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        if extension == ".png":
+            self._send(200, "image/png", frame.png, etag)
+        else:
+            self._send(200, "application/octet-stream", frame.bitplanes, etag)
+
+    def _send(self, status: int, content_type: str, body: bytes, etag: str = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves the rendered dashboards to thin-client panels.")
+    parser.add_argument("--sites", help="JSON file with the list of sites, see sites.json.dist (default: config.json only)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--interval", type=int, default=600, help="Seconds between weather data checks")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    sites = load_sites(args.sites) if args.sites else [{"name": "default"}]
+    FrameRequestHandler.renderer = FrameRenderer(sites=sites, interval=args.interval)
+    FrameRequestHandler.renderer.start()
+
+    server = ThreadingHTTPServer((args.host, args.port), FrameRequestHandler)
+    logger.info(f"Serving {len(sites)} site(s) on {args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
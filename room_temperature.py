@@ -1,40 +1,173 @@
+import hashlib
 import json
+import logging
 import os
 import time
 
+from paho.mqtt.client import topic_matches_sub
+
+import artifacts
 from mqtt_client import mqtt_client
+from sensor_history import SensorHistory
+
+logger = logging.getLogger(__name__)
 
 ## Paths config
 _HERE = os.path.dirname(__file__)
+historypath = os.path.join(_HERE, "cache", "sensor_history.npz")
 
 ## Read Settings
 with open(os.path.join(_HERE, "config.json"), "r") as configfile:
     config = json.load(configfile)
-mqtt_host = config["mqtt_host"]
-mqtt_port = config["mqtt_port"]
-mqtt_user = config["mqtt_user"]
-mqtt_pass = config["mqtt_pass"]
-mqtt_topic = config["mqtt_topic"]
-mqtt_temp_key = config["mqtt_temp_key"]
-mqtt_rH_key = config["mqtt_rH_key"]
+
+
+def apply_settings(settings: dict) -> None:
+    """Applies the given settings (same keys as config.json) to this module"""
+    global mqtt_host, mqtt_port, mqtt_user, mqtt_pass, mqtt_topic, mqtt_temp_key, mqtt_rH_key
+    mqtt_host = settings["mqtt_host"]
+    mqtt_port = settings["mqtt_port"]
+    mqtt_user = settings["mqtt_user"]
+    mqtt_pass = settings["mqtt_pass"]
+    mqtt_topic = settings["mqtt_topic"]
+    mqtt_temp_key = settings["mqtt_temp_key"]
+    mqtt_rH_key = settings["mqtt_rH_key"]
+
+
+apply_settings(config)
+
+
+# Minimum seconds between two saves of the sensor history
+HISTORY_SAVE_INTERVAL = 300
+# Minimum seconds between two samples of a sensor for its history, other messages are never decoded
+HISTORY_SAMPLE_INTERVAL = 60
+
+_histories = {}
+_history_saved = {}
+_clients = {}
+
+
+def _history_path(topic: str) -> str:
+    # The configured topic keeps the file name it always had, other sensors get one per topic
+    if topic == mqtt_topic:
+        return historypath
+    return os.path.join(_HERE, "cache", f"sensor_history_{hashlib.sha1(topic.encode('utf-8')).hexdigest()[:12]}.npz")
+
+
+def get_history(topic: str = None) -> SensorHistory:
+    """Returns the history of the sensor on the topic (default: mqtt_topic), loaded from the cache directory on first use"""
+    path = _history_path(mqtt_topic if topic is None else topic)
+    if path not in _histories:
+        try:
+            with open(path, "rb") as historyfile:
+                _histories[path] = SensorHistory.from_bytes(historyfile.read())
+        except FileNotFoundError:
+            _histories[path] = SensorHistory()
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Could not load the sensor history {path}, starting a new one: {e!r}")
+            _histories[path] = SensorHistory()
+    return _histories[path]
+
+
+def save_history(topic: str = None) -> None:
+    # Written in the background by the artifact writer
+    path = _history_path(mqtt_topic if topic is None else topic)
+    _history_saved[path] = time.time()
+    artifacts.get_writer().submit(path, get_history(topic).to_bytes)
+
+
+def sensor_topic(topic: str = None) -> str:
+    """
+    Returns the topic whose history belongs to the sensor topic (default: mqtt_topic)
+    Histories are kept per topic a message arrived on, for a wildcard that's the matching topic of the latest message
+    a client of this process received, the wildcard itself if there is none.
+    """
+    topic = mqtt_topic if topic is None else topic
+    for client in _clients.values():
+        latest = client.store.latest_topic(topic)
+        if latest is not None:
+            return latest
+    return topic
+
+
+def last_reading(topic: str = None):
+    """Returns time, temperature and rel. humidity of the latest sample in the sensor's history, None if there is none"""
+    samples = get_history(sensor_topic(topic)).raw_samples()
+    if not len(samples):
+        return None
+    return float(samples[-1]["time"]), float(samples[-1]["temp"]), float(samples[-1]["rH"])
 
 
 class mqtt_temperature(mqtt_client):
-    def __init__(self, host, port, user, password, topic):
+    """
+    Client for indoor sensors, one connection serves any number of sensor topics (wildcards allowed)
+    Every sensor has its own keys for temperature and rel. humidity. Payloads are only decoded when read, and
+    for the sensor history at most every HISTORY_SAMPLE_INTERVAL seconds per topic.
+    """
+
+    def __init__(self, host, port, user, password, topic, temp_key=None, rH_key=None):
+        self.topic = topic
+        self.keys = {topic: (mqtt_temp_key if temp_key is None else temp_key, mqtt_rH_key if rH_key is None else rH_key)}
+        self._sampled = {}
         super().__init__(host=host, port=port, user=user, password=password, topic=topic)
 
-    def get_temperature(self):
-        if self.state != 0:
-            return float(self.state[mqtt_temp_key])
-        else:
-            return None
+    def add_sensor(self, topic: str, temp_key: str, rH_key: str) -> None:
+        self.keys[topic] = (temp_key, rH_key)
+        self.subscribe(topic)
 
-    def get_rH(self):
-        if self.state != 0:
-            return float(self.state[mqtt_rH_key])
-        else:
+    def on_message(self, client, userdata, msg):
+        super().on_message(client, userdata, msg)
+        now = time.time()
+        if now - self._sampled.get(msg.topic, 0) < HISTORY_SAMPLE_INTERVAL:
+            return
+        for sensor, (temp_key, rH_key) in list(self.keys.items()):
+            if not topic_matches_sub(sensor, msg.topic):
+                continue
+            # Every topic matching a wildcard is a sensor of its own with its own history
+            temperature, rH = self._value(msg.topic, temp_key), self._value(msg.topic, rH_key)
+            if temperature is None or rH is None:
+                continue
+            get_history(msg.topic).append(now, temperature, rH)
+            # Only a recorded reading starts the interval, messages without valid values don't hold up the next one
+            self._sampled[msg.topic] = now
+            if now - _history_saved.get(_history_path(msg.topic), 0) >= HISTORY_SAVE_INTERVAL:
+                save_history(msg.topic)
+            break
+
+    def _value(self, topic: str, key: str):
+        value = self.store.value(topic, key)
+        try:
+            return None if value is None else float(value)
+        except (TypeError, ValueError):
             return None
 
+    def _read(self, topic, key_index: int):
+        topic = self.topic if topic is None else topic
+        return self._value(topic, self.keys[topic][key_index])
+
+    def get_temperature(self, topic: str = None):
+        return self._read(topic, 0)
+
+    def get_rH(self, topic: str = None):
+        return self._read(topic, 1)
+
+
+def get_sensor_client(topic: str = None, temp_key: str = None, rH_key: str = None) -> mqtt_temperature:
+    """
+    Returns the connected client of this process for the configured broker, subscribed to the sensor's topic
+    Sites on the same broker share the client. Defaults are mqtt_topic, mqtt_temp_key and mqtt_rH_key.
+    """
+    topic = mqtt_topic if topic is None else topic
+    temp_key = mqtt_temp_key if temp_key is None else temp_key
+    rH_key = mqtt_rH_key if rH_key is None else rH_key
+    broker = (mqtt_host, mqtt_port, mqtt_user, os.getpid())
+    if broker not in _clients:
+        _clients[broker] = mqtt_temperature(
+            host=mqtt_host, port=mqtt_port, user=mqtt_user, password=mqtt_pass, topic=topic, temp_key=temp_key, rH_key=rH_key
+        )
+    else:
+        _clients[broker].add_sensor(topic, temp_key, rH_key)
+    return _clients[broker]
+
 
 def main():
     my_temperature = mqtt_temperature(
@@ -43,6 +176,8 @@ def main():
     while True:
         print(f"Temperatur: {my_temperature.get_temperature()}°C")
         print(f"rF: {my_temperature.get_rH()}%")
+        for topic, rate in my_temperature.store.rates().items():
+            print(f"{topic}: {rate['count']} messages, {rate['per_second']:.2f}/s")
         time.sleep(5)
 
 
@@ -0,0 +1,280 @@
+#!/usr/bin/python
+import logging
+import time
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+
+import draw_forecasts
+import profiling
+import render_budget
+import room_temperature
+import weather
+from draw_forecasts import config
+from src.drivers import epd7in5b_V2
+from weather_display import WeatherDisplay
+
+logger = logging.getLogger(__name__)
+
+# OWM publishes its forecasts for every 3rd full hour (UTC)
+FORECAST_CADENCE_HOURS = 3
+# get_owm_data() calls the current weather and the forecast endpoint
+API_CALLS_PER_FETCH = 2
+# The README's cronjob: update every 15 minutes outside of the quiet hours
+CRON_INTERVAL_MINUTES = 15
+# A failed fetch or panel refresh is retried after this delay, doubled with every further failure up to the maximum
+RETRY_MINUTES = 5
+MAX_RETRY_MINUTES = 60
+
+# Displayed values and the config key of the threshold they have to change by, all others refresh on any change
+THRESHOLD_KEYS = {
+    "temp": "refresh_temp_threshold",
+    "chart_temps": "refresh_temp_threshold",
+    "day_temps": "refresh_temp_threshold",
+    "precip": "refresh_precip_threshold_mm",
+    "chart_precip": "refresh_precip_threshold_mm",
+    "day_precip": "refresh_precip_threshold_mm",
+    "sensor_temp": "refresh_sensor_temp_threshold",
+    "sensor_rH": "refresh_sensor_rH_threshold",
+}
+THRESHOLD_DEFAULTS = {
+    "refresh_temp_threshold": 1,
+    "refresh_precip_threshold_mm": 0.5,
+    "refresh_sensor_temp_threshold": 0.5,
+    "refresh_sensor_rH_threshold": 3,
+}
+
+
+def exceeds(old, new, threshold: float) -> bool:
+    # True if a displayed value changed by at least the threshold, tuples change if any of their items do
+    if isinstance(new, tuple):
+        if not isinstance(old, tuple) or len(old) != len(new):
+            return True
+        return any(exceeds(old_item, new_item, threshold) for old_item, new_item in zip(old, new))
+    if isinstance(new, (int, float)) and isinstance(old, (int, float)):
+        return abs(new - old) >= threshold if threshold else new != old
+    return new != old
+
+
+def next_fetch_time(now: datetime, offset_minutes: int) -> datetime:
+    """
+    Returns the first 3-hour forecast boundary (UTC) plus offset after now
+    :param now:
+        Timezone-aware current time
+    :param offset_minutes:
+        Minutes to wait after the boundary, OWM needs a few minutes to publish the new forecast
+    """
+    now = now.astimezone(timezone.utc)
+    boundary = now.replace(hour=now.hour - now.hour % FORECAST_CADENCE_HOURS, minute=0, second=0, microsecond=0)
+    fetch_time = boundary + timedelta(minutes=offset_minutes)
+    while fetch_time <= now:
+        fetch_time += timedelta(hours=FORECAST_CADENCE_HOURS)
+    return fetch_time
+
+
+def retry_delay(failures: int) -> timedelta:
+    """Time to wait after the given number of consecutive failures"""
+    return timedelta(minutes=min(RETRY_MINUTES * 2 ** (failures - 1), MAX_RETRY_MINUTES))
+
+
+class RefreshScheduler:
+    """
+    Replaces the 15 minute cronjob: weather data is fetched when OWM publishes a new forecast, and the panel is
+    only refreshed when a displayed value changed beyond its threshold, at most every min_refresh_minutes.
+    The panel is cleared once when the quiet hours start and stays asleep until they end.
+    """
+
+    def __init__(self, epd, settings: dict):
+        self.epd = epd
+        self.display = WeatherDisplay(pixel_width=epd.width, pixel_height=epd.height, width_mm=163, height_mm=98)
+        self.thresholds = {key: settings.get(key, default) for key, default in THRESHOLD_DEFAULTS.items()}
+        self.min_refresh = timedelta(minutes=settings.get("min_refresh_minutes", 15))
+        self.fetch_offset_minutes = settings.get("fetch_offset_minutes", 10)
+        # Current conditions change in between the forecasts, 0 only fetches with every new forecast
+        fetch_interval_minutes = settings.get("fetch_interval_minutes", 60)
+        self.fetch_interval = timedelta(minutes=fetch_interval_minutes) if fetch_interval_minutes else None
+        self.quiet_hours = tuple(settings.get("quiet_hours", [0, 4]))
+        self.nightly_clear = settings.get("nightly_clear", True)
+        self.settings = settings
+        # ReadBusy() gives up after the panel budget instead of blocking the scheduler on a stuck panel
+        self.panel_timeout = {**weather.STAGE_BUDGETS, **settings.get("stage_budget_seconds", {})}["panel"]
+        self.budget = render_budget.from_config(settings)
+
+        self.my_home = None
+        if draw_forecasts.mqtt_sub:
+            # One connection for the whole run instead of one per render
+            self.my_home = room_temperature.get_sensor_client(
+                topic=draw_forecasts.mqtt_topic, temp_key=draw_forecasts.mqtt_temp_key, rH_key=draw_forecasts.mqtt_rH_key
+            )
+
+        self.weather_data = None
+        self.next_fetch = None
+        self.last_fetch = None
+        self.fetch_failures = 0
+        self.displayed_values = None
+        self.last_refresh = None
+        self.refresh_failures = 0
+        self.retry_refresh = None
+        self.cleared = False
+        self.reset_stats(datetime.now())
+
+    def reset_stats(self, now: datetime) -> None:
+        self.stats = {"day": now.date(), "api_calls": 0, "refreshes": 0, "cron_runs": 0}
+        self._last_quarter = None
+
+    def report(self) -> dict:
+        """Logs API calls and panel refreshes of the day against the cronjob it replaces"""
+        stats = self.stats
+        cron_api_calls = stats["cron_runs"] * API_CALLS_PER_FETCH
+        logger.info(
+            f"{stats['day']}: {stats['api_calls']} API calls ({cron_api_calls - stats['api_calls']} saved), "
+            f"{stats['refreshes']} panel refreshes ({stats['cron_runs'] - stats['refreshes']} saved)"
+        )
+        return dict(stats, cron_api_calls=cron_api_calls)
+
+    def is_quiet(self, now: datetime) -> bool:
+        start, end = self.quiet_hours
+        if start <= end:
+            return start <= now.hour < end
+        return now.hour >= start or now.hour < end
+
+    def fetch_due(self, now: datetime) -> bool:
+        if self.next_fetch is None or now >= self.next_fetch:
+            return True
+        # After a failed fetch, with or without older data to show, only the retry time counts
+        if self.fetch_failures or self.weather_data is None:
+            return False
+        return self.fetch_interval is not None and now - self.last_fetch >= self.fetch_interval
+
+    def fetch(self, now: datetime) -> None:
+        self.stats["api_calls"] += API_CALLS_PER_FETCH
+        try:
+            self.weather_data = draw_forecasts.get_weather_data()
+        except Exception as e:
+            # Keep showing the last data and try again after the retry delay
+            self.fetch_failures += 1
+            self.next_fetch = now + retry_delay(self.fetch_failures)
+            logger.error(f"Fetching weather data failed: {e!r}, retrying at {self.next_fetch:%H:%M}")
+            return
+        self.fetch_failures = 0
+        self.last_fetch = now
+        self.next_fetch = next_fetch_time(now, self.fetch_offset_minutes)
+        logger.info(f"Fetched weather data, next forecast fetch at {self.next_fetch.astimezone():%H:%M}")
+
+    def read_sensors(self):
+        # Never waits for the sensor, a missing reading is picked up with a later tick
+        if self.my_home is None:
+            return None
+        readings = (self.my_home.get_temperature(draw_forecasts.mqtt_topic), self.my_home.get_rH(draw_forecasts.mqtt_topic))
+        return None if None in readings else readings
+
+    def changed_values(self, values: dict) -> list:
+        """Names of the displayed values that changed beyond their threshold since the last refresh"""
+        if self.displayed_values is None:
+            return list(values)
+        return [
+            name
+            for name, value in values.items()
+            if exceeds(self.displayed_values.get(name), value, self.thresholds.get(THRESHOLD_KEYS.get(name), 0))
+        ]
+
+    def refresh(self, now: datetime, values: dict, sensor_readings) -> None:
+        (current_weather, hourly_forecasts) = self.weather_data
+        if draw_forecasts.mqtt_sub and sensor_readings is None:
+            sensor_readings = draw_forecasts.read_sensor_readings(self.my_home)
+        if self.budget is not None:
+            render_budget.apply(self.budget, self.settings)
+        with profiling.stage("render"):
+            image = draw_forecasts.get_forecast_image(
+                display=self.display,
+                current_weather=current_weather,
+                hourly_forecasts=hourly_forecasts,
+                sensor_readings=sensor_readings,
+            )
+        try:
+            self.epd.busy_timeout = self.panel_timeout
+            weather.update_panel(self.epd, image)
+        except Exception as e:
+            # The panel must not stay powered, the refresh is retried after the retry delay
+            self.refresh_failures += 1
+            self.retry_refresh = now + retry_delay(self.refresh_failures)
+            logger.error(f"Updating the panel failed: {e!r}, retrying at {self.retry_refresh:%H:%M}")
+            weather.release_panel(self.epd)
+            return
+        self.refresh_failures = 0
+        self.retry_refresh = None
+        if self.budget is not None:
+            self.budget.record(draw_forecasts.applied_settings)
+        self.displayed_values = values
+        self.last_refresh = now
+        self.cleared = False
+        self.stats["refreshes"] += 1
+
+    def tick(self, now: datetime) -> None:
+        """Runs one scheduling step, now is the timezone-aware local time"""
+        if now.date() != self.stats["day"]:
+            self.report()
+            self.reset_stats(now)
+
+        if self.is_quiet(now):
+            if self.nightly_clear and not self.cleared:
+                logger.info("Quiet hours, clearing the panel")
+                weather.clear_panel(self.epd)
+                self.cleared = True
+                self.displayed_values = None
+            return
+
+        # Count the runs the cronjob would have made
+        quarter = (now.hour, now.minute // CRON_INTERVAL_MINUTES)
+        if quarter != self._last_quarter:
+            self._last_quarter = quarter
+            self.stats["cron_runs"] += 1
+
+        if self.fetch_due(now):
+            self.fetch(now)
+        if self.weather_data is None:
+            return
+
+        sensor_readings = self.read_sensors()
+        (current_weather, hourly_forecasts) = self.weather_data
+        values = draw_forecasts.get_displayed_values(current_weather, hourly_forecasts, sensor_readings)
+        if self.displayed_values is not None and draw_forecasts.mqtt_sub and sensor_readings is None:
+            # Keep the shown sensor values until the sensor reports again
+            values.update({name: self.displayed_values[name] for name in ("sensor_temp", "sensor_rH") if name in self.displayed_values})
+
+        changed = self.changed_values(values)
+        if not changed:
+            return
+        if self.last_refresh is not None and now - self.last_refresh < self.min_refresh:
+            logger.debug(f"Refresh of {', '.join(changed)} postponed, last refresh at {self.last_refresh:%H:%M}")
+            return
+        if self.retry_refresh is not None and now < self.retry_refresh:
+            logger.debug(f"Refresh of {', '.join(changed)} postponed, retrying at {self.retry_refresh:%H:%M}")
+            return
+        logger.info(f"Refreshing the panel, changed: {', '.join(changed)}")
+        self.refresh(now, values, sensor_readings)
+
+    def run(self, tick_seconds: int = 60) -> None:
+        while True:
+            try:
+                self.tick(datetime.now().astimezone())
+            except Exception as e:
+                logger.error(f"Scheduler tick failed: {e!r}")
+            time.sleep(tick_seconds)
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    epd = epd7in5b_V2.EPD()
+    scheduler = RefreshScheduler(epd=epd, settings=config)
+    try:
+        scheduler.run(tick_seconds=config.get("scheduler_tick_seconds", 60))
+    except KeyboardInterrupt:
+        logging.info("ctrl + c:")
+        scheduler.report()
+        epd7in5b_V2.epdconfig.module_exit()
+        exit()
+
+
+if __name__ == "__main__":
+    main()
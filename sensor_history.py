@@ -0,0 +1,114 @@
+import io
+import threading
+
+import numpy as np
+
+# Raw samples and per-bucket aggregates, kept in fixed-size ring buffers
+SAMPLE_DTYPE = np.dtype([("time", "f8"), ("temp", "f4"), ("rH", "f4")])
+BUCKET_DTYPE = np.dtype(
+    [
+        ("start", "f8"),
+        ("count", "u4"),
+        ("temp_min", "f4"),
+        ("temp_max", "f4"),
+        ("temp_sum", "f8"),
+        ("rH_min", "f4"),
+        ("rH_max", "f4"),
+        ("rH_sum", "f8"),
+    ]
+)
+
+
+class SensorHistory:
+    """
+    Time series of the indoor temperature and rel. humidity
+    Every sample is added to a ring buffer of raw samples and to the min/max/sum of its time bucket, so
+    aggregates are read without scanning the samples. Samples arriving out of order only go into the raw buffer.
+    """
+
+    def __init__(self, capacity: int = 4096, bucket_seconds: int = 1800, buckets: int = 96):
+        self.bucket_seconds = bucket_seconds
+        self.samples = np.zeros(capacity, dtype=SAMPLE_DTYPE)
+        self.buckets = np.zeros(buckets, dtype=BUCKET_DTYPE)
+        self.sample_count = 0
+        self.bucket_count = 0
+        # Index of the latest sample and bucket
+        self._sample_head = -1
+        self._bucket_head = -1
+        self._lock = threading.Lock()
+
+    def append(self, timestamp: float, temp: float, rH: float) -> None:
+        with self._lock:
+            self._sample_head = (self._sample_head + 1) % len(self.samples)
+            self.samples[self._sample_head] = (timestamp, temp, rH)
+            self.sample_count = min(self.sample_count + 1, len(self.samples))
+
+            start = timestamp - timestamp % self.bucket_seconds
+            if self.bucket_count and start == self.buckets[self._bucket_head]["start"]:
+                bucket = self.buckets[self._bucket_head]
+                bucket["count"] += 1
+                bucket["temp_min"] = min(bucket["temp_min"], temp)
+                bucket["temp_max"] = max(bucket["temp_max"], temp)
+                bucket["temp_sum"] += temp
+                bucket["rH_min"] = min(bucket["rH_min"], rH)
+                bucket["rH_max"] = max(bucket["rH_max"], rH)
+                bucket["rH_sum"] += rH
+            elif not self.bucket_count or start > self.buckets[self._bucket_head]["start"]:
+                self._bucket_head = (self._bucket_head + 1) % len(self.buckets)
+                self.buckets[self._bucket_head] = (start, 1, temp, temp, temp, rH, rH, rH)
+                self.bucket_count = min(self.bucket_count + 1, len(self.buckets))
+
+    def _chronological(self, ring: np.ndarray, head: int, count: int) -> np.ndarray:
+        # Copy of the filled part of a ring buffer, oldest first
+        return np.roll(ring, -(head + 1))[len(ring) - count :] if count else ring[:0].copy()
+
+    def raw_samples(self) -> np.ndarray:
+        with self._lock:
+            return self._chronological(self.samples, self._sample_head, self.sample_count)
+
+    def aggregates(self, since: float = 0) -> dict:
+        """
+        Returns the buckets starting at or after since, oldest first
+        :return:
+            Dict of arrays: start, count, temp_min, temp_max, temp_mean, rH_min, rH_max, rH_mean
+        """
+        with self._lock:
+            buckets = self._chronological(self.buckets, self._bucket_head, self.bucket_count)
+        buckets = buckets[buckets["start"] >= since]
+        return {
+            "start": buckets["start"],
+            "count": buckets["count"],
+            "temp_min": buckets["temp_min"],
+            "temp_max": buckets["temp_max"],
+            "temp_mean": buckets["temp_sum"] / buckets["count"],
+            "rH_min": buckets["rH_min"],
+            "rH_max": buckets["rH_max"],
+            "rH_mean": buckets["rH_sum"] / buckets["count"],
+        }
+
+    def to_bytes(self) -> bytes:
+        with self._lock:
+            buffer = io.BytesIO()
+            np.savez(
+                buffer,
+                samples=self._chronological(self.samples, self._sample_head, self.sample_count),
+                buckets=self._chronological(self.buckets, self._bucket_head, self.bucket_count),
+                bucket_seconds=self.bucket_seconds,
+            )
+        return buffer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data: bytes, capacity: int = 4096, bucket_seconds: int = 1800, buckets: int = 96):
+        """Restores a history saved with to_bytes(), the buckets are only kept if their size didn't change"""
+        history = cls(capacity=capacity, bucket_seconds=bucket_seconds, buckets=buckets)
+        with np.load(io.BytesIO(data)) as saved:
+            samples = saved["samples"][-capacity:]
+            history.samples[: len(samples)] = samples
+            history.sample_count = len(samples)
+            history._sample_head = len(samples) - 1
+            if int(saved["bucket_seconds"]) == bucket_seconds:
+                saved_buckets = saved["buckets"][-buckets:]
+                history.buckets[: len(saved_buckets)] = saved_buckets
+                history.bucket_count = len(saved_buckets)
+                history._bucket_head = len(saved_buckets) - 1
+        return history
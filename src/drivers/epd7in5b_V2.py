@@ -29,6 +29,7 @@
 
 
 import logging
+import time
 from src.drivers import epdconfig
 
 # Display resolution
@@ -45,6 +46,8 @@ class EPD:
         self.cs_pin = epdconfig.CS_PIN
         self.width = EPD_WIDTH
         self.height = EPD_HEIGHT
+        # Seconds ReadBusy() waits for the panel before raising TimeoutError, None waits forever
+        self.busy_timeout = None
 
     # Hardware reset
     def reset(self):
@@ -75,9 +78,12 @@ class EPD:
 
     def ReadBusy(self):
         logger.debug("e-Paper busy")
+        start = time.monotonic()
         self.send_command(0x71)
         busy = epdconfig.digital_read(self.busy_pin)
         while(busy == 0):
+            if self.busy_timeout is not None and time.monotonic() - start > self.busy_timeout:
+                raise TimeoutError(f"e-Paper still busy after {self.busy_timeout:.0f} s")
             self.send_command(0x71)
             busy = epdconfig.digital_read(self.busy_pin)
         epdconfig.delay_ms(200)
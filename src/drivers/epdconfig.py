@@ -263,6 +263,53 @@ class SunriseX3:
 
 
 
+class Recording:
+    # Stand-in for the hardware, selected with EPD_BACKEND=recording: records every SPI transfer and is never busy
+    RST_PIN  = 17
+    DC_PIN   = 25
+    CS_PIN   = 8
+    BUSY_PIN = 24
+    PWR_PIN  = 18
+
+    def __init__(self):
+        # List of command byte and the data sent after it
+        self.transfers = []
+        self._dc = 0
+
+    def digital_write(self, pin, value):
+        if pin == self.DC_PIN:
+            self._dc = value
+
+    def digital_read(self, pin):
+        return 1
+
+    def delay_ms(self, delaytime):
+        pass
+
+    def spi_writebyte(self, data):
+        if self._dc == 0:
+            self.transfers.extend((command, bytearray()) for command in data)
+        elif self.transfers:
+            self.transfers[-1][1].extend(data)
+
+    def spi_writebyte2(self, data):
+        self.spi_writebyte(data)
+
+    def recorded_data(self, command):
+        # Data sent after the last occurrence of the command, None if it wasn't sent
+        for sent, data in reversed(self.transfers):
+            if sent == command:
+                return bytes(data)
+        return None
+
+    def module_init(self):
+        return 0
+
+    def module_exit(self):
+        logger.debug("recorded %d transfers", len(self.transfers))
+
+
+
 if sys.version_info[0] == 2:
     process = subprocess.Popen("cat /proc/cpuinfo | grep Raspberry", shell=True, stdout=subprocess.PIPE)
 else:
@@ -271,7 +318,9 @@ output, _ = process.communicate()
 if sys.version_info[0] == 2:
     output = output.decode(sys.stdout.encoding)
 
-if "Raspberry" in output:
+if os.environ.get("EPD_BACKEND") == "recording":
+    implementation = Recording()
+elif "Raspberry" in output:
     implementation = RaspberryPi()
 elif os.path.exists('/sys/bus/platform/drivers/gpio-x3'):
     implementation = SunriseX3()
@@ -1,8 +1,10 @@
+import functools
 import os
 
 from PIL import ImageFont
 
 
+@functools.lru_cache(maxsize=None)
 def font(family, style, size):
     # Returns the TrueType font object for the given characteristics
     fontdir = os.path.dirname(os.path.abspath(__file__))
@@ -1,29 +1,140 @@
+import functools
+import json
+import logging
+import mmap
 import os
-import urllib
+import urllib.request
 
 from PIL import Image
 from PIL import ImageOps
 
+logger = logging.getLogger(__name__)
+
+weatherdir = os.path.dirname(os.path.abspath(__file__))
+atlaspath = os.path.join(weatherdir, "icons.atlas")
+indexpath = os.path.join(weatherdir, "icons.atlas.json")
+
+# All icon codes of OWM, see https://openweathermap.org/weather-conditions
+ICON_NAMES = [f"{code}{time}" for code in ["01", "02", "03", "04", "09", "10", "11", "13", "50"] for time in "dn"]
+# Sizes and inversion of the icons as the layout uses them: current weather and daily forecast
+LAYOUT_ICON_VARIANTS = [(150, True), (90, False)]
+
+_atlas = None
+_atlas_index = {}
 
-def get_weather_icon(icon_name, size, use_owm_icons: bool = False, invert: bool = False) -> Image:
-    # Returns the requested weather icon as Image
-    # Please note: The invert parameter only applies and is needed for the built-in icons
 
-    weatherdir = os.path.dirname(os.path.abspath(__file__))
-    iconpath = os.path.join(weatherdir, "owm_icons", f"{icon_name}.png")
+def _atlas_key(icon_name, size, use_owm_icons: bool, invert: bool) -> str:
+    # The invert parameter only applies to the built-in icons
+    if use_owm_icons:
+        return f"owm/{icon_name}/{size}"
+    return f"custom/{icon_name}/{size}/{'inverted' if invert else 'plain'}"
 
+
+def _load_icon(icon_name, size, use_owm_icons: bool, invert: bool) -> Image:
+    # Decodes and resizes the icon from its PNG file
     if use_owm_icons == True:
-        if not os.path.exists(iconpath):
-            urllib.request.urlretrieve(
-                url=f"https://openweathermap.org/img/wn/{icon_name}@2x.png", filename=f"{iconpath}"
-            )
-        icon = Image.open(iconpath)
+        icon = Image.open(os.path.join(weatherdir, "owm_icons", f"{icon_name}.png"))
     else:
-        icon = Image.open(os.path.join(weatherdir, f"{icon_name}.png"))
+        icon = Image.open(os.path.join(weatherdir, "custom_icons", f"{icon_name}.png"))
         icon = icon.convert("L")
         if invert == True:
             icon = ImageOps.invert(icon)
 
-    icon = icon.resize((size, size))
+    return icon.resize((size, size))
+
+
+def load_atlas() -> bool:
+    """
+    Maps the icon atlas into memory, if it has been built
+    :return:
+        True if the atlas is available
+    """
+    global _atlas, _atlas_index
+    if _atlas is not None:
+        return True
+    try:
+        with open(indexpath, "r") as indexfile:
+            index = json.load(indexfile)
+        with open(atlaspath, "rb") as atlasfile:
+            _atlas = mmap.mmap(atlasfile.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return False
+    _atlas_index = index
+    return True
+
+
+@functools.lru_cache(maxsize=None)
+def get_weather_icon(icon_name, size, use_owm_icons: bool = False, invert: bool = False) -> Image:
+    # Returns the requested weather icon as Image
+    # Please note: The invert parameter only applies and is needed for the built-in icons
+    # Icons are cached, so callers must not modify the returned image in place
+    # With a built atlas, icons are read-only views into the memory-mapped atlas file without any decoding
+
+    if load_atlas():
+        entry = _atlas_index.get(_atlas_key(icon_name, size, use_owm_icons, invert))
+        if entry is not None:
+            data = memoryview(_atlas)[entry["offset"] : entry["offset"] + entry["length"]]
+            return Image.frombuffer(entry["mode"], (size, size), data, "raw", entry["mode"], 0, 1)
+
+    try:
+        return _load_icon(icon_name, size, use_owm_icons, invert)
+    except FileNotFoundError:
+        # Icons are never downloaded while rendering, build the atlas to fetch missing OWM icons
+        logger.error(f"Weather icon {icon_name} is missing, run: python3 -m src.weather_icons.weather_icons")
+        return Image.new("RGBA", (size, size), (0, 0, 0, 0))
+
+
+def download_owm_icons() -> None:
+    # Downloads all OWM icons which are not there yet
+    for icon_name in ICON_NAMES:
+        iconpath = os.path.join(weatherdir, "owm_icons", f"{icon_name}.png")
+        if not os.path.exists(iconpath):
+            logger.info(f"Downloading OWM icon {icon_name}")
+            urllib.request.urlretrieve(url=f"https://openweathermap.org/img/wn/{icon_name}@2x.png", filename=iconpath)
+
+
+def build_atlas(variants: list = LAYOUT_ICON_VARIANTS) -> dict:
+    """
+    Packs all icons of both icon sets at the given sizes into one uncompressed atlas file with an index
+    :param variants:
+        List of (size, invert) tuples
+    :return:
+        Index of the atlas: key to offset, length and mode of the raw icon data
+    """
+    index = {}
+    offset = 0
+    tmp_path = f"{atlaspath}.tmp"
+    with open(tmp_path, "wb") as atlasfile:
+        for use_owm_icons in (True, False):
+            for icon_name in ICON_NAMES:
+                for size, invert in variants:
+                    key = _atlas_key(icon_name, size, use_owm_icons, invert)
+                    if key in index:
+                        continue
+                    try:
+                        icon = _load_icon(icon_name, size, use_owm_icons, invert)
+                    except FileNotFoundError:
+                        logger.warning(f"Skipping missing icon {key}")
+                        continue
+                    if icon.mode not in ("L", "RGBA"):
+                        icon = icon.convert("RGBA")
+                    data = icon.tobytes()
+                    atlasfile.write(data)
+                    index[key] = {"offset": offset, "length": len(data), "mode": icon.mode}
+                    offset += len(data)
+    os.replace(tmp_path, atlaspath)
+    with open(f"{indexpath}.tmp", "w") as indexfile:
+        json.dump(index, indexfile, indent=4)
+    os.replace(f"{indexpath}.tmp", indexpath)
+    return index
+
 
-    return icon
+if __name__ == "__main__":
+    # Builds the icon atlas, run as: python3 -m src.weather_icons.weather_icons
+    logging.basicConfig(level=logging.INFO)
+    try:
+        download_owm_icons()
+    except OSError as e:
+        logger.warning(f"Could not download the missing OWM icons: {e}")
+    index = build_atlas()
+    logger.info(f"Packed {len(index)} icons into {atlaspath}")
@@ -0,0 +1,54 @@
+import json
+import os
+import sys
+
+import pytest
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, _ROOT)
+# The panel driver records its SPI transfers instead of looking for hardware
+os.environ["EPD_BACKEND"] = "recording"
+
+# Every module reads config.json on import
+if not os.path.exists(os.path.join(_ROOT, "config.json")):
+    collect_ignore_glob = ["test_*.py"]
+
+
+@pytest.fixture(scope="session")
+def weather_data():
+    """Current weather and hourly forecasts from owm_forecasts' stand-in responses, no request is made"""
+    import draw_forecasts
+    import owm_forecasts
+
+    # Nothing is read from or written to the cache directory of a real dashboard
+    draw_forecasts.configure_site({"mqtt_sub": False, "history": False, "tile_cache_mb": 0})
+    draw_forecasts.persist_layers = False
+    responses = owm_forecasts._stand_in_responses()
+    current_weather = owm_forecasts.CurrentWeather(json.loads(responses["weather"]))
+    rows = []
+    for item in json.loads(responses["forecast"])["list"]:
+        main = item["main"]
+        rows.append(
+            (item["dt"], main["temp"], main["temp_min"], main["temp_max"], item.get("rain", {}).get("3h", 0.0), item["wind"]["speed"], item["wind"]["gust"], item["weather"][0]["icon"])
+        )
+    table = owm_forecasts._forecast_table(rows)
+    hourly_forecasts = owm_forecasts.to_hourly_forecasts(
+        table, temp_units=owm_forecasts.temp_units, wind_units=owm_forecasts.wind_units, tz_zone=owm_forecasts.tz_zone
+    )
+    return current_weather, hourly_forecasts
+
+
+@pytest.fixture(scope="session")
+def display():
+    from weather_display import WeatherDisplay
+
+    return WeatherDisplay(pixel_width=800, pixel_height=480, width_mm=163, height_mm=98)
+
+
+@pytest.fixture(scope="session")
+def dashboard(weather_data, display):
+    """The dashboard rendered from the stand-in weather data"""
+    import draw_forecasts
+
+    (current_weather, hourly_forecasts) = weather_data
+    return draw_forecasts.get_forecast_image(display=display, current_weather=current_weather, hourly_forecasts=hourly_forecasts)
@@ -0,0 +1,37 @@
+import draw_forecasts
+import profiling
+from epd_image import pack_bitplanes
+from epd_image import to_palette
+
+# Budget if config.json sets none, a render from scratch peaks at about 120 MiB RSS on x86-64
+DEFAULT_BUDGET_MB = 400
+
+
+def _profile_render(display, weather_data) -> dict:
+    (current_weather, hourly_forecasts) = weather_data
+    profiling.enable()
+    try:
+        with profiling.stage("render"):
+            image = draw_forecasts.get_forecast_image(display=display, current_weather=current_weather, hourly_forecasts=hourly_forecasts)
+        with profiling.stage("palette"):
+            image_black, image_red = to_palette(image=image, palette="bwr", dither=draw_forecasts.dither)
+        with profiling.stage("bitplanes"):
+            pack_bitplanes(image_black, image_red)
+        return profiling.report()
+    finally:
+        profiling.disable()
+
+
+def test_render_stays_within_memory_budget(display, weather_data):
+    summary = _profile_render(display, weather_data)
+    budget = draw_forecasts.config.get("memory_budget_mb", 0) or DEFAULT_BUDGET_MB
+    assert {record["stage"] for record in summary["stages"]} >= {"render", "palette", "bitplanes"}
+    assert summary["peak_rss_mb"] > 0
+    assert profiling.within_budget(summary, budget), f"peak RSS {summary['peak_rss_mb']:.1f} MiB exceeds {budget} MiB"
+
+
+def test_render_over_memory_budget_fails(display, weather_data):
+    summary = _profile_render(display, weather_data)
+    # No render fits into 1 MiB
+    assert not profiling.within_budget(summary, 1)
+    assert profiling.within_budget(summary, 0)
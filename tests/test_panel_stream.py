@@ -0,0 +1,35 @@
+import pytest
+
+import draw_forecasts
+import frame_archive
+import weather
+from epd_image import pack_bitplanes
+from epd_image import to_palette
+from src.drivers import epd7in5b_V2
+from src.drivers import epdconfig
+
+
+@pytest.fixture
+def epd(tmp_path, monkeypatch):
+    # latest-image.png/.bin go to the temporary directory, nothing is archived
+    monkeypatch.setattr(weather, "repodir", str(tmp_path))
+    monkeypatch.setattr(frame_archive, "archive_path", lambda path=None: "")
+    epdconfig.implementation.transfers.clear()
+    return epd7in5b_V2.EPD()
+
+
+@pytest.mark.parametrize("band_rows", [0, 48, 52])
+def test_panel_receives_packed_bitplanes(epd, dashboard, monkeypatch, band_rows):
+    # 0 sends the full frame with EPD.display(), otherwise the bands are streamed; 52 rows round up to 56, which leaves
+    # a shorter last band
+    monkeypatch.setitem(weather.config, "stream_band_rows", band_rows)
+    expected = pack_bitplanes(*to_palette(image=dashboard.copy(), palette="bwr", dither=draw_forecasts.dither))
+
+    weather.update_panel(epd, dashboard.copy())
+
+    assert epdconfig.recorded_data(0x10) == expected[0]
+    assert epdconfig.recorded_data(0x13) == expected[1]
+    # Refreshed and put to sleep, without the status reads (0x71) of ReadBusy()
+    commands = [command for command, _ in epdconfig.implementation.transfers if command != 0x71]
+    assert commands.index(0x12) > commands.index(0x13)
+    assert commands[-2:] == [0x02, 0x07]
@@ -0,0 +1,33 @@
+import json
+
+import numpy as np
+import pytest
+from pyowm.utils import measurables
+from pyowm.weatherapi25.weather import Weather
+
+import owm_forecasts
+
+PYOWM_CONVERSIONS = {"celsius": measurables.kelvin_to_celsius, "fahrenheit": measurables.kelvin_to_fahrenheit}
+
+
+@pytest.mark.parametrize("unit", list(PYOWM_CONVERSIONS))
+def test_convert_temperatures_rounds_like_pyowm(unit):
+    # Three decimals hit the values np.round() rounds differently from pyowm's formatting
+    kelvin = np.round(np.arange(230000, 330000) / 1000, 3)
+    expected = [PYOWM_CONVERSIONS[unit](value) for value in kelvin.tolist()]
+    assert owm_forecasts.convert_temperatures(kelvin, unit) == expected
+    assert [owm_forecasts.convert_temperature(value, unit) for value in kelvin.tolist()] == expected
+
+
+def test_convert_temperatures_keeps_missing_values_and_deltas():
+    assert owm_forecasts.convert_temperatures(np.array([np.nan, -0.5, 283.15]), "celsius") == [None, -0.5, 10.0]
+
+
+@pytest.mark.parametrize("unit", list(PYOWM_CONVERSIONS))
+def test_forecast_temperatures_match_pyowm(unit):
+    forecasts = json.loads(owm_forecasts._stand_in_responses()["forecast"])["list"]
+    rows = [(item["dt"], item["main"]["temp"], item["main"]["temp_min"], item["main"]["temp_max"], 0.0, 0.0, 0.0, "") for item in forecasts]
+    hourly_forecasts = owm_forecasts.to_hourly_forecasts(owm_forecasts._forecast_table(rows), temp_units=unit, wind_units="meters_sec", tz_zone=None)
+    for item, forecast in zip(forecasts, hourly_forecasts):
+        temperature = Weather.from_dict(item).temperature(unit)
+        assert (forecast["temp"], forecast["min_temp"], forecast["max_temp"]) == (temperature["temp"], temperature["temp_min"], temperature["temp_max"])
@@ -0,0 +1,82 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from PIL import Image
+from PIL import PngImagePlugin
+
+logger = logging.getLogger(__name__)
+
+
+class TileCache:
+    """
+    Content-addressed cache of rendered tiles on disk
+    Tiles are stored as PNG under the hash of everything they were drawn from, so they are shared between runs
+    and processes. Their dither_regions are kept in the PNG. The least recently used tiles are removed once the
+    cache grows beyond max_bytes.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(*inputs) -> str:
+        # Inputs are hashed as JSON, anything JSON can't represent (datetimes, ...) by its str()
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.png")
+
+    def get(self, key: str) -> Image:
+        """Returns the tile stored under the key, None if there is none"""
+        path = self._path(key)
+        try:
+            with Image.open(path) as tile:
+                tile.load()
+            # Mark as recently used for the eviction
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        regions = tile.info.pop("dither_regions", None)
+        tile.info = {"dither_regions": [tuple(box) for box in json.loads(regions)]} if regions else {}
+        self.hits += 1
+        return tile
+
+    def put(self, key: str, tile: Image) -> None:
+        """Stores the tile under the key and evicts the least recently used tiles beyond the size limit"""
+        info = PngImagePlugin.PngInfo()
+        if tile.info.get("dither_regions"):
+            info.add_text("dither_regions", json.dumps(tile.info["dither_regions"]))
+        tmp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tile.save(tmp_path, format="PNG", pnginfo=info, compress_level=1)
+            os.replace(tmp_path, self._path(key))
+            self.evict()
+        except OSError as e:
+            logger.warning(f"Could not cache tile {key}: {e}")
+
+    def evict(self) -> None:
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".png"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
@@ -0,0 +1,235 @@
+#!/usr/bin/python
+import argparse
+import collections
+import glob
+import heapq
+import io
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import time
+from datetime import datetime
+
+from PIL import GifImagePlugin
+from PIL import Image
+
+import artifacts
+import draw_forecasts
+import epd_image
+import forecast_accuracy
+import owm_forecasts
+from weather_display import WeatherDisplay
+
+logger = logging.getLogger(__name__)
+
+## Paths config
+_HERE = os.path.dirname(os.path.realpath(__file__))
+
+# Frames rendered ahead of the one written next, per worker
+FRAMES_AHEAD = 2
+
+
+def _current_weather(observed: dict) -> owm_forecasts.CurrentWeather:
+    # Current weather as the dashboard needs it, from an observation of the forecast store (see owm_forecasts.observation())
+    return owm_forecasts.CurrentWeather(
+        {
+            "dt": observed["time"],
+            "main": {"temp": observed["temp"], "feels_like": observed.get("feels_like") or observed["temp"], "humidity": observed.get("humidity", 0)},
+            "weather": [{"description": observed.get("status", ""), "icon": observed["icon"]}],
+            "rain": {"1h": observed["precip_1h_mm"]},
+        }
+    )
+
+
+def store_snapshots(store: owm_forecasts.ForecastStore):
+    """
+    Yields issue time, current weather and hourly forecasts of every issue of a forecast store
+    The current weather is the latest observation up to the issue, the first forecast if there is none.
+    """
+    observations = iter(store.observations)
+    observed = next(observations, None)
+    latest = None
+    for issued, table in store.snapshots():
+        while observed is not None and observed["time"] <= issued:
+            latest, observed = observed, next(observations, None)
+        hourly_forecasts = owm_forecasts.to_hourly_forecasts(
+            table, temp_units=owm_forecasts.temp_units, wind_units=owm_forecasts.wind_units, tz_zone=owm_forecasts.tz_zone
+        )
+        if latest is None:
+            first = {"time": issued, "temp": float(table["temp"][0]), "precip_1h_mm": float(table["precip_3h_mm"][0]) / 3, "icon": table["icon"][0]}
+            yield issued, _current_weather(first), hourly_forecasts
+        else:
+            yield issued, _current_weather(latest), hourly_forecasts
+
+
+def json_snapshots(directory: str):
+    """
+    Yields issue time, current weather and hourly forecasts of the full JSON snapshots written before the forecast store
+    Snapshots hold the forecast in the configured units, the current weather is made up from the first forecast.
+    """
+    paths = sorted(glob.glob(os.path.join(directory, "openweather_*.json")))
+    for path in paths:
+        match = forecast_accuracy.SNAPSHOT_NAME.search(path)
+        if match is None:
+            continue
+        issued = datetime.strptime(match.group(1), "%Y-%m-%d_%H-%M-%S").timestamp()
+        try:
+            with open(path, "rb") as snapshotfile:
+                hourly_forecasts = json.loads(snapshotfile.read())
+            for item in hourly_forecasts:
+                item["datetime"] = datetime.fromisoformat(item["datetime"]).astimezone(owm_forecasts.tz_zone)
+            first = hourly_forecasts[0]
+        except (OSError, ValueError, KeyError, IndexError) as e:
+            logger.warning(f"Skipping {path}: {e!r}")
+            continue
+        temp = float(forecast_accuracy.to_kelvin(first["temp"], owm_forecasts.temp_units))
+        observed = {"time": issued, "temp": temp, "precip_1h_mm": first["precip_3h_mm"] / 3, "icon": first["icon"]}
+        yield issued, _current_weather(observed), hourly_forecasts
+
+
+def snapshots(directory: str, lat, lon):
+    """Yields issue time, current weather and hourly forecasts of every snapshot of the location, oldest first"""
+    # One month of the store is loaded at a time
+    stores = itertools.chain.from_iterable(
+        store_snapshots(owm_forecasts.ForecastStore(path)) for path in owm_forecasts.store_paths(lat, lon, directory)
+    )
+    return heapq.merge(json_snapshots(directory), stores, key=lambda snapshot: snapshot[0])
+
+
+def render_frame(snapshot: tuple) -> tuple:
+    """
+    Renders a snapshot as the panel would show it, in a worker process
+    :return:
+        Tuple of issue time, the frame as palette image bytes (see epd_image.join_bitplanes()) and the render time,
+        None and the error instead of the frame and time if rendering failed
+    """
+    (issued, current_weather, hourly_forecasts) = snapshot
+    start = time.perf_counter()
+    try:
+        owm_forecasts.render_time = issued
+        display = WeatherDisplay(pixel_width=800, pixel_height=480, width_mm=163, height_mm=98)
+        image = draw_forecasts.get_forecast_image(display=display, current_weather=current_weather, hourly_forecasts=hourly_forecasts)
+        frame = epd_image.join_bitplanes(*epd_image.to_palette(image=image, palette="bwr", dither=draw_forecasts.dither))
+    except Exception as e:
+        return issued, None, repr(e)
+    finally:
+        owm_forecasts.render_time = None
+    return issued, frame.tobytes(), time.perf_counter() - start
+
+
+class GifWriter:
+    """
+    Writes an animated GIF frame by frame, so the frames never have to be held in memory together
+    All frames are palette images using epd_image.BWR_PALETTE, which is the GIF's global colour table.
+    """
+
+    def __init__(self, path: str, duration_ms: int):
+        self.path = path
+        self.duration_ms = duration_ms
+        self.frames = 0
+        self._file = open(path, "wb")
+
+    def append(self, frame: Image) -> None:
+        if not self.frames:
+            (header, _) = GifImagePlugin.getheader(frame, info={"loop": 0, "duration": self.duration_ms, "optimize": False})
+            self._file.write(b"".join(header))
+        self._file.write(b"".join(GifImagePlugin.getdata(frame, duration=self.duration_ms)))
+        self.frames += 1
+
+    def close(self) -> None:
+        # Trailer
+        self._file.write(b";")
+        self._file.close()
+
+
+def _png(frame: Image):
+    def encode() -> bytes:
+        buffer = io.BytesIO()
+        frame.save(buffer, format="PNG")
+        return buffer.getvalue()
+
+    return encode
+
+
+def render_timelapse(snapshots, outdir: str, workers: int, duration_ms: int = 200) -> dict:
+    """
+    Renders the snapshots across a pool of worker processes, writes every frame as PNG and all of them as animated GIF
+    Snapshots are read while rendering and only FRAMES_AHEAD frames per worker are in flight, the frames are written
+    in order as they complete.
+    :return:
+        Dict with the number of frames, failures, seconds and frames per second
+    """
+    os.makedirs(os.path.join(outdir, "frames"), exist_ok=True)
+    # Past dates must not replace the dashboard's cached layers and tiles, and the workers would race on the same files
+    settings = draw_forecasts.applied_settings
+    draw_forecasts.apply_settings({**settings, "tile_cache_mb": 0})
+    draw_forecasts.persist_layers = False
+    draw_forecasts.warm_caches()
+    size = (800, 480)
+    gif = GifWriter(os.path.join(outdir, "timelapse.gif"), duration_ms)
+    writer = artifacts.get_writer()
+    stats = {"frames": 0, "failed": 0, "render_seconds": 0.0}
+
+    def write(result) -> None:
+        (issued, frame_bytes, seconds) = result
+        if frame_bytes is None:
+            stats["failed"] += 1
+            logger.error(f"Rendering the snapshot of {datetime.fromtimestamp(issued):%Y-%m-%d %H:%M} failed: {seconds}")
+            return
+        frame = Image.frombytes("P", size, frame_bytes)
+        frame.putpalette(epd_image.BWR_PALETTE)
+        stats["frames"] += 1
+        stats["render_seconds"] += seconds
+        writer.submit(os.path.join(outdir, "frames", f"frame_{stats['frames']:05d}_{datetime.fromtimestamp(issued):%Y%m%d-%H%M}.png"), _png(frame))
+        gif.append(frame)
+
+    start = time.perf_counter()
+    context = multiprocessing.get_context("fork")
+    try:
+        with context.Pool(processes=workers) as pool:
+            pending = collections.deque()
+            for snapshot in snapshots:
+                pending.append(pool.apply_async(render_frame, (snapshot,)))
+                if len(pending) >= workers * FRAMES_AHEAD:
+                    write(pending.popleft().get())
+            while pending:
+                write(pending.popleft().get())
+    finally:
+        gif.close()
+        writer.flush()
+        draw_forecasts.persist_layers = True
+        draw_forecasts.apply_settings(settings)
+    elapsed = time.perf_counter() - start
+    return dict(
+        stats,
+        workers=workers,
+        seconds=elapsed,
+        frames_per_second=stats["frames"] / elapsed if elapsed > 0 else 0.0,
+        mean_render_seconds=stats["render_seconds"] / stats["frames"] if stats["frames"] else 0.0,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-renders the forecast history as frames and an animated timelapse.")
+    parser.add_argument("--history", default=owm_forecasts.historydir, help="History directory (default: history)")
+    parser.add_argument("--out", default=os.path.join(_HERE, "timelapse"), help="Directory for the frames and timelapse.gif")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--duration", type=int, default=200, help="Milliseconds per frame of the timelapse")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    # The history has no indoor readings
+    draw_forecasts.configure_site({"mqtt_sub": False})
+    stats = render_timelapse(
+        snapshots(args.history, draw_forecasts.lat, draw_forecasts.lon), outdir=args.out, workers=args.workers, duration_ms=args.duration
+    )
+    logger.info(
+        f"{stats['frames']} frames ({stats['failed']} failed) in {stats['seconds']:.2f} s with {stats['workers']} workers: "
+        f"{stats['frames_per_second']:.2f} frames/s, {stats['mean_render_seconds']:.2f} s per frame"
+    )
+
+
+if __name__ == "__main__":
+    main()
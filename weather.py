@@ -1,11 +1,25 @@
 #!/usr/bin/python
-from PIL import Image
+import fcntl
 import logging
-import numpy
 import os
+import pickle
+import queue
+import signal
+import threading
+import time
 
-from src.drivers import epd7in5b_V2
+import artifacts
+import deadline
+import epd_image
+import frame_archive
+import framebuffer
+import panel_writer
+import profiling
+import draw_forecasts
+import render_budget
+from draw_forecasts import config
 from draw_forecasts import get_forecast_image
+from epd_image import to_palette
 from weather_display import WeatherDisplay
 
 logging.basicConfig(level=logging.DEBUG)
@@ -15,125 +29,331 @@ logger = logging.getLogger(__name__)
 repodir = os.path.dirname(os.path.realpath(__file__))
 srcdir = os.path.join(repodir, "src")
 fontdir = os.path.join(srcdir, "fonts")
+# Fingerprint of the frame on the panel, see draw_forecasts.get_fingerprint()
+fingerprintpath = os.path.join(draw_forecasts.cachedir, "frame-fingerprint")
+# Weather data of the last successful fetch, shown when OWM doesn't answer
+weatherpath = os.path.join(draw_forecasts.cachedir, "last-weather.pickle")
+# Held while a run is in progress, overlapping cron runs skip
+lockpath = os.path.join(draw_forecasts.cachedir, "weather.lock")
 
+# Default seconds per stage, overridden by stage_budget_seconds of config.json
+STAGE_BUDGETS = {"fetch": 45, "sensors": 20, "render": 90, "panel": 60}
+# The run is aborted this long after refresh_deadline_seconds if a stage still blocks
+DEADLINE_GRACE_SECONDS = 30
+# Seconds release_panel() waits for a busy panel to power off
+RELEASE_BUSY_SECONDS = 10
 
-def main():
+# EPD of the running refresh, released by _on_alarm()
+_epd = None
+
+
+def read_fingerprint():
+    """Returns the fingerprint of the frame on the panel, None if unknown"""
     try:
-        epd = epd7in5b_V2.EPD()
+        with open(fingerprintpath, "r") as infile:
+            return infile.read().strip()
+    except OSError:
+        return None
 
-        logging.info("Drawing image ...")
-        ## Display configuration
-        my_weather_display = WeatherDisplay(pixel_width=epd.width, pixel_height=epd.height, width_mm=163, height_mm=98)
-        ## Get the Weather Forecast as image
-        image = get_forecast_image(display=my_weather_display)
-        image_black, image_red = to_palette(image=image,palette="bwr")
-        image.save(os.path.join(repodir, "latest-image.jpg"))
+
+def forget_fingerprint() -> None:
+    # The panel no longer shows the last frame
+    if os.path.exists(fingerprintpath):
+        os.remove(fingerprintpath)
+
+
+def stream_to_panel(epd, image, band_height: int) -> tuple:
+    """
+    Maps and packs the image band by band on a thread while the bands already done are sent to the panel
+    The controller takes all black bytes before any red ones, so the red plane is kept packed until then.
+    :param band_height:
+        Rows per band
+    :return:
+        Packed black and red plane, as from epd_image.pack_bitplanes()
+    """
+    bands = queue.Queue(maxsize=2)
+
+    def convert():
+        try:
+            for band in epd_image.packed_bands(image, dither=draw_forecasts.dither, band_height=band_height):
+                bands.put(band)
+            bands.put(None)
+        except Exception as e:
+            bands.put(e)
+
+    threading.Thread(target=convert, name="band-converter", daemon=True).start()
+    black, red = [], []
+    epd.send_command(0x10)
+    while True:
+        band = bands.get()
+        if band is None:
+            break
+        if isinstance(band, Exception):
+            # The panel only refreshes with 0x12, a partial frame is never shown
+            raise band
+        (_, band_black, band_red) = band
+        epd.send_data2(band_black)
+        black.append(band_black)
+        red.append(band_red)
+    red = b"".join(red)
+    epd.send_command(0x13)
+    epd.send_data2(red)
+
+    epd.send_command(0x12)
+    time.sleep(0.1)
+    epd.ReadBusy()
+    return b"".join(black), red
+
+
+def update_panel(epd, image) -> None:
+    """Maps the image to the panel's colours and paints it, latest-image.png and .bin are written in the background"""
+    band_height = config.get("stream_band_rows", 0)
+    if band_height and image.size == (epd.width, epd.height):
         logging.info("Init EPD ...")
         epd.init()
 
-        # logging.info("Clear EPD ...")
-        # epd.Clear()
+        logging.info("Streaming image ...")
+        with profiling.stage("panel"):
+            (black, red) = stream_to_panel(epd, image, band_height)
+        artifacts.write_frame(os.path.join(repodir, "latest-image.png"), *epd_image.unpack_bitplanes(black, red, image.size))
+        artifacts.get_writer().submit(os.path.join(repodir, "latest-image.bin"), lambda: black + red)
+        frame_archive.record(black, red)
+
+        logging.info("Put EPD to Sleep...")
+        epd.sleep()
+        return
+
+    with profiling.stage("palette"):
+        image_black, image_red = to_palette(image=image,palette="bwr", dither=draw_forecasts.dither)
+    artifacts.write_frame(os.path.join(repodir, "latest-image.png"), image_black, image_red)
+    artifacts.write_bitplanes(os.path.join(repodir, "latest-image.bin"), image_black, image_red)
+    logging.info("Init EPD ...")
+    epd.init()
 
-        logging.info("Painting image ...")
+    # logging.info("Clear EPD ...")
+    # epd.Clear()
+
+    logging.info("Painting image ...")
+    with profiling.stage("panel"):
         epd.display(epd.getbuffer(image_black), epd.getbuffer(image_red))
+    frame_archive.record(*epd_image.pack_bitplanes(image_black, image_red))
 
-        logging.info("Put EPD to Sleep...")
+    logging.info("Put EPD to Sleep...")
+    epd.sleep()
+
+
+def publish_frame(frames: framebuffer.FrameBuffer, image) -> int:
+    """
+    Maps the image to the panel's colours and publishes it for panel_writer.py, latest-image.png and .bin are
+    written in the background
+    :return:
+        Sequence number of the frame
+    """
+    with profiling.stage("palette"):
+        bands = list(epd_image.packed_bands(image, dither=draw_forecasts.dither, band_height=config.get("stream_band_rows") or image.height))
+    black = b"".join(band_black for (_, band_black, _) in bands)
+    red = b"".join(band_red for (_, _, band_red) in bands)
+    seq = frames.publish(black, red)
+    logging.info(f"Published frame {seq} to {frames.path}")
+    artifacts.write_frame(os.path.join(repodir, "latest-image.png"), *epd_image.unpack_bitplanes(black, red, image.size))
+    artifacts.get_writer().submit(os.path.join(repodir, "latest-image.bin"), lambda: black + red)
+    return seq
+
+
+def clear_panel(epd) -> None:
+    """Clears the panel and puts it to sleep, like clean.py"""
+    logging.info("init and Clear")
+    forget_fingerprint()
+    epd.init()
+    epd.Clear()
+    frame_archive.record(*frame_archive.white_frame())
+
+    logging.info("Goto Sleep...")
+    epd.sleep()
+
+
+def acquire_lock():
+    """Returns the open lock file if no other run holds it, None otherwise. The lock is held until the process exits."""
+    os.makedirs(os.path.dirname(lockpath), exist_ok=True)
+    lockfile = open(lockpath, "w")
+    try:
+        fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lockfile.close()
+        return None
+    return lockfile
+
+
+def fetch_weather(run: deadline.Deadline):
+    """
+    Fetches the weather data within the fetch budget and keeps it for later runs
+    :return:
+        Tuple of current weather and hourly forecasts, the last fetched ones if fetching failed, None if there are none
+        or they are older than max_cached_weather_hours
+    """
+    try:
+        weather_data = run.run("fetch", draw_forecasts.get_weather_data)
+        artifacts.get_writer().submit(weatherpath, lambda: pickle.dumps((time.time(), weather_data)))
+        return weather_data
+    except Exception as e:
+        logging.error(f"Fetching weather data failed: {e!r}")
+    try:
+        with open(weatherpath, "rb") as weatherfile:
+            (fetched, weather_data) = pickle.load(weatherfile)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError) as e:
+        run.degrade("fetch", f"no cached weather data ({e.__class__.__name__})")
+        return None
+    age_hours = (time.time() - fetched) / 3600
+    if age_hours > config.get("max_cached_weather_hours", 6):
+        run.degrade("fetch", f"cached weather data is {age_hours:.1f} h old")
+        return None
+    run.degrade("fetch", f"using the weather data of {age_hours:.1f} h ago")
+    return weather_data
+
+
+def read_sensors(run: deadline.Deadline):
+    """
+    Waits for the indoor sensor within the sensors budget
+    :return:
+        Sensor readings, the last recorded ones marked stale if the sensor is silent, None if there are none
+    """
+    try:
+        # Finishes on its own after the budget, so the waiting thread doesn't outlive the stage
+        return run.run("sensors", draw_forecasts.get_sensor_readings, timeout=run.budget("sensors"))
+    except Exception as e:
+        logging.error(f"Reading the indoor sensor failed: {e!r}")
+    sensor_readings = draw_forecasts.get_stale_sensor_readings()
+    run.degrade("sensors", "no sensor values recorded" if sensor_readings is None else "last recorded values, marked stale")
+    return sensor_readings
+
+
+def release_panel(epd) -> None:
+    """Puts the panel to sleep after a failed refresh, or at least powers it down and releases SPI and GPIO"""
+    try:
+        # The panel may be stuck busy, don't wait a whole refresh for it to power off
+        epd.busy_timeout = RELEASE_BUSY_SECONDS
         epd.sleep()
+    except Exception as e:
+        from src.drivers import epd7in5b_V2
+
+        logging.error(f"Putting the EPD to sleep failed: {e!r}")
+        epd7in5b_V2.epdconfig.module_exit()
+
+
+def _on_alarm(signum, frame):
+    # Last resort if a stage blocks the main thread beyond the deadline
+    logging.error("Deadline exceeded, aborting the run")
+    if _epd is not None:
+        # The panel must not stay powered
+        from src.drivers import epd7in5b_V2
+
+        try:
+            epd7in5b_V2.epdconfig.module_exit()
+        except Exception as e:
+            logging.error(f"Releasing the EPD failed: {e!r}")
+    os._exit(2)
+
+
+def main():
+    global _epd
+    epd = None
+    lockfile = acquire_lock()
+    if lockfile is None:
+        logging.warning("Another run is still in progress, skipping this one")
         exit()
+    run = deadline.Deadline(
+        total_seconds=config.get("refresh_deadline_seconds", 240),
+        budgets={**STAGE_BUDGETS, **config.get("stage_budget_seconds", {})},
+    )
+    signal.signal(signal.SIGALRM, _on_alarm)
+    signal.alarm(int(run.total_seconds) + DEADLINE_GRACE_SECONDS)
+    try:
+        if config.get("framebuffer"):
+            # The panel belongs to panel_writer.py, this process only renders
+            frames = framebuffer.FrameBuffer(panel_writer.framebuffer_path(config["framebuffer"]))
+            (width, height) = (frames.width, frames.height)
+        else:
+            from src.drivers import epd7in5b_V2
+
+            epd = _epd = epd7in5b_V2.EPD()
+            (width, height) = (epd.width, epd.height)
+
+        if config.get("profile_memory", False):
+            profiling.enable()
+
+        logging.info("Drawing image ...")
+        ## Display configuration
+        my_weather_display = WeatherDisplay(pixel_width=width, pixel_height=height, width_mm=163, height_mm=98)
+        with profiling.stage("fetch"):
+            weather_data = fetch_weather(run)
+            sensor_readings = read_sensors(run) if draw_forecasts.mqtt_sub else None
+        if weather_data is None or (draw_forecasts.mqtt_sub and sensor_readings is None):
+            run.degrade("panel", "nothing to show, the panel keeps the last frame")
+            finish(run)
+        (current_weather, hourly_forecasts) = weather_data
+
+        ## Pick the render quality that fits the render budget, part of the fingerprint as it changes the frame
+        budget = render_budget.from_config(config)
+        if budget is not None:
+            render_budget.apply(budget)
+
+        ## Skip render and panel if the frame would be the same as the one shown
+        fingerprint = draw_forecasts.get_fingerprint(my_weather_display, current_weather, hourly_forecasts, sensor_readings)
+        if config.get("skip_unchanged_frames", True) and fingerprint == read_fingerprint():
+            logging.info(f"Nothing changed since the last frame ({fingerprint[:12]}), leaving the panel asleep")
+            finish(run)
+
+        ## Get the Weather Forecast as image
+        with profiling.stage("render"), run.measure("render"):
+            image = get_forecast_image(
+                display=my_weather_display,
+                current_weather=current_weather,
+                hourly_forecasts=hourly_forecasts,
+                sensor_readings=sensor_readings,
+            )
+        if run.remaining() < run.budgets["panel"]:
+            # A refresh started now would overrun the deadline
+            run.degrade("panel", f"only {run.remaining():.0f} s left, the panel keeps the last frame")
+            finish(run)
+        try:
+            # On this thread, an abandoned refresh would leave the panel powered with half a frame; a BUSY line
+            # stuck for longer than the budget raises TimeoutError in ReadBusy()
+            with run.measure("panel"):
+                if epd is None:
+                    publish_frame(frames, image)
+                else:
+                    # A frame interrupted while painting is not on the panel
+                    forget_fingerprint()
+                    epd.busy_timeout = run.budget("panel")
+                    update_panel(epd, image)
+        except Exception as e:
+            logging.error(f"Updating the panel failed: {e!r}")
+            if epd is not None:
+                release_panel(epd)
+            finish(run)
+        artifacts.get_writer().submit(fingerprintpath, lambda: fingerprint.encode("utf-8"))
+        if budget is not None:
+            budget.record(draw_forecasts.applied_settings)
+        finish(run)
 
     except KeyboardInterrupt:
         logging.info("ctrl + c:")
-        epd7in5b_V2.epdconfig.module_exit()
+        if epd is not None:
+            epd7in5b_V2.epdconfig.module_exit()
         exit()
 
-# Stolen from inkycal
-def to_palette(image, palette, dither=True) -> (Image, Image):
-    """Maps an image to a given colour palette.
-    Maps each pixel from the image to a colour from the palette.
-    Args:
-      - palette: A supported token. (see below)
-      - dither:->bool. Use dithering? Set to `False` for solid colour fills.
-    Returns:
-      - two images: one for the coloured band and one for the black band.
-    Raises:
-      - ValueError if palette token is not supported
-    Supported palette tokens:
-    >>> 'bwr' # black-white-red
-    >>> 'bwy' # black-white-yellow
-    >>> 'bw'  # black-white
-    >>> '16gray' # 16 shades of gray
-    """
-    # 
-
-    image.convert('RGB')
-    logger.info('loaded Image')
-
-    if palette == 'bwr':
-        # black-white-red palette
-        pal = [255, 255, 255, 0, 0, 0, 255, 0, 0]
-    elif palette == 'bwy':
-        # black-white-yellow palette
-        pal = [255, 255, 255, 0, 0, 0, 255, 255, 0]
-    elif palette == 'bw':
-        pal = None
-    elif palette == '16gray':
-        pal = [x for x in range(0, 256, 16)] * 3
-        pal.sort()
-    else:
-        logger.error('The given palette is unsupported.')
-        raise ValueError('The given palette is not supported.')
-    if pal:
-        # The palette needs to have 256 colors, for this, the black-colour
-        # is added until the
-        colours = len(pal) // 3
-        # print(f'The palette has {colours} colours')
-        if 256 % colours != 0:
-            # print('Filling palette with black')
-            pal += (256 % colours) * [0, 0, 0]
-        # print(pal)
-        colours = len(pal) // 3
-        # print(f'The palette now has {colours} colours')
-        # Create a dummy image to be used as a palette
-        palette_im = Image.new('P', (1, 1))
-        # Attach the created palette. The palette should have 256 colours
-        # equivalent to 768 integers
-        palette_im.putpalette(pal * (256 // colours))
-        # Quantize the image to given palette
-        quantized_im = image.quantize(palette=palette_im, dither=dither)
-        quantized_im = quantized_im.convert('RGB')
-        # get rgb of the non-black-white colour from the palette
-        rgb = [pal[x:x + 3] for x in range(0, len(pal), 3)]
-        rgb = [col for col in rgb if col != [0, 0, 0] and col != [255, 255, 255]][0]
-        r_col, g_col, b_col = rgb
-        # print(f'r:{r_col} g:{g_col} b:{b_col}')
-        # Create an image buffer for black pixels
-        buffer1 = numpy.array(quantized_im)
-        # Get RGB values of each pixel
-        r, g, b = buffer1[:, :, 0], buffer1[:, :, 1], buffer1[:, :, 2]
-        # convert coloured pixels to white
-        buffer1[numpy.logical_and(r == r_col, g == g_col)] = [255, 255, 255]
-        # reconstruct image for black-band
-        im_black = Image.fromarray(buffer1)
-        # Create a buffer for coloured pixels
-        buffer2 = numpy.array(quantized_im)
-        # Get RGB values of each pixel
-        r, g, b = buffer2[:, :, 0], buffer2[:, :, 1], buffer2[:, :, 2]
-        # convert black pixels to white
-        buffer2[numpy.logical_and(r == 0, g == 0)] = [255, 255, 255]
-        # convert non-white pixels to black
-        buffer2[numpy.logical_and(g == g_col, b == 0)] = [0, 0, 0]
-        # reconstruct image for colour-band
-        im_colour = Image.fromarray(buffer2)
-        # self.preview(im_black)
-        # self.preview(im_colour)
-
-    else:
-        im_black = image.convert('1', dither=dither)
-        im_colour = Image.new(mode='1', size=im_black.size, color='white')
-
-    logger.info('mapped image to specified palette')
-
-    return im_black, im_colour
+
+def finish(run: deadline.Deadline) -> None:
+    """Writes the queued files, reports the stages and exits, with status 1 if a stage overran"""
+    with profiling.stage("artifacts"):
+        failures = artifacts.flush()
+    if failures:
+        logging.error(f"{len(failures)} file(s) could not be written")
+    if profiling.is_enabled():
+        profiling.report()
+    run.report()
+    exit(1 if run.overrun() else 0)
+
 
 if __name__ == "__main__":
     main()